@@ -1,3 +1,4 @@
+import copy
 import os
 import time
 import traceback
@@ -18,6 +19,10 @@ from distar.envs.env import SC2Env
 from distar.ctools.worker.league.player import FRAC_ID
 
 default_config = read_config(os.path.join(os.path.dirname(__file__), 'actor_default_config.yaml'))
+# agent attributes shared by all agent copies of pipelined envs in one process
+SHARED_AGENT_ATTRS = ['inference_request', '_shared_input', '_shared_output', '_signals', '_responses',
+                      '_teacher_shared_input', '_teacher_shared_output', '_teacher_signals', '_teacher_responses',
+                      'handoff_latency', 'teacher_handoff_latency']
 
 
 class Actor(object):
@@ -29,6 +34,9 @@ class Actor(object):
         self._league_job_type = cfg.actor.get('league_job_type','train')
         self._actor_uid = str(uuid.uuid1())
         self._gpu_batch_inference = self._cfg.get('gpu_batch_inference', False)
+        self._cpu_batch_inference = self._cfg.get('cpu_batch_inference', False)
+        self._batch_inference = self._gpu_batch_inference or self._cpu_batch_inference
+        self._pipeline_env_num = self._cfg.get('pipeline_env_num', 1)
         self._logger = TextLogger(
             path=os.path.join(os.getcwd(), 'experiments', self._whole_cfg.common.experiment_name, 'actor_log'),
             name=self._actor_uid)
@@ -102,8 +110,7 @@ class Actor(object):
                         else:
                             agent.teacher_model = teacher_models[teacher_player_id]
 
-    def _inference_loop(self, env_id=0, job={}, result_queue=None, pipe_c=None):
-        torch.set_num_threads(1)
+    def _make_env(self, job):
         frac_ids = job.get('frac_ids',[])
         env_info = job.get('env_info', {})
         races = []
@@ -112,21 +119,132 @@ class Actor(object):
         if len(races) >0:
             env_info['races']=races
         mergerd_whole_cfg = deep_merge_dicts(self._whole_cfg, {'env': env_info})
-        self._env = SC2Env(mergerd_whole_cfg)
+        return SC2Env(mergerd_whole_cfg)
+
+    def _make_variable_record(self):
+        variable_record = VariableRecord(self._cfg.print_freq)
+        variable_record.register_var('agent_time')
+        variable_record.register_var('agent_time_per_agent')
+        variable_record.register_var('env_time')
+        if 'train' in self._job_type:
+            variable_record.register_var('post_process_time')
+            variable_record.register_var('post_process_per_agent')
+            variable_record.register_var('send_data_time')
+            variable_record.register_var('send_data_per_agent')
+            variable_record.register_var('send_data_per_agent')
+            variable_record.register_var('update_model_time')
+        return variable_record
+
+    @staticmethod
+    def _copy_agent(agent):
+        # models and batch inference buffers stay shared with the original agent, episode states are copied
+        memo = {}
+        for k, v in vars(agent).items():
+            if k in SHARED_AGENT_ATTRS or isinstance(v, torch.nn.Module):
+                memo[id(v)] = v
+        return copy.deepcopy(agent, memo)
+
+    def _reset_agents(self, agents, env_id, observations, game_info, map_name):
+        for idx in observations.keys():
+            agents[idx].env_id = env_id
+            race = self._whole_cfg.env.races[idx]
+            agents[idx].reset(map_name, race, game_info[idx], observations[idx])
+
+    def _agents_step(self, agents, players_obs):
+        actions = {}
+        for player_index, obs in players_obs.items():
+            player_id = agents[player_index].player_id
+            if self._job_type == 'train':
+                agents[player_index]._model_last_iter = self._comm.model_last_iter_dict[player_id].item()
+            actions[player_index] = agents[player_index].step(obs)
+        return actions
+
+    def _collect_data(self, agents, next_players_obs, reward, done):
+        post_process_time = 0
+        post_process_count = 0
+        send_data_time = 0
+        send_data_count = 0
+        for player_index, obs in next_players_obs.items():
+            if self._job_type == 'train_test' or agents[player_index].player_id in self._comm.job[
+                'send_data_players']:
+                post_process_start_time = time.time()
+                traj_data = agents[player_index].collect_data(next_players_obs[player_index],
+                                                              reward[player_index], done, player_index)
+                post_process_time += time.time() - post_process_start_time
+                post_process_count += 1
+                if traj_data is not None and self._job_type == 'train':
+                    send_data_start_time = time.time()
+                    self._comm.send_data(traj_data, agents[player_index].player_id)
+                    send_data_time += time.time() - send_data_start_time
+                    send_data_count += 1
+            else:
+                agents[player_index].update_fake_reward(next_players_obs[player_index])
+        record_vars = {}
+        if post_process_count > 0:
+            record_vars.update({
+                'post_process_time': post_process_time,
+                'post_process_per_agent': post_process_time / post_process_count,
+            })
+        if send_data_count > 0:
+            record_vars.update({
+                'send_data_time': send_data_time,
+                'send_data_per_agent': send_data_time / send_data_count,
+            })
+        return record_vars
+
+    def _finish_episode(self, env, agents, env_id, episode_count, players_obs, reward, game_start, game_iters):
+        if 'test' in self._whole_cfg and self._whole_cfg.test.get('tb_stat', False):
+            if not os.path.exists(env._result_dir):
+                os.makedirs(env._result_dir)
+            data = agents[0].get_stat_data()
+            player_index = list(players_obs.keys())[-1]
+            path = os.path.join(env._result_dir, '{}_{}_{}_.json'.format(env_id, episode_count, player_index))
+            with open(path, 'w') as f:
+                json.dump(data, f)
 
+        if self._job_type == 'train':
+            player_idx = random.choice(list(players_obs.keys()))
+            game_steps = players_obs[player_idx]['raw_obs'].observation.game_loop
+            result_info = defaultdict(dict)
+
+            for player_index in range(len(agents)):
+                player_id = agents[player_index].player_id
+                side_id = agents[player_index].side_id
+                race = agents[player_index].race
+                agent_iters = agents[player_index].iter_count
+                result_info[side_id]['race'] = race
+                result_info[side_id]['player_id'] = player_id
+                result_info[side_id]['opponent_id'] = agents[player_index].opponent_id
+                result_info[side_id]['winloss'] = reward[player_index]
+                result_info[side_id]['agent_iters'] = agent_iters
+                result_info[side_id].update(agents[player_index].get_unit_num_info())
+                result_info[side_id].update(agents[player_index].get_stat_data())
+            game_duration = time.time() - game_start
+            result_info['game_steps'] = game_steps
+            result_info['game_iters'] = game_iters
+            result_info['game_duration'] = game_duration
+            self._comm.send_result(result_info)
+
+    def _inference_loop(self, env_id=0, job={}, result_queue=None, pipe_c=None):
+        torch.set_num_threads(1)
+        if self._pipeline_env_num > 1:
+            closed = self._pipeline_loop(env_id, job, pipe_c)
+        else:
+            closed = self._serial_loop(env_id, job, pipe_c)
+        if closed:
+            return
+        if result_queue is not None:
+            print(os.getpid(), 'done')
+            result_queue.put('done')
+            time.sleep(1000000)
+        else:
+            return
+
+    def _serial_loop(self, env_id, job, pipe_c):
+        self._env = self._make_env(job)
         iter_count = 0
         if env_id == 0:
-            variable_record = VariableRecord(self._cfg.print_freq)
-            variable_record.register_var('agent_time')
-            variable_record.register_var('agent_time_per_agent')
-            variable_record.register_var('env_time')
-            if 'train' in self._job_type:
-                variable_record.register_var('post_process_time')
-                variable_record.register_var('post_process_per_agent')
-                variable_record.register_var('send_data_time')
-                variable_record.register_var('send_data_per_agent')
-                variable_record.register_var('send_data_per_agent')
-                variable_record.register_var('update_model_time')
+            variable_record = self._make_variable_record()
         with torch.no_grad():
             episode_count = 0
             while episode_count < self._cfg.episode_num:
@@ -134,10 +252,7 @@ class Actor(object):
                     game_start = time.time()
                     game_iters = 0
                     observations, game_info, map_name = self._env.reset()
-                    for idx in observations.keys():
-                        self.agents[idx].env_id = env_id
-                        race = self._whole_cfg.env.races[idx]
-                        self.agents[idx].reset(map_name, race, game_info[idx], observations[idx])
+                    self._reset_agents(self.agents, env_id, observations, game_info, map_name)
 
                     while True:  # one episode loop
                         if pipe_c is not None and pipe_c.poll():
@@ -146,109 +261,36 @@ class Actor(object):
                                 break
                             elif cmd == 'close':
                                 self._env.close()
-                                return
+                                return True
                         # agent step
                         agent_start_time = time.time()
-                        agent_count = 0
-                        actions = {}
-
-                        players_obs = observations
-                        for player_index, obs in players_obs.items():
-                            player_id = self.agents[player_index].player_id
-                            if self._job_type == 'train':
-                                self.agents[player_index]._model_last_iter = self._comm.model_last_iter_dict[player_id].item()
-                            actions[player_index] = self.agents[player_index].step(obs)
-                            agent_count += 1
+                        actions = self._agents_step(self.agents, observations)
                         agent_time = time.time() - agent_start_time
 
                         # env step
                         env_start_time = time.time()
                         next_observations, reward, done = self._env.step(actions)
                         env_time = time.time() - env_start_time
-                        next_players_obs = next_observations
+                        record_vars = {'agent_time': agent_time,
+                                       'agent_time_per_agent': agent_time / (len(actions) + 1e-6),
+                                       'env_time': env_time,
+                                       }
                         # collect data
                         if 'train' in self._job_type:
-                            post_process_time = 0
-                            post_process_count = 0
-                            send_data_time = 0
-                            send_data_count = 0
-                            for player_index, obs in next_players_obs.items():
-                                if self._job_type == 'train_test' or self.agents[player_index].player_id in self._comm.job[
-                                    'send_data_players']:
-                                    post_process_start_time = time.time()
-                                    traj_data = self.agents[player_index].collect_data(next_players_obs[player_index],
-                                                                                    reward[player_index], done, player_index)
-                                    post_process_time += time.time() - post_process_start_time
-                                    post_process_count += 1
-                                    if traj_data is not None and self._job_type == 'train':
-                                        send_data_start_time = time.time()
-                                        self._comm.send_data(traj_data, self.agents[player_index].player_id)
-                                        send_data_time += time.time() - send_data_start_time
-                                        send_data_count += 1
-                                else:
-                                    self.agents[player_index].update_fake_reward(next_players_obs[player_index])
+                            record_vars.update(self._collect_data(self.agents, next_observations, reward, done))
 
                         # update log
                         iter_count += 1
                         game_iters += 1
                         if env_id == 0:
-                            if 'train' in self._job_type:
-                                variable_record.update_var(
-                                    {'agent_time': agent_time,
-                                    'agent_time_per_agent': agent_time / (agent_count + 1e-6),
-                                    'env_time': env_time,
-                                    })
-                                if post_process_count > 0:
-                                    variable_record.update_var(
-                                        {'post_process_time': post_process_time,
-                                        'post_process_per_agent': post_process_time / post_process_count,
-                                        })
-                                if send_data_count > 0:
-                                    variable_record.update_var({
-                                        'send_data_time': send_data_time,
-                                        'send_data_per_agent': send_data_time / send_data_count,
-                                    })
-
-                            else:
-                                variable_record.update_var({'agent_time': agent_time,
-                                                            'agent_time_per_agent': agent_time / (agent_count + 1e-6),
-                                                            'env_time': env_time, })
+                            variable_record.update_var(record_vars)
                             self.iter_after_hook(iter_count, variable_record)
 
                         if not done:
                             observations = next_observations
                         else:
-                            players_obs = observations
-                            if 'test' in self._whole_cfg and self._whole_cfg.test.get('tb_stat', False):
-                                if not os.path.exists(self._env._result_dir):
-                                    os.makedirs(self._env._result_dir)
-                                data = self.agents[0].get_stat_data()
-                                path = os.path.join(self._env._result_dir, '{}_{}_{}_.json'.format(env_id, episode_count, player_index))
-                                with open(path, 'w') as f:
-                                    json.dump(data, f)
-
-                            if self._job_type == 'train':
-                                player_idx = random.sample(players_obs.keys(), 1)[0]
-                                game_steps = players_obs[player_idx]['raw_obs'].observation.game_loop
-                                result_info = defaultdict(dict)
-
-                                for player_index in range(len(self.agents)):
-                                    player_id = self.agents[player_index].player_id
-                                    side_id = self.agents[player_index].side_id
-                                    race = self.agents[player_index].race
-                                    agent_iters = self.agents[player_index].iter_count
-                                    result_info[side_id]['race'] = race
-                                    result_info[side_id]['player_id'] = player_id
-                                    result_info[side_id]['opponent_id'] = self.agents[player_index].opponent_id
-                                    result_info[side_id]['winloss'] = reward[player_index]
-                                    result_info[side_id]['agent_iters'] = agent_iters
-                                    result_info[side_id].update(self.agents[player_index].get_unit_num_info())
-                                    result_info[side_id].update(self.agents[player_index].get_stat_data())
-                                game_duration = time.time() - game_start
-                                result_info['game_steps'] = game_steps
-                                result_info['game_iters'] = game_iters
-                                result_info['game_duration'] = game_duration
-                                self._comm.send_result(result_info)
+                            self._finish_episode(self._env, self.agents, env_id, episode_count, observations, reward,
+                                                 game_start, game_iters)
                             break
 
                     episode_count += 1
@@ -258,20 +300,106 @@ class Actor(object):
                     episode_count += 1
                     self._env.close()
             self._env.close()
-            if result_queue is not None:
-                print(os.getpid(), 'done')
-                result_queue.put('done')
-                time.sleep(1000000)
-            else:
-                return
+        return False
 
-    def _gpu_inference_loop(self):
-        _, _ = dist_init(method='single_node')
-        torch.set_num_threads(1)
-        for agent in self.agents:
-            agent.model = agent.model.cuda()
-            if 'train' in self._job_type:
-                agent.teacher_model = agent.teacher_model.cuda()
+    def _pipeline_loop(self, env_id, job, pipe_c):
+        # keep pipeline_env_num envs in flight, agents of one env run inference while SC2 steps the others
+        pipeline_env_num = self._pipeline_env_num
+        envs = [self._make_env(job) for _ in range(pipeline_env_num)]
+        agents_list = [self.agents] + [[self._copy_agent(agent) for agent in self.agents]
+                                       for _ in range(pipeline_env_num - 1)]
+        # every env owns one slot of the batch inference buffers
+        slot_ids = [env_id * pipeline_env_num + idx for idx in range(pipeline_env_num)]
+        observations = [None] * pipeline_env_num
+        game_start = [0.] * pipeline_env_num
+        game_iters = [0] * pipeline_env_num
+        running = [False] * pipeline_env_num
+        stepping = [False] * pipeline_env_num
+        iter_count = 0
+        episode_count = 0
+        if env_id == 0:
+            variable_record = self._make_variable_record()
+        with torch.no_grad():
+            while episode_count < self._cfg.episode_num or any(running):
+                if pipe_c is not None and pipe_c.poll():
+                    cmd = pipe_c.recv()
+                    if cmd == 'reset':
+                        for idx in range(pipeline_env_num):
+                            if stepping[idx]:
+                                try:
+                                    envs[idx].step_wait()
+                                except Exception:
+                                    envs[idx].close()
+                            running[idx] = stepping[idx] = False
+                    elif cmd == 'close':
+                        for env in envs:
+                            env.close()
+                        return True
+                for idx in range(pipeline_env_num):
+                    env, agents = envs[idx], agents_list[idx]
+                    try:
+                        if not running[idx]:
+                            if episode_count >= self._cfg.episode_num:
+                                continue
+                            episode_count += 1
+                            game_start[idx] = time.time()
+                            game_iters[idx] = 0
+                            observations[idx], game_info, map_name = env.reset()
+                            self._reset_agents(agents, slot_ids[idx], observations[idx], game_info, map_name)
+                            running[idx] = True
+                        elif stepping[idx]:
+                            env_start_time = time.time()
+                            next_observations, reward, done = env.step_wait()
+                            stepping[idx] = False
+                            # only the time blocked on SC2 is counted, the rest overlaps with inference
+                            record_vars = {'env_time': time.time() - env_start_time}
+                            if 'train' in self._job_type:
+                                record_vars.update(self._collect_data(agents, next_observations, reward, done))
+                            iter_count += 1
+                            game_iters[idx] += 1
+                            if env_id == 0:
+                                variable_record.update_var(record_vars)
+                                self.iter_after_hook(iter_count, variable_record)
+                            if done:
+                                self._finish_episode(env, agents, env_id, episode_count, observations[idx], reward,
+                                                     game_start[idx], game_iters[idx])
+                                running[idx] = False
+                                continue
+                            observations[idx] = next_observations
+
+                        agent_start_time = time.time()
+                        actions = self._agents_step(agents, observations[idx])
+                        agent_time = time.time() - agent_start_time
+                        env.step_async(actions)
+                        stepping[idx] = True
+                        if env_id == 0:
+                            variable_record.update_var({'agent_time': agent_time,
+                                                        'agent_time_per_agent': agent_time / (len(actions) + 1e-6)})
+                    except Exception as e:
+                        print('[EPISODE LOOP ERROR]', e, flush=True)
+                        print(''.join(traceback.format_tb(e.__traceback__)), flush=True)
+                        running[idx] = stepping[idx] = False
+                        env.close()
+            for env in envs:
+                env.close()
+        return False
+
+    def _batch_inference_loop(self):
+        if self._gpu_batch_inference:
+            _, _ = dist_init(method='single_node')
+            torch.set_num_threads(1)
+            device = torch.cuda.current_device()
+            for agent in self.agents:
+                agent.model = agent.model.cuda()
+                if 'train' in self._job_type:
+                    agent.teacher_model = agent.teacher_model.cuda()
+        else:
+            # env processes are pinned to one thread, the batched forward gets the intra-op threads instead
+            torch.set_num_threads(self._cfg.get('batch_inference_num_threads', 4))
+            device = 'cpu'
+        max_batch_size = self._cfg.get('batch_inference_max_batch_size', 0) or self._cfg.env_num
+        max_wait_time = self._cfg.get('batch_inference_max_wait_time', 0.)
+        first_request_time = defaultdict(lambda: None)
         start_time = time.time()
         done_count = 0
         with torch.no_grad():
@@ -293,10 +421,32 @@ class Actor(object):
                         if done_count == len(self._processes):
                             self._close_processes()
                             break
-                for agent in self.agents:
-                    agent.gpu_batch_inference()
-                    if 'train' in self._job_type:
-                        agent.gpu_batch_inference(teacher=True)
+                # an env process blocks on its request, so at most one request per alive env is pending
+                full_batch_size = min(max_batch_size, max(self._cfg.env_num - done_count, 1))
+                # wake up at least once a second for model update and job control
+                wait_time = 1.
+                for agent_idx, agent in enumerate(self.agents):
+                    for teacher in ([False, True] if 'train' in self._job_type else [False]):
+                        key = (agent_idx, teacher)
+                        pending_num = agent.pending_inference_num(teacher=teacher)
+                        if pending_num == 0:
+                            first_request_time[key] = None
+                            continue
+                        now = time.time()
+                        if first_request_time[key] is None:
+                            first_request_time[key] = now
+                        remain_time = first_request_time[key] + max_wait_time - now
+                        if pending_num < full_batch_size and remain_time > 0:
+                            wait_time = min(wait_time, remain_time)
+                            continue
+                        agent.batch_inference(teacher=teacher, device=device, max_batch_size=max_batch_size)
+                        first_request_time[key] = None
+                        if pending_num > max_batch_size:
+                            wait_time = 0
+                # every request releases the semaphore once, drain the rest before scanning signals again
+                if wait_time > 0 and self._inference_request.acquire(timeout=wait_time):
+                    while self._inference_request.acquire(block=False):
+                        pass
 
     def _start_multi_inference_loop(self):
         self._close_processes()
@@ -310,6 +460,10 @@ class Actor(object):
         context_str = 'spawn' if platform.system().lower() == 'windows' else 'fork'
         mp_context = mp.get_context(context_str)
         self._result_queue = mp_context.Queue()
+        if self._batch_inference:
+            self._inference_request = mp_context.Semaphore(0)
+            for agent in self.agents:
+                agent.inference_request = self._inference_request
         for env_id in range(self._cfg.env_num):
             pipe_p, pipe_c = mp_context.Pipe()
             p = mp_context.Process(target=self._inference_loop, args=(env_id, job, self._result_queue, pipe_c), daemon=True)
@@ -329,8 +483,8 @@ class Actor(object):
             else:
                 if self._job_type == 'train':
                     self._start_multi_inference_loop()
-                    if self._gpu_batch_inference:
-                        self._gpu_inference_loop()
+                    if self._batch_inference:
+                        self._batch_inference_loop()
                     else:
                         start_time = time.time()
                         while True:
@@ -340,8 +494,8 @@ class Actor(object):
                             time.sleep(1)
                 if self._job_type == 'eval':
                     self._start_multi_inference_loop()
-                    if self._gpu_batch_inference:
-                        self._gpu_inference_loop()
+                    if self._batch_inference:
+                        self._batch_inference_loop()
                     else:
                         for _ in range(len(self._processes)):
                             self._result_queue.get()
@@ -375,10 +529,16 @@ class Actor(object):
         if iter_count % self._cfg.print_freq == 0:
             if hasattr(self,'_comm'):
                 variable_record.update_var({'update_model_time':self._comm._avg_update_model_time.item() })
+            handoff_text = ''
+            if self._batch_inference:
+                for agent in self.agents:
+                    handoff_text += '\n' + agent.handoff_latency.get_text()
+                    if 'train' in self._job_type:
+                        handoff_text += '\n' + agent.teacher_handoff_latency.get_text()
             self._logger.info(
-                'ACTOR({}):\n{}TimeStep{}{} {}'.format(
+                'ACTOR({}):\n{}TimeStep{}{} {}{}'.format(
                     self._actor_uid, '=' * 35, iter_count, '=' * 35,
-                    variable_record.get_vars_text()
+                    variable_record.get_vars_text(), handoff_text
                 )
             )
 
@@ -11,6 +11,7 @@ import json
 import os
 import random
 import torch
+import torch.multiprocessing as mp
 
 from copy import deepcopy
 from collections import deque, defaultdict
@@ -18,13 +19,23 @@ from functools import partial
 from torch.utils.data._utils.collate import default_collate
 
 from .model.model import Model
+from .model.quantize import quantize_model
+from .model.compiled_model import CompiledModel, enable_fallback_random
 from .lib.actions import NUM_CUMULATIVE_STAT_ACTIONS, ACTIONS, BEGINNING_ORDER_ACTIONS, CUMULATIVE_STAT_ACTIONS, UNIT_ABILITY_TO_ACTION, QUEUE_ACTIONS, UNIT_TO_CUM, UPGRADE_TO_CUM
-from .lib.features import Features, SPATIAL_SIZE, BEGINNING_ORDER_ACTIONS, CUMULATIVE_STAT_ACTIONS, BEGINNING_ORDER_LENGTH, ScoreCategories, compute_battle_score, fake_step_data, fake_model_output
+from .lib.features import Features, SPATIAL_SIZE, BEGINNING_ORDER_ACTIONS, CUMULATIVE_STAT_ACTIONS, BEGINNING_ORDER_LENGTH, ScoreCategories, compute_battle_score, fake_step_data, fake_model_output, MAX_ENTITY_NUM
 from .lib.stat import Stat, cum_dict
+from .lib.trajectory_buffer import TrajectoryBuffer, intern_static_layers, encode_entity_delta, pack_trajectory
+from .lib.compact_logit import compact_logit
+from .lib.z_library import load_z_library
 from distar.ctools.torch_utils.metric import levenshtein_distance, hamming_distance, l2_distance
 from distar.pysc2.lib.units import get_unit_type
 from distar.pysc2.lib.static_data import UNIT_TYPES, NUM_UNIT_TYPES
 from distar.ctools.torch_utils import to_device
+from distar.ctools.utils.log_helper import LatencyHistogram
+
+# per action type masks of step data, written into trajectory buffer without copying ACTIONS every step
+ACTIONS_MASK = [{k: torch.tensor(v, dtype=torch.long) for k, v in action.items()
+                 if k not in ['name', 'goal', 'func_id', 'general_ability_id', 'game_id']} for action in ACTIONS]
 
 RACE_DICT = {
     1: 'terran',
@@ -67,26 +78,42 @@ def copy_input_data(shared_step_data, step_data, data_idx):
                     shared_step_data[k][_k][data_idx].copy_(step_data[k][_k])
 
 
+def select_input_data(shared_step_data, data_indexes, max_entity_num=None):
+    # gather the rows of pending env processes, so the batched forward only runs on them,
+    # entity_info is also cut to max_entity_num, outputs are copied back into the padded buffers by copy_output_data
+    ret = {}
+    for k, v in shared_step_data.items():
+        if k == 'hidden_state':
+            ret[k] = [(v[i][0].index_select(0, data_indexes), v[i][1].index_select(0, data_indexes))
+                      for i in range(len(v))]
+        elif isinstance(v, torch.Tensor):
+            ret[k] = v.index_select(0, data_indexes)
+        elif k == 'entity_info' and max_entity_num is not None:
+            ret[k] = {_k: _v[:, :max_entity_num].index_select(0, data_indexes) for _k, _v in v.items()}
+        elif isinstance(v, dict):
+            ret[k] = {_k: _v.index_select(0, data_indexes) for _k, _v in v.items()}
+    return ret
+
+
 def copy_output_data(shared_step_data, step_data, data_indexes):
-    data_indexes = data_indexes.nonzero().squeeze(dim=1)
+    # step_data is the output of a forward on select_input_data(..., data_indexes), row i belongs to data_indexes[i]
     for k, v in step_data.items():
         if k == 'hidden_state':
             for i in range(len(v)):
-                shared_step_data['hidden_state'][i][0].index_copy_(0, data_indexes, v[i][0][data_indexes].cpu())
-                shared_step_data['hidden_state'][i][1].index_copy_(0, data_indexes, v[i][1][data_indexes].cpu())
+                shared_step_data['hidden_state'][i][0].index_copy_(0, data_indexes, v[i][0].cpu())
+                shared_step_data['hidden_state'][i][1].index_copy_(0, data_indexes, v[i][1].cpu())
         elif isinstance(v, dict):
             for _k, _v in v.items():
                 if len(_v.shape) == 3:
                     _, s1, s2 = _v.shape
-                    #shared_step_data[k][_k][:, :s1, :s2][data_indexes].copy_(_v[data_indexes])
-                    shared_step_data[k][_k][:, :s1, :s2].index_copy_(0, data_indexes, _v[data_indexes].cpu())
+                    shared_step_data[k][_k][:, :s1, :s2].index_copy_(0, data_indexes, _v.cpu())
                 elif len(_v.shape) == 2:
                     _, s1 = _v.shape
-                    shared_step_data[k][_k][:, :s1].index_copy_(0, data_indexes, _v[data_indexes].cpu())
+                    shared_step_data[k][_k][:, :s1].index_copy_(0, data_indexes, _v.cpu())
                 elif len(_v.shape) == 1:
-                    shared_step_data[k][_k].index_copy_(0, data_indexes, _v[data_indexes].cpu())
+                    shared_step_data[k][_k].index_copy_(0, data_indexes, _v.cpu())
         elif isinstance(v, torch.Tensor):
-            shared_step_data[k].index_copy_(0, data_indexes, v[data_indexes].cpu())
+            shared_step_data[k].index_copy_(0, data_indexes, v.cpu())
 
 
 class Agent:
@@ -99,6 +126,9 @@ class Agent:
         self._job_type = cfg.actor.job_type
         self._only_cum_action_kl = self._whole_cfg.get('learner', {}).get('only_cum_action_kl',False)
         self._z_path = self._whole_cfg.agent.z_path
+        # Z file is loaded once per process, env processes forked after this share it
+        if os.path.exists(os.path.join(os.path.dirname(__file__), 'lib', self._z_path)):
+            load_z_library(self._z_path)
         self._bo_norm = self._whole_cfg.get('learner', {}).get('bo_norm',20)
         self._cum_norm = self._whole_cfg.get('learner', {}).get('cum_norm',30)
         self._battle_norm = self._whole_cfg.get('learner', {}).get('battle_norm',30)
@@ -116,6 +146,41 @@ class Agent:
         self._cum_type = self._whole_cfg.agent.get('cum_type', 'action')  # observation or action
         self._env_id = env_id
         self._gpu_batch_inference = self._whole_cfg.actor.get('gpu_batch_inference', False)
+        self._cpu_batch_inference = self._whole_cfg.actor.get('cpu_batch_inference', False)
+        self._batch_inference = self._gpu_batch_inference or self._cpu_batch_inference
+        # run teacher once per trajectory instead of once per step, batch inference keeps the per step teacher forward
+        self._teacher_sequence_forward = self._whole_cfg.actor.get('teacher_sequence_forward', False) \
+                                         and not self._batch_inference
+        # quantized copies only run on cpu, they are rebuilt when model.version changes
+        self._quantized_inference = self._whole_cfg.actor.get('quantized_inference', False) \
+                                    and not self._whole_cfg.actor.use_cuda and not self._gpu_batch_inference
+        self._quantized_conv_bf16 = self._whole_cfg.actor.get('quantized_conv_bf16', False)
+        self._compiled_inference = self._whole_cfg.actor.get('compiled_inference', False)
+        self._compiled_inference_backend = self._whole_cfg.actor.get('compiled_inference_backend', 'inductor')
+        if self._compiled_inference and self._quantized_inference:
+            # the quantized copy is rebuilt after every model update, compiling it each time costs more than it saves
+            print('[WARNING] compiled_inference is ignored with quantized_inference')
+            self._compiled_inference = False
+        if self._compiled_inference and self._compiled_inference_backend == 'inductor':
+            enable_fallback_random()
+        self._inference_models = {}
+        # batched entity_info is cut to the smallest bucket holding the max entity_num of the batch
+        self._entity_num_buckets = sorted(self._whole_cfg.actor.get('batch_inference_entity_num_buckets',
+                                                                    [64, 128, 256, 384, MAX_ENTITY_NUM]))
+        # spatial layers sent once per trajectory when they do not change in it
+        self._static_spatial_layers = self._whole_cfg.actor.get('static_spatial_layers', ['height_map'])
+        # entity_info sent as difference from previous step, entities are aligned by tag
+        self._entity_delta_encoding = self._whole_cfg.actor.get('entity_delta_encoding', False)
+        # trajectories are also saved here before entity delta encoding, for benchmark_entity_delta
+        self._trajectory_dump_dir = self._whole_cfg.actor.get('trajectory_dump_dir', '')
+        # at most this many trajectories are saved by every agent, so long runs do not fill the disk
+        self._trajectory_dump_num = self._whole_cfg.actor.get('trajectory_dump_num', 100)
+        self._trajectory_dump_count = 0
+        # teacher logits sent in fp16, location head as top-k logits with log-sum-exp of the others
+        self._compact_teacher_logit = self._whole_cfg.actor.get('compact_teacher_logit', False)
+        self._compact_teacher_logit_topk = self._whole_cfg.actor.get('compact_teacher_logit_topk', 64)
+        # 0/1 fields bit packed and integer fields downcast in sent trajectories
+        self._pack_trajectory = self._whole_cfg.actor.get('pack_trajectory', False)
         self.z_idx = None
         if self._whole_cfg.env.realtime:
             data = fake_step_data(share_memory=True, batch_size=1, hidden_size=self._hidden_size,
@@ -125,13 +190,19 @@ class Agent:
                 self.model = self.model.cuda()
             with torch.no_grad():
                 _ = self.model.compute_logp_action(**data)
-        if self._gpu_batch_inference:
-            batch_size = self._whole_cfg.actor.env_num
+        if self._batch_inference:
+            # each pipelined env owns its own slot
+            batch_size = self._whole_cfg.actor.env_num * self._whole_cfg.actor.get('pipeline_env_num', 1)
             self._shared_input = fake_step_data(share_memory=True, batch_size=batch_size, hidden_size=self._hidden_size,
                                                hidden_layer=self._num_layers, train=False)
             self._shared_output = fake_model_output(batch_size=batch_size, hidden_size=self._hidden_size,
                                              hidden_layer=self._num_layers, teacher=False)
             self._signals = torch.zeros(batch_size).share_memory_()
+            # env process wakes the inference loop by inference_request and waits on its own slot for output,
+            # actor replaces inference_request with one shared by all agents
+            self.inference_request = mp.Semaphore(0)
+            self._responses = [mp.Semaphore(0) for _ in range(batch_size)]
+            self.handoff_latency = LatencyHistogram('handoff_latency', rows=batch_size)
             if 'train' in self._job_type:
                 self._teacher_shared_input = fake_step_data(share_memory=True, batch_size=batch_size,
                                                            hidden_size=self._hidden_size,
@@ -139,6 +210,8 @@ class Agent:
                 self._teacher_shared_output = fake_model_output(batch_size=batch_size, hidden_size=self._hidden_size,
                                                  hidden_layer=self._num_layers, teacher=True)
                 self._teacher_signals = torch.zeros(batch_size).share_memory_()
+                self._teacher_responses = [mp.Semaphore(0) for _ in range(batch_size)]
+                self.teacher_handoff_latency = LatencyHistogram('teacher_handoff_latency', rows=batch_size)
         if 'train' in self._job_type:
             self.teacher_model = Model(cfg)
 
@@ -170,7 +243,10 @@ class Agent:
         if 'train' in self._job_type:
             self._hidden_state_backup = [(torch.zeros(self._hidden_size), torch.zeros(self._hidden_size)) for _ in range(self._num_layers)]
             self._teacher_hidden_state = [(torch.zeros(self._hidden_size), torch.zeros(self._hidden_size)) for _ in range(self._num_layers)]
-            self._data_buffer = deque(maxlen=self._whole_cfg.actor.traj_len)
+            if not hasattr(self, '_traj_buffer'):
+                self._traj_buffer = TrajectoryBuffer(self._whole_cfg.actor.traj_len)
+            self._traj_buffer.reset()
+            self._teacher_pending_steps = []
             self._push_count = 0
 
         # init Z
@@ -185,10 +261,7 @@ class Agent:
         born_location[0] = int(born_location[0])
         born_location[1] = int(self._feature.map_size.y - born_location[1])
         born_location_str = str(born_location[0] + born_location[1] * 160)
-        self._z_path = os.path.join(os.path.dirname(__file__), 'lib', self._z_path)
-        with open(self._z_path, 'r') as f:
-            self._z_data = json.load(f)
-            z_data = self._z_data
+        z_library = load_z_library(self._z_path)
         z_type = None
         idx = None
         raw_ob = obs['raw_obs']
@@ -201,9 +274,9 @@ class Agent:
             mix_race = race + opponent_race
         if self.z_idx is not None:
             idx, z_type = random.choice(self.z_idx[self._map_name][mix_race][born_location_str])
-            z = z_data[self._map_name][mix_race][born_location_str][idx]
+            z = z_library.get(self._map_name, mix_race, born_location_str, idx)
         else:
-            z = random.choice(z_data[self._map_name][mix_race][born_location_str])
+            z = z_library.sample(self._map_name, mix_race, born_location_str)
         if len(z) == 5:
             self._target_building_order, target_cumulative_stat, bo_location, self._target_z_loop, z_type = z
         else:
@@ -255,7 +328,10 @@ class Agent:
 
 
     def _pre_process(self, obs):
-        if self._use_value_feature:
+        if 'agent_obs' in obs:
+            # already transformed by a VectorSC2Env worker, views of its shared memory batch
+            agent_obs = dict(obs['agent_obs'])
+        elif self._use_value_feature:
             agent_obs = self._feature.transform_obs(obs['raw_obs'], padding_spatial=True, opponent_obs=obs['opponent_obs'])
         else:
             agent_obs = self._feature.transform_obs(obs['raw_obs'], padding_spatial=True)
@@ -267,14 +343,14 @@ class Agent:
 
         last_selected_units = torch.zeros(agent_obs['entity_num'], dtype=torch.int8)
         last_targeted_unit = torch.zeros(agent_obs['entity_num'], dtype=torch.int8)
-        tags = self._game_info['tags']
+        tag_index = self._game_info['tag_index']
         if self._last_selected_unit_tags is not None:
             for t in self._last_selected_unit_tags:
-                if t in tags:
-                    last_selected_units[tags.index(t)] = 1
+                if t in tag_index:
+                    last_selected_units[tag_index[t]] = 1
         if self._last_target_unit_tag is not None:
-            if self._last_target_unit_tag in tags:
-                last_targeted_unit[tags.index(self._last_target_unit_tag)] = 1
+            if self._last_target_unit_tag in tag_index:
+                last_targeted_unit[tag_index[self._last_target_unit_tag]] = 1
         agent_obs['entity_info']['last_selected_units'] = last_selected_units
         agent_obs['entity_info']['last_targeted_unit'] = last_targeted_unit
 
@@ -295,10 +371,9 @@ class Agent:
         self._observation = agent_obs
         if self._whole_cfg.actor.use_cuda:
             agent_obs = to_device(agent_obs, 'cuda:0')
-        if self._gpu_batch_inference:
-            copy_input_data(self._shared_input, agent_obs, data_idx=self._env_id)
-            self._signals[self._env_id] += 1
-            model_input = None
+        if self._batch_inference:
+            # copied to shared memory in step, the batch inference loop collates it with other env processes
+            model_input = agent_obs
         else:
             model_input = default_collate([agent_obs])
         return model_input
@@ -308,15 +383,19 @@ class Agent:
             self._update_fake_reward(self._last_action_type, self._last_location, observation)
         model_input = self._pre_process(observation)
         self._stat_api.update(self._last_action_type, observation['action_result'][0], self._observation, self._game_step)
-        if not self._gpu_batch_inference:
-            model_output = self.model.compute_logp_action(**model_input)
+        if not self._batch_inference:
+            # model is shared by agents of pipelined envs, which may play different races
+            model = self._inference_model()
+            model.policy.action_type_head.race = self._race
+            model_output = model.compute_logp_action(**model_input)
         else:
-            while True:
-                if self._signals[self._env_id] == 0:
-                    model_output = self._shared_output
-                    break
-                else:
-                    time.sleep(0.01)
+            copy_input_data(self._shared_input, model_input, data_idx=self._env_id)
+            self._signals[self._env_id] = 1
+            request_time = time.time()
+            self.inference_request.release()
+            self._responses[self._env_id].acquire()
+            self.handoff_latency.update(time.time() - request_time, row=self._env_id)
+            model_output = self._shared_output
         action = self._post_process(model_output)
         self._iter_count += 1
         return action
@@ -345,7 +424,7 @@ class Agent:
             return data
 
     def _post_process(self, output):
-        if self._gpu_batch_inference:
+        if self._batch_inference:
             output = self.decollate_output(output, batch_idx=self._env_id)
         else:
             output = self.decollate_output(output)
@@ -472,15 +551,7 @@ class Agent:
         data.update(cum_out)
         return data
 
-    def collect_data(self, next_obs, reward, done,idx):
-        action_result = False if next_obs is None else ('Success' in next_obs['action_result'])
-        if action_result:
-            self._success_iter_count += 1
-
-        behavior_z = self.get_behavior_z()
-        bo_reward, cum_reward, battle_reward = self.update_fake_reward(next_obs)
-        agent_obs = self._observation
-        # teacher model forward
+    def _teacher_step_forward(self, agent_obs):
         teacher_obs = {'spatial_info': agent_obs['spatial_info'], 'entity_info': agent_obs['entity_info'],
                        'scalar_info': agent_obs['scalar_info'],
                        'entity_num': agent_obs['entity_num'], 'hidden_state': self._teacher_hidden_state,
@@ -488,21 +559,57 @@ class Agent:
                        'action_info': self._output['action_info']}
         if self._whole_cfg.actor.use_cuda:
             teacher_obs = to_device(teacher_obs, 'cuda:0')
-        if self._gpu_batch_inference:
+        if self._batch_inference:
             copy_input_data(self._teacher_shared_input, teacher_obs, data_idx=self._env_id)
-            self._teacher_signals[self._env_id] += 1
-            while True:
-                if self._teacher_signals[self._env_id] == 0:
-                    teacher_output = self._teacher_shared_output
-                    teacher_output = self.decollate_output(teacher_output, batch_idx=self._env_id)
-                    break
-                else:
-                    time.sleep(0.01)
+            self._teacher_signals[self._env_id] = 1
+            request_time = time.time()
+            self.inference_request.release()
+            self._teacher_responses[self._env_id].acquire()
+            self.teacher_handoff_latency.update(time.time() - request_time, row=self._env_id)
+            teacher_output = self.decollate_output(self._teacher_shared_output, batch_idx=self._env_id)
         else:
             teacher_model_input = default_collate([teacher_obs])
-            teacher_output = self.teacher_model.compute_teacher_logit(**teacher_model_input)
+            teacher_output = self._inference_model(teacher=True).compute_teacher_logit(**teacher_model_input)
             teacher_output = self.decollate_output(teacher_output)
         self._teacher_hidden_state = teacher_output['hidden_state']
+        return teacher_output
+
+    def _teacher_sequence_forward_pending(self):
+        # fill teacher_logit of steps collected since last call with one forward over the whole sequence
+        slots = self._teacher_pending_steps
+        if len(slots) == 0:
+            return
+        teacher_model_input = self._traj_buffer.gather(slots, keys=['spatial_info', 'entity_info', 'scalar_info',
+                                                                    'entity_num', 'selected_units_num', 'action_info'])
+        teacher_model_input['hidden_state'] = [(h.unsqueeze(dim=0), c.unsqueeze(dim=0)) for h, c in self._teacher_hidden_state]
+        if self._whole_cfg.actor.use_cuda:
+            teacher_model_input = to_device(teacher_model_input, 'cuda:0')
+        teacher_output = self._inference_model(teacher=True).compute_teacher_logit_sequence(**teacher_model_input)
+        self._teacher_hidden_state = [(h.squeeze(dim=0), c.squeeze(dim=0)) for h, c in teacher_output['hidden_state']]
+        for idx, slot in enumerate(slots):
+            entity_num = teacher_model_input['entity_num'][idx].item()
+            selected_units_num = teacher_model_input['selected_units_num'][idx].item()
+            logit = {k: v[idx].cpu() for k, v in teacher_output['logit'].items()}
+            logit['selected_units'] = logit['selected_units'][:selected_units_num, :entity_num + 1]
+            logit['target_unit'] = logit['target_unit'][:entity_num]
+            if self._compact_teacher_logit:
+                logit = compact_logit(logit, self._compact_teacher_logit_topk)
+            self._traj_buffer.update(slot, {'teacher_logit': logit})
+        self._teacher_pending_steps = []
+
+    def collect_data(self, next_obs, reward, done,idx):
+        action_result = False if next_obs is None else ('Success' in next_obs['action_result'])
+        if action_result:
+            self._success_iter_count += 1
+
+        behavior_z = self.get_behavior_z()
+        bo_reward, cum_reward, battle_reward = self.update_fake_reward(next_obs)
+        agent_obs = self._observation
+        # teacher model forward
+        if self._teacher_sequence_forward:
+            teacher_output = {'logit': None}
+        else:
+            teacher_output = self._teacher_step_forward(agent_obs)
         # successive model forward
         if self._whole_cfg.learner.use_dapo:
             successive_obs = deepcopy(self._observation)
@@ -514,11 +621,10 @@ class Agent:
             successive_output = self.decollate_output(successive_output)
             self._successive_hidden_state = successive_output['hidden_state']
 
-        # gather step data
-        action_info = deepcopy(self._output['action_info'])
+        # gather step data, copied into trajectory buffer
+        action_info = self._output['action_info']
         mask = dict()
-        mask['actions_mask'] = copy.deepcopy(
-            {k: val for k, val in ACTIONS[action_info['action_type'].item()].items() if k not in ['name', 'goal','func_id','general_ability_id', 'game_id']})
+        mask['actions_mask'] = ACTIONS_MASK[action_info['action_type'].item()]
         if self._only_cum_action_kl:
             mask['cum_action_mask'] = torch.tensor(0.0,dtype=torch.float)
         else:
@@ -533,8 +639,8 @@ class Agent:
         else:
             mask['built_unit_mask'] = torch.tensor(0.0,dtype=torch.float)
         selected_units_num = self._output['selected_units_num']
-        for k, v in mask['actions_mask'].items():
-            mask['actions_mask'][k] = torch.tensor(v, dtype=torch.long)
+        if self._compact_teacher_logit and teacher_output['logit'] is not None:
+            teacher_output['logit'] = compact_logit(teacher_output['logit'], self._compact_teacher_logit_topk)
         step_data = {
             'map_name': self._map_name,
             'spatial_info': agent_obs['spatial_info'],
@@ -564,11 +670,17 @@ class Agent:
             step_data['value_feature'].update(behavior_z)
         if self._whole_cfg.learner.use_dapo:
             step_data['successive_logit'] = successive_output['logit']
+        if self._entity_delta_encoding or self._trajectory_dump_dir:
+            step_data['entity_tag'] = torch.as_tensor(self._game_info['tags'], dtype=torch.long)
         self._hidden_state_backup = self._hidden_state
 
         # push data
-        self._data_buffer.append(step_data)
+        slot = self._traj_buffer.append(step_data)
         self._push_count += 1
+        if self._teacher_sequence_forward:
+            self._teacher_pending_steps.append(slot)
+            if len(self._teacher_pending_steps) >= self._whole_cfg.actor.traj_len or done:
+                self._teacher_sequence_forward_pending()
         if self._push_count == self._whole_cfg.actor.traj_len or done:
             if not done:
                 # can not obtain next observation in environment when done is true, use last step data instead,
@@ -576,33 +688,40 @@ class Agent:
                 if not next_obs['raw_obs'].observation:
                     return None
                 self._pre_process(next_obs)
-                agent_obs = deepcopy(self._observation)
-                last_step_data = {
-                    'map_name': self._map_name,
-                    'spatial_info': agent_obs['spatial_info'],
-                    # 'spatial_info_ref':spatial_info_ref,
-                    'entity_info': agent_obs['entity_info'],
-                    'scalar_info': agent_obs['scalar_info'],
-                    'entity_num': agent_obs['entity_num'],
-                    'hidden_state': self._hidden_state,
-                }
-            else:
-                last_step_data = deepcopy({
-                    'map_name': self._map_name,
-                    'spatial_info': agent_obs['spatial_info'],
-                    # 'spatial_info_ref':spatial_info_ref,
-                    'entity_info': agent_obs['entity_info'],
-                    'scalar_info': agent_obs['scalar_info'],
-                    'entity_num': agent_obs['entity_num'],
-                    'hidden_state': self._hidden_state,
-                })
+                agent_obs = self._observation
+            last_step_data = {
+                'map_name': self._map_name,
+                'spatial_info': agent_obs['spatial_info'],
+                # 'spatial_info_ref':spatial_info_ref,
+                'entity_info': agent_obs['entity_info'],
+                'scalar_info': agent_obs['scalar_info'],
+                'entity_num': agent_obs['entity_num'],
+                'hidden_state': self._hidden_state,
+            }
             if self._use_value_feature:
-                last_step_data['value_feature'] = agent_obs['value_feature']
-                last_step_data['value_feature'].update(self.get_behavior_z())
-            list_data = list(self._data_buffer)
-            list_data.append(last_step_data)
+                last_step_data['value_feature'] = dict(agent_obs['value_feature'], **self.get_behavior_z())
+            if self._entity_delta_encoding or self._trajectory_dump_dir:
+                last_step_data['entity_tag'] = torch.as_tensor(self._game_info['tags'], dtype=torch.long)
             self._push_count = 0
-            return list_data
+            trajectory = self._traj_buffer.get_trajectory(last_step_data)
+            intern_static_layers(trajectory, self._static_spatial_layers)
+            trajectory['compact_teacher_logit'] = self._compact_teacher_logit
+            if self._trajectory_dump_dir:
+                os.makedirs(self._trajectory_dump_dir, exist_ok=True)
+                torch.save(trajectory, os.path.join(self._trajectory_dump_dir,
+                                                    '{}_{}.pt'.format(self.player_id, time.time())))
+                self._trajectory_dump_count += 1
+                if self._trajectory_dump_count >= self._trajectory_dump_num:
+                    print('{} trajectories of {} saved in {}, stop saving'.format(
+                        self._trajectory_dump_count, self.player_id, self._trajectory_dump_dir), flush=True)
+                    self._trajectory_dump_dir = ''
+            if self._entity_delta_encoding:
+                encode_entity_delta(trajectory)
+            else:
+                trajectory['data'].pop('entity_tag', None)
+            if self._pack_trajectory:
+                pack_trajectory(trajectory)
+            return trajectory
         else:
             return None
     
@@ -712,31 +831,56 @@ class Agent:
         self._total_cum_reward += cum_reward
         return bo_reward, cum_reward, battle_reward
 
-    def gpu_batch_inference(self, teacher=False):
+    def _inference_model(self, teacher=False):
+        model = self.teacher_model if teacher else self.model
+        if not self._quantized_inference and not self._compiled_inference:
+            return model
+        # read version before quantizing, parameters loaded meanwhile bump it again and trigger another rebuild,
+        # compiled graphs of the fp32 model read parameters updated in place and are kept
+        version = model.version.item()
+        if teacher not in self._inference_models or \
+                (self._quantized_inference and self._inference_models[teacher][0] != version):
+            if self._quantized_inference:
+                model = quantize_model(model, conv_bf16=self._quantized_conv_bf16)
+            if self._compiled_inference:
+                model = CompiledModel(model, backend=self._compiled_inference_backend)
+            self._inference_models[teacher] = (version, model)
+        return self._inference_models[teacher][1]
+
+    def pending_inference_num(self, teacher=False):
+        signals = self._teacher_signals if teacher else self._signals
+        return int(signals.sum().item())
+
+    def batch_inference(self, teacher=False, device='cpu', max_batch_size=None):
         if not teacher:
-            inference_indexes = self._signals.clone().bool()
-            batch_num = inference_indexes.sum()
-            if batch_num > 0:
-                #print(self.player_id, 'batch num:', batch_num, inference_indexes)
-                pass
-            else:
-                return
-            model_input = to_device(self._shared_input, torch.cuda.current_device())
-            model_output = self.model.compute_logp_action(**model_input)
-            copy_output_data(self._shared_output, model_output, inference_indexes)
-            self._signals[inference_indexes] *= 0
+            signals, shared_input, shared_output = self._signals, self._shared_input, self._shared_output
+            responses = self._responses
         else:
-            inference_indexes = self._teacher_signals.clone().bool()
-            batch_num = inference_indexes.sum()
-            if batch_num > 0:
-                #print(self.player_id, 'teacher batch num:', batch_num)
-                pass
-            else:
-                return
-            model_input = to_device(self._teacher_shared_input, torch.cuda.current_device())
-            model_output = self.teacher_model.compute_teacher_logit(**model_input)
-            copy_output_data(self._teacher_shared_output, model_output, inference_indexes)
-            self._teacher_signals[inference_indexes] *= 0
+            signals, shared_input, shared_output = self._teacher_signals, self._teacher_shared_input, \
+                                                   self._teacher_shared_output
+            responses = self._teacher_responses
+        inference_indexes = signals.nonzero().squeeze(dim=1)
+        batch_num = len(inference_indexes)
+        if batch_num == 0:
+            return 0
+        if max_batch_size is not None and batch_num > max_batch_size:
+            inference_indexes = inference_indexes[:max_batch_size]
+            batch_num = max_batch_size
+        max_entity_num = shared_input['entity_num'].index_select(0, inference_indexes).max().item()
+        bucket = next((b for b in self._entity_num_buckets if b >= max_entity_num), MAX_ENTITY_NUM)
+        model_input = to_device(select_input_data(shared_input, inference_indexes, max_entity_num=bucket), device)
+        if not teacher:
+            model_output = self._inference_model().compute_logp_action(**model_input)
+        else:
+            model_output = self._inference_model(teacher=True).compute_teacher_logit(**model_input)
+        copy_output_data(shared_output, model_output, inference_indexes)
+        signals[inference_indexes] = 0
+        for idx in inference_indexes.tolist():
+            responses[idx].release()
+        return batch_num
+
+    def gpu_batch_inference(self, teacher=False):
+        return self.batch_inference(teacher=teacher, device=torch.cuda.current_device())
 
     @staticmethod
     def _get_time_factor(game_step):
@@ -405,6 +405,14 @@ for idx, a in enumerate(ACTIONS):
     if a['selected_units']:
         SELECTED_UNITS_MASK[idx] = 1
 
+TARGET_UNIT_MASK = torch.zeros(len(ACTIONS), dtype=torch.bool)
+TARGET_LOCATION_MASK = torch.zeros(len(ACTIONS), dtype=torch.bool)
+for idx, a in enumerate(ACTIONS):
+    if a['target_unit']:
+        TARGET_UNIT_MASK[idx] = 1
+    if a['target_location']:
+        TARGET_LOCATION_MASK[idx] = 1
+
 UNIT_BUILD_ACTIONS = [a['func_id'] for a in ACTIONS if a['goal'] == 'build']
 UNIT_TRAIN_ACTIONS = [a['func_id'] for a in ACTIONS if a['goal'] == 'unit']
 
@@ -0,0 +1,54 @@
+import math
+
+import torch
+
+from .features import SPATIAL_SIZE
+
+# heads stored as top-k logits and the log-sum-exp of the other logits, they have no masked entries
+TOPK_HEADS = ['target_location']
+LOCATION_NUM = SPATIAL_SIZE[0] * SPATIAL_SIZE[1]
+
+
+def compact_logit(logit, topk=64):
+    r"""
+    Overview:
+        compact teacher logits of one step (or a batch of steps) for transport, logits are stored in fp16 and heads
+        in TOPK_HEADS only keep top-k logits with the log-sum-exp of the others
+    Arguments:
+        - logit (:obj:`dict`): head name -> logit tensor
+        - topk (:obj:`int`): number of logits kept for heads in TOPK_HEADS
+    Returns:
+        - logit (:obj:`dict`): compact logits, heads in TOPK_HEADS are dicts of 'value', 'index' and 'remainder'
+    """
+    ret = {}
+    for k, v in logit.items():
+        if k in TOPK_HEADS:
+            v = v.float()
+            value, index = v.topk(topk, dim=-1)
+            remainder = torch.logsumexp(v.scatter(-1, index, float('-inf')), dim=-1)
+            ret[k] = {'value': value.half(), 'index': index.short(), 'remainder': remainder}
+        else:
+            ret[k] = v.half()
+    return ret
+
+
+def expand_logit(logit):
+    r"""
+    Overview:
+        rebuild float32 logits from compact_logit, the probability left out of top-k is spread evenly over the other
+        entries, masked logits (-inf in fp16) are set back to -1e9
+    Arguments:
+        - logit (:obj:`dict`): output of compact_logit, with any leading dims
+    Returns:
+        - logit (:obj:`dict`): head name -> float32 logit tensor
+    """
+    ret = {}
+    for k, v in logit.items():
+        if isinstance(v, dict):
+            value, index = v['value'].float(), v['index'].long()
+            rest = v['remainder'].float() - math.log(LOCATION_NUM - value.shape[-1])
+            full = rest.unsqueeze(dim=-1).repeat(*([1] * rest.dim()), LOCATION_NUM)
+            ret[k] = full.scatter(-1, index, value).clamp(min=-1e9)
+        else:
+            ret[k] = v.float().clamp(min=-1e9)
+    return ret
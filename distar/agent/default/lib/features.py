@@ -54,6 +54,13 @@ SCALAR_INFO = [('home_race', uint8, ()), ('away_race', uint8, ()), ('upgrades',
                ('unit_order_type', uint8, (NUM_UNIT_MIX_ABILITIES,)), ('unit_type_bool', uint8, (NUM_UNIT_TYPES,)),
                ('enemy_unit_type_bool', uint8, (NUM_UNIT_TYPES,))]
 
+# FeatureUnit fields with the same name in unit proto, read directly by Features._entity_columns
+UNIT_PROTO_FIELDS = ['unit_type', 'alliance', 'cargo_space_taken', 'build_progress', 'health_max', 'shield_max',
+                     'energy_max', 'display_type', 'owner', 'cloak', 'is_blip', 'is_powered', 'mineral_contents',
+                     'vespene_contents', 'cargo_space_max', 'assigned_harvesters', 'weapon_cooldown',
+                     'is_hallucination', 'is_active', 'attack_upgrade_level', 'armor_upgrade_level',
+                     'shield_upgrade_level', 'health', 'shield', 'energy']
+
 ENTITY_INFO = [('unit_type', int16), ('alliance', uint8), ('cargo_space_taken', uint8),
                ('build_progress', float16), ('health_ratio', float16), ('shield_ratio', float16),
                ('energy_ratio', float16), ('display_type', uint8), ('x', uint8), ('y', uint8),
@@ -66,6 +73,12 @@ ENTITY_INFO = [('unit_type', int16), ('alliance', uint8), ('cargo_space_taken',
                ('is_in_cargo', uint8), ('attack_upgrade_level', uint8), ('armor_upgrade_level', uint8),
                ('shield_upgrade_level', uint8), ('last_selected_units', int8), ('last_targeted_unit', int8)]
 
+# integer fields of the tables above holding 0/1 only, bit packed in sent trajectories
+BOOL_INFO = {'spatial_info': ['creep', 'pathable', 'buildable'],
+             'scalar_info': ['upgrades', 'cumulative_stat', 'unit_order_type', 'unit_type_bool',
+                             'enemy_unit_type_bool'],
+             'entity_info': ['is_blip', 'is_powered', 'is_hallucination', 'is_active', 'is_in_cargo']}
+
 ACTION_INFO = {'action_type': torch.tensor(0, dtype=torch.long), 'delay': torch.tensor(0, dtype=torch.long),
                'queued': torch.tensor(0, dtype=torch.long), 'selected_units': torch.zeros((MAX_SELECTED_UNITS_NUM,), dtype=torch.long),
                'target_unit': torch.tensor(0, dtype=torch.long),
@@ -351,6 +364,11 @@ MINIMAP_FEATURES = MinimapFeatures(
 )
 
 
+def build_tag_index(tags):
+    # index of the first occurrence of each tag, same as tags.index
+    return dict(zip(reversed(tags), range(len(tags) - 1, -1, -1)))
+
+
 def compute_battle_score(obs):
     if obs is None:
         return 0.
@@ -379,6 +397,8 @@ class Features(object):
         self._cumulative_stat_flag = random.random() < self._cfg.get('cumulative_stat_prob', 1.)
         self._zero_z_value = self._cfg.get('zero_z_value', 1.)
         self._filter_spine = self._cfg.get('filter_spine', True)
+        # entity info read field by field for all units instead of unit by unit
+        self._columnar_entity_info = self._cfg.get('columnar_entity_info', True)
         self._init_born_location(game_info, raw_ob)
 
     def _init_born_location(self, game_info, raw_ob):
@@ -459,40 +479,7 @@ class Features(object):
             cumulative_stat = 0 * cumulative_stat + self._zero_z_value
         return beginning_order, cumulative_stat, bo_len, bo_location
 
-    @sw.decorate
-    def transform_obs(self, obs, padding_spatial=False, opponent_obs=None):
-        spatial_info = defaultdict(list)
-        scalar_info = {}
-        entity_info = dict()
-        game_info = {}
-
-        raw = obs.observation.raw_data
-        # spatial info
-        for f in MINIMAP_FEATURES:
-            d = f.unpack(obs.observation).copy()
-            d = torch.from_numpy(d)
-            padding_y = SPATIAL_SIZE[0] - d.shape[0]
-            padding_x = SPATIAL_SIZE[1] - d.shape[1]
-            if (padding_y != 0 or padding_x != 0) and padding_spatial:
-                d = torch.nn.functional.pad(d, (0, padding_x, 0, padding_y), 'constant', 0)
-            spatial_info[f.name] = d
-        for e in raw.effects:
-            name = Effects(e.effect_id).name
-            if name in ['LiberatorDefenderZone', 'LurkerSpines'] and e.owner == 1:
-                continue
-            for p in e.pos:
-                location = int(p.x) + int(self.map_size.y - p.y) * SPATIAL_SIZE[1]
-                spatial_info['effect_' + name].append(location)
-        for k, _ in SPATIAL_INFO:
-            if 'effect' in k:
-                padding_num = EFFECT_LEN - len(spatial_info[k])
-                if padding_num > 0:
-                    spatial_info[k] += [0] * padding_num
-                else:
-                    spatial_info[k] = spatial_info[k][:EFFECT_LEN]
-                spatial_info[k] = torch.as_tensor(spatial_info[k], dtype=int16)
-
-        # entity info
+    def _entity_rows(self, raw):
         tag_types = {}  # Only populate the cache if it's needed.
         def get_addon_type(tag):
             if not tag_types:
@@ -590,46 +577,145 @@ class Features(object):
         units = units[:MAX_ENTITY_NUM]
         tags = tags[:MAX_ENTITY_NUM]
         raw_entity_info = named_array.NamedNumpyArray(units, [None, FeatureUnit], dtype=np.float32)
+        return tags, {f.name: raw_entity_info[:, f] for f in FeatureUnit}
+
+    def _entity_columns(self, raw):
+        # same values as _entity_rows, each field is read for all units at once into a float32 column
+        units = list(raw.units)
+        orders = [u.orders for u in units]
+        order_len = [len(o) for o in orders]
+        buff_ids = [u.buff_ids for u in units]
+        positions = [u.pos for u in units]
+        add_on_tags = [u.add_on_tag for u in units]
+        tag_types = {u.tag: u.unit_type for u in units} if any(add_on_tags) else {}
+        columns = {}
+        for name in UNIT_PROTO_FIELDS:
+            columns[name] = [getattr(u, name) for u in units]
+        columns['x'] = [p.x for p in positions]
+        columns['y'] = [p.y for p in positions]
+        columns['order_length'] = order_len
+        for i in range(4):
+            columns['order_id_{}'.format(i)] = [o[i].ability_id if l > i else 0 for o, l in zip(orders, order_len)]
+        for i in range(2):
+            columns['order_progress_{}'.format(i)] = [o[i].progress if l > i else 0 for o, l in zip(orders, order_len)]
+            columns['buff_id_{}'.format(i)] = [b[i] if len(b) > i else 0 for b in buff_ids]
+        columns['addon_unit_type'] = [tag_types.get(t, 0) if t else 0 for t in add_on_tags]
+        columns['is_in_cargo'] = [0] * len(units)
+        columns = {k: np.array(v, dtype=np.float32) for k, v in columns.items()}
+        tags = [u.tag for u in units]
+
+        carriers = [i for i, u in enumerate(units) if len(u.passengers) > 0]
+        if len(carriers) > 0:
+            passenger_num = np.zeros(len(units), dtype=np.int64)
+            passenger_columns = defaultdict(list)
+            for i in carriers:
+                u = units[i]
+                passenger_num[i] = len(u.passengers)
+                for v in u.passengers:
+                    for name in ['health_max', 'shield_max', 'energy_max', 'health', 'shield', 'energy']:
+                        passenger_columns[name].append(getattr(v, name))
+                    passenger_columns['unit_type'].append(v.unit_type)
+                    passenger_columns['alliance'].append(u.alliance)
+                    passenger_columns['owner'].append(u.owner)
+                    passenger_columns['x'].append(u.pos.x)
+                    passenger_columns['y'].append(u.pos.y)
+                    passenger_columns['is_in_cargo'].append(1)
+            # passengers follow their carrier
+            unit_rows = np.arange(len(units)) + np.cumsum(passenger_num) - passenger_num
+            passenger_rows = np.concatenate([unit_rows[i] + 1 + np.arange(passenger_num[i]) for i in carriers])
+            total = len(units) + len(passenger_rows)
+            for k, v in columns.items():
+                merged = np.zeros(total, dtype=np.float32)
+                merged[unit_rows] = v
+                if k in passenger_columns:
+                    merged[passenger_rows] = np.array(passenger_columns[k], dtype=np.float32)
+                columns[k] = merged
+            merged_tags = [0] * total
+            for i, t in zip(unit_rows.tolist(), tags):
+                merged_tags[i] = t
+            for i, t in zip(passenger_rows.tolist(), [v.tag for i in carriers for v in units[i].passengers]):
+                merged_tags[i] = t
+            tags = merged_tags
+        return tags[:MAX_ENTITY_NUM], {k: v[:MAX_ENTITY_NUM] for k, v in columns.items()}
+
+    @sw.decorate
+    def transform_obs(self, obs, padding_spatial=False, opponent_obs=None):
+        spatial_info = defaultdict(list)
+        scalar_info = {}
+        entity_info = dict()
+        game_info = {}
+
+        raw = obs.observation.raw_data
+        # spatial info
+        for f in MINIMAP_FEATURES:
+            d = f.unpack(obs.observation).copy()
+            d = torch.from_numpy(d)
+            padding_y = SPATIAL_SIZE[0] - d.shape[0]
+            padding_x = SPATIAL_SIZE[1] - d.shape[1]
+            if (padding_y != 0 or padding_x != 0) and padding_spatial:
+                d = torch.nn.functional.pad(d, (0, padding_x, 0, padding_y), 'constant', 0)
+            spatial_info[f.name] = d
+        for e in raw.effects:
+            name = Effects(e.effect_id).name
+            if name in ['LiberatorDefenderZone', 'LurkerSpines'] and e.owner == 1:
+                continue
+            for p in e.pos:
+                location = int(p.x) + int(self.map_size.y - p.y) * SPATIAL_SIZE[1]
+                spatial_info['effect_' + name].append(location)
+        for k, _ in SPATIAL_INFO:
+            if 'effect' in k:
+                padding_num = EFFECT_LEN - len(spatial_info[k])
+                if padding_num > 0:
+                    spatial_info[k] += [0] * padding_num
+                else:
+                    spatial_info[k] = spatial_info[k][:EFFECT_LEN]
+                spatial_info[k] = torch.as_tensor(spatial_info[k], dtype=int16)
+
+        # entity info
+        if self._columnar_entity_info:
+            tags, raw_entity_info = self._entity_columns(raw)
+        else:
+            tags, raw_entity_info = self._entity_rows(raw)
 
         for k, dtype in ENTITY_INFO:
             if 'last' in k:
                 pass
             elif k == 'unit_type':
-                entity_info[k] = UNIT_TYPES_REORDER_ARRAY[raw_entity_info[:, 'unit_type']].short()
+                entity_info[k] = UNIT_TYPES_REORDER_ARRAY[raw_entity_info['unit_type']].short()
             elif 'order_id' in k:
                 order_idx = int(k.split('_')[-1])
                 if order_idx == 0:
-                    entity_info[k] = UNIT_ABILITY_REORDER[raw_entity_info[:, k]].short()
+                    entity_info[k] = UNIT_ABILITY_REORDER[raw_entity_info[k]].short()
                     invalid_actions = entity_info[k] == -1
                     if invalid_actions.any():
-                       print('[ERROR] invalid unit ability', raw_entity_info[invalid_actions, k])
+                       print('[ERROR] invalid unit ability', raw_entity_info[k][invalid_actions.numpy()])
                 else:
-                    entity_info[k] = ABILITY_TO_QUEUE_ACTION[raw_entity_info[:, k]].short()
+                    entity_info[k] = ABILITY_TO_QUEUE_ACTION[raw_entity_info[k]].short()
                     invalid_actions = entity_info[k] == -1
                     if invalid_actions.any():
-                       print('[ERROR] invalid queue ability', raw_entity_info[invalid_actions, k])
+                       print('[ERROR] invalid queue ability', raw_entity_info[k][invalid_actions.numpy()])
             elif 'buff_id' in k:
-                entity_info[k] = BUFFS_REORDER_ARRAY[raw_entity_info[:, k]].short()
+                entity_info[k] = BUFFS_REORDER_ARRAY[raw_entity_info[k]].short()
             elif k == 'addon_unit_type':
-                entity_info[k] = ADDON_REORDER_ARRAY[raw_entity_info[:, k]].short()
+                entity_info[k] = ADDON_REORDER_ARRAY[raw_entity_info[k]].short()
             elif k == 'cargo_space_taken':
-                entity_info[k] = torch.as_tensor(raw_entity_info[:, 'cargo_space_taken'], dtype=dtype).clamp_(min=0, max=8)
+                entity_info[k] = torch.as_tensor(raw_entity_info['cargo_space_taken'], dtype=dtype).clamp_(min=0, max=8)
             elif k == 'cargo_space_max':
-                entity_info[k] = torch.as_tensor(raw_entity_info[:, 'cargo_space_max'], dtype=dtype).clamp_(min=0, max=8)
+                entity_info[k] = torch.as_tensor(raw_entity_info['cargo_space_max'], dtype=dtype).clamp_(min=0, max=8)
             elif k == 'health_ratio':
-                entity_info[k] = torch.as_tensor(raw_entity_info[:, 'health'], dtype=dtype) / (torch.as_tensor(raw_entity_info[:, 'health_max'], dtype=dtype) + 1e-6)
+                entity_info[k] = torch.as_tensor(raw_entity_info['health'], dtype=dtype) / (torch.as_tensor(raw_entity_info['health_max'], dtype=dtype) + 1e-6)
             elif k == 'shield_ratio':
-                entity_info[k] = torch.as_tensor(raw_entity_info[:, 'shield'], dtype=dtype) / (torch.as_tensor(raw_entity_info[:, 'shield_max'], dtype=dtype) + 1e-6)
+                entity_info[k] = torch.as_tensor(raw_entity_info['shield'], dtype=dtype) / (torch.as_tensor(raw_entity_info['shield_max'], dtype=dtype) + 1e-6)
             elif k == 'energy_ratio':
-                entity_info[k] = torch.as_tensor(raw_entity_info[:, 'energy'], dtype=dtype) / (torch.as_tensor(raw_entity_info[:, 'energy_max'], dtype=dtype) + 1e-6)
+                entity_info[k] = torch.as_tensor(raw_entity_info['energy'], dtype=dtype) / (torch.as_tensor(raw_entity_info['energy_max'], dtype=dtype) + 1e-6)
             elif k == 'mineral_contents':
-                entity_info[k] = torch.as_tensor(raw_entity_info[:, 'mineral_contents'], dtype=dtype) / 1800
+                entity_info[k] = torch.as_tensor(raw_entity_info['mineral_contents'], dtype=dtype) / 1800
             elif k == 'vespene_contents':
-                entity_info[k] = torch.as_tensor(raw_entity_info[:, 'vespene_contents'], dtype=dtype) / 2500
+                entity_info[k] = torch.as_tensor(raw_entity_info['vespene_contents'], dtype=dtype) / 2500
             elif k == 'y':
-                entity_info[k] = torch.as_tensor(self.map_size.y -  raw_entity_info[:, 'y'], dtype=dtype)
+                entity_info[k] = torch.as_tensor(self.map_size.y -  raw_entity_info['y'], dtype=dtype)
             else:
-                entity_info[k] = torch.as_tensor(raw_entity_info[:, k], dtype=dtype)
+                entity_info[k] = torch.as_tensor(raw_entity_info[k], dtype=dtype)
 
         # scalar info
         scalar_info['time'] = torch.tensor(obs.observation.game_loop, dtype=torch.float)
@@ -680,6 +766,7 @@ class Features(object):
         game_info['action_result'] = [o.result for o in obs.action_errors]
         game_info['game_loop'] = obs.observation.game_loop
         game_info['tags'] = tags
+        game_info['tag_index'] = build_tag_index(tags)
         game_info['battle_score'] = compute_battle_score(obs)
         game_info['opponent_battle_score'] = 0.
         ret = {
@@ -691,16 +778,12 @@ class Features(object):
         if opponent_obs:
             raw = opponent_obs.observation.raw_data
             enemy_unit_counts_bow = torch.zeros(NUM_UNIT_TYPES, dtype=torch.uint8)
-            enemy_x = []
-            enemy_y = []
-            enemy_unit_type = []
-            unit_alliance = []
-            for u in raw.units:
-                if u.alliance == 1:
-                    enemy_x.append(u.pos.x)
-                    enemy_y.append(u.pos.y)
-                    enemy_unit_type.append(u.unit_type)
-                    unit_alliance.append(1)
+            opponent_units = [u for u in raw.units if u.alliance == 1]
+            opponent_positions = [u.pos for u in opponent_units]
+            enemy_x = [p.x for p in opponent_positions]
+            enemy_y = [p.y for p in opponent_positions]
+            enemy_unit_type = [u.unit_type for u in opponent_units]
+            unit_alliance = [1] * len(opponent_units)
             enemy_unit_type = UNIT_TYPES_REORDER_ARRAY[enemy_unit_type].short()
             enemy_unit_counts_bow = torch.scatter_add(enemy_unit_counts_bow, dim=0, index=enemy_unit_type.long(),
                                                       src=torch.ones_like(enemy_unit_type, dtype=torch.uint8))
@@ -851,7 +934,9 @@ class Features(object):
         return sc2_action
 
     @sw.decorate
-    def reverse_raw_action(self, action, raw_tags):
+    def reverse_raw_action(self, action, raw_tags, raw_tag_index=None):
+        if raw_tag_index is None:
+            raw_tag_index = build_tag_index(raw_tags)
         action_ret = {'action_type': None, 'delay': torch.tensor(0, dtype=torch.long), 'queued': None, 'selected_units': None, 'target_unit': None, 'target_location': None}
         last_selected_unit_tags = None
         last_target_unit_tag = None
@@ -886,18 +971,17 @@ class Features(object):
             queue_command = uc.queue_command
             action_ret['queued'] = torch.tensor(queue_command, dtype=torch.long)
             for t in uc.unit_tags:
-                try:
-                    unit_index = raw_tags.index(t)
+                unit_index = raw_tag_index.get(t)
+                if unit_index is not None:
                     units.append(unit_index)
                     tags.append(t)
-                except ValueError:
-                    pass
 
             if uc.HasField("target_unit_tag"):
-                try:
-                    action_ret['target_unit'] = torch.tensor(raw_tags.index(uc.target_unit_tag), dtype=torch.long)
+                target_unit_index = raw_tag_index.get(uc.target_unit_tag)
+                if target_unit_index is not None:
+                    action_ret['target_unit'] = torch.tensor(target_unit_index, dtype=torch.long)
                     last_target_unit_tag = uc.target_unit_tag
-                except ValueError:
+                else:
                     invalid_action_flag = True
                 action_ret['action_type'] = transfer_action_type(ability_id, actions.raw_cmd_unit)
             elif uc.HasField("target_world_space_pos"):
@@ -914,12 +998,10 @@ class Features(object):
             ability_id = uc.ability_id
             action_ret['action_type'] = transfer_action_type(ability_id, actions.raw_autocast)
             for t in uc.unit_tags:
-                try:
-                    unit_index = raw_tags.index(t)
+                unit_index = raw_tag_index.get(t)
+                if unit_index is not None:
                     units.append(unit_index)
                     tags.append(t)
-                except ValueError:
-                    pass
 
         if action_ret['action_type'] is not None:
             action_ret['action_type'] = torch.tensor(action_ret['action_type'], dtype=torch.long)
@@ -0,0 +1,389 @@
+import hashlib
+import numbers
+
+import numpy as np
+import torch
+
+from .compact_logit import expand_logit
+from .features import MAX_ENTITY_NUM, MAX_SELECTED_UNITS_NUM, SPATIAL_INFO, SCALAR_INFO, ENTITY_INFO, BOOL_INFO, \
+    ACTION_INFO
+
+# leaves with variable length dims, stored padded to the max length and cut to the longest written one when gathered,
+# 'entity_end' is an entity dim with the end flag appended
+VARIABLE_DIMS = {
+    ('action_info', 'selected_units'): ('su', ),
+    ('behaviour_logp', 'selected_units'): ('su', ),
+    ('teacher_logit', 'selected_units'): ('su', 'entity_end'),
+    ('teacher_logit', 'target_unit'): ('entity', ),
+    ('successive_logit', 'selected_units'): ('su', 'entity_end'),
+    ('successive_logit', 'target_unit'): ('entity', ),
+}
+MAX_LEN = {'entity': MAX_ENTITY_NUM, 'entity_end': MAX_ENTITY_NUM + 1, 'su': MAX_SELECTED_UNITS_NUM}
+LOGIT_KEYS = ['behaviour_logp', 'teacher_logit', 'successive_logit']
+# integer dtypes tried in order when downcasting, with element size
+PACK_INT_DTYPES = [(torch.uint8, 1), (torch.int8, 1), (torch.int16, 2), (torch.int32, 4)]
+
+
+def _pack_schema():
+    # trajectory path -> 'bits' for 0/1 fields, 'int' for integer fields downcast to the smallest dtype holding them
+    schema = {('data', 'entity_num'): 'int', ('data', 'selected_units_num'): 'int',
+              ('entity_delta', 'changed'): 'bits', ('entity_delta', 'src'): 'int'}
+    for k in ACTION_INFO.keys():
+        schema[('data', 'action_info', k)] = 'int'
+    for key, table in [('spatial_info', SPATIAL_INFO), ('scalar_info', SCALAR_INFO), ('entity_info', ENTITY_INFO)]:
+        for field in table:
+            name, dtype = field[0], field[1]
+            if dtype.is_floating_point:
+                continue
+            kind = 'bits' if name in BOOL_INFO[key] else 'int'
+            schema[('data', key, name)] = kind
+            if key == 'entity_info':
+                schema[('entity_delta', 'values', name)] = kind
+    return schema
+
+
+PACK_SCHEMA = _pack_schema()
+
+
+def variable_dims(path):
+    if path[0] in ['entity_info', 'entity_tag']:
+        return ('entity', )
+    return VARIABLE_DIMS.get(path[:2])
+
+
+class TrajectoryBuffer(object):
+    r"""
+    Overview:
+        Ring buffer of traj_len + 1 step data slots. Each tensor leaf of step data is one preallocated tensor with
+        the slot as first dim, allocated the first time the leaf is written and reused afterwards. Step data is
+        copied in place, variable length leaves (entities, selected units) are padded to their max length.
+    Interface:
+        __init__, reset, append, update, gather, get_trajectory, step_count
+    """
+
+    def __init__(self, traj_len):
+        self._traj_len = traj_len
+        self._slot_num = traj_len + 1
+        self._leaves = {}
+        self._values = {}
+        self._containers = {}
+        self._lengths = {'entity': [0] * self._slot_num, 'su': [0] * self._slot_num}
+        self._step_count = 0
+
+    def reset(self):
+        self._step_count = 0
+
+    @property
+    def step_count(self):
+        return self._step_count
+
+    def append(self, step_data):
+        r"""
+        Overview:
+            write step data into the next slot
+        Returns:
+            - slot (:obj:`int`): slot of the step, valid until traj_len more steps are appended
+        """
+        slot = self._step_count % self._slot_num
+        self._write(slot, step_data, new_step=True)
+        self._step_count += 1
+        return slot
+
+    def update(self, slot, data):
+        self._write(slot, data)
+
+    def gather(self, slots, keys=None):
+        r"""
+        Overview:
+            copy slots into tensors with the slot as first dim, variable length dims are cut to the longest one
+        Arguments:
+            - slots (:obj:`list`): slots to gather
+            - keys (:obj:`list`): top level keys to gather, all keys if None
+        Returns:
+            - data (:obj:`dict`): step data with leading dim len(slots)
+        """
+        entity_len = max([self._lengths['entity'][s] for s in slots])
+        cut = {'entity': entity_len, 'entity_end': entity_len + 1, 'su': max([self._lengths['su'][s] for s in slots])}
+        index = torch.as_tensor(slots, dtype=torch.long)
+        flat = {}
+        for path, leaf in self._leaves.items():
+            if keys is not None and path[0] not in keys:
+                continue
+            dims = variable_dims(path)
+            if dims is not None:
+                leaf = leaf[(slice(None), ) + tuple([slice(0, cut[d]) for d in dims])]
+            flat[path] = leaf.index_select(0, index)
+        for path, v in self._values.items():
+            if keys is None or path[0] in keys:
+                flat[path] = v
+        return self._unflatten(flat)
+
+    def get_trajectory(self, last_step_data):
+        r"""
+        Overview:
+            write observation after the last step and gather the last traj_len steps with it
+        Arguments:
+            - last_step_data (:obj:`dict`): observation after the last step
+        Returns:
+            - trajectory (:obj:`dict`): 'data' with leading dim step_num + 1, 'step_num' and 'last_step_keys', \
+                split into step data list by unstack_trajectory
+        """
+        slot = self._step_count % self._slot_num
+        self._write(slot, last_step_data, new_step=True)
+        step_num = min(self._step_count, self._traj_len)
+        slots = [(self._step_count - step_num + i) % self._slot_num for i in range(step_num + 1)]
+        return {'data': self.gather(slots), 'step_num': step_num, 'last_step_keys': list(last_step_data.keys())}
+
+    def _write(self, slot, data, new_step=False):
+        if new_step:
+            for lengths in self._lengths.values():
+                lengths[slot] = 0
+        for path, v in self._flatten(data, ()):
+            if v is None:
+                continue
+            if isinstance(v, numbers.Number) and not isinstance(v, bool):
+                v = torch.as_tensor(v)
+            if not isinstance(v, torch.Tensor):
+                self._values[path] = v
+                continue
+            dims = variable_dims(path)
+            if path not in self._leaves:
+                shape = v.shape if dims is None else [MAX_LEN[d] for d in dims]
+                self._leaves[path] = torch.zeros(self._slot_num, *shape, dtype=v.dtype)
+            leaf = self._leaves[path]
+            if dims is None:
+                leaf[slot].copy_(v)
+                continue
+            leaf[slot].fill_(-1e9 if path[0] in LOGIT_KEYS else 0)
+            leaf[slot][tuple([slice(0, s) for s in v.shape])].copy_(v)
+            for d, s in zip(dims, v.shape):
+                kind, length = ('entity', s - 1) if d == 'entity_end' else (d, s)
+                self._lengths[kind][slot] = max(self._lengths[kind][slot], length)
+
+    def _flatten(self, data, prefix):
+        if isinstance(data, dict):
+            self._containers[prefix] = dict
+            for k, v in data.items():
+                yield from self._flatten(v, prefix + (k, ))
+        elif isinstance(data, (list, tuple)):
+            self._containers[prefix] = type(data)
+            for i, v in enumerate(data):
+                yield from self._flatten(v, prefix + (i, ))
+        else:
+            yield prefix, data
+
+    def _unflatten(self, flat):
+        ret = {}
+        for path, v in flat.items():
+            node = ret
+            for k in path[:-1]:
+                node = node.setdefault(k, {})
+            node[path[-1]] = v
+        return self._restore(ret, ())
+
+    def _restore(self, node, prefix):
+        if not isinstance(node, dict):
+            return node
+        node = {k: self._restore(v, prefix + (k, )) for k, v in node.items()}
+        container = self._containers.get(prefix, dict)
+        if container is dict:
+            return node
+        return container([node[i] for i in sorted(node.keys())])
+
+
+def intern_static_layers(trajectory, names):
+    r"""
+    Overview:
+        replace spatial layers which do not change within the trajectory by one frame and its content hash
+    Arguments:
+        - trajectory (:obj:`dict`): output of TrajectoryBuffer.get_trajectory, modified in place
+        - names (:obj:`list`): names of spatial layers to check, e.g. height_map
+    """
+    spatial_info = trajectory['data']['spatial_info']
+    static_spatial = {}
+    for name in names:
+        layer = spatial_info.get(name)
+        if layer is None or not (layer == layer[0]).all():
+            continue
+        static_spatial[name] = {'key': hashlib.sha1(layer[0].numpy().tobytes()).hexdigest(), 'layer': layer[0].clone()}
+        spatial_info.pop(name)
+    trajectory['static_spatial'] = static_spatial
+
+
+def encode_entity_delta(trajectory):
+    r"""
+    Overview:
+        replace entity_info of a trajectory by its difference from the previous step. Entities are aligned with the
+        previous step by tag (entity_tag, removed from data), an aligned entity only keeps the fields that changed,
+        entities of the first step and new entities keep all fields.
+    Arguments:
+        - trajectory (:obj:`dict`): output of TrajectoryBuffer.get_trajectory with entity_tag, modified in place
+    """
+    data = trajectory['data']
+    tags = data.pop('entity_tag')
+    entity_info = data.pop('entity_info')
+    entity_num = data['entity_num'].long()
+    entity_len = tags.shape[1]
+    valid = torch.arange(entity_len).unsqueeze(dim=0) < entity_num.unsqueeze(dim=1)
+    table = torch.stack([v[valid].float() for v in entity_info.values()], dim=1)
+    tags = tags[valid]
+    offsets = [0] + entity_num.cumsum(dim=0).tolist()
+    # row of the same entity in the previous step, -1 for new entities
+    src = torch.full((len(tags), ), -1, dtype=torch.long)
+    for t in range(1, len(entity_num)):
+        prev_tags, cur_tags = tags[offsets[t - 1]:offsets[t]], tags[offsets[t]:offsets[t + 1]]
+        if len(prev_tags) == 0 or len(cur_tags) == 0:
+            continue
+        sorted_tags, order = prev_tags.sort()
+        pos = torch.searchsorted(sorted_tags, cur_tags).clamp(max=len(prev_tags) - 1)
+        found = sorted_tags[pos] == cur_tags
+        src[offsets[t]:offsets[t + 1]][found] = order[pos[found]] + offsets[t - 1]
+    changed = (src < 0).unsqueeze(dim=1) | (table != table[src.clamp(min=0)])
+    values = {k: v[valid][changed[:, i]] for i, (k, v) in enumerate(entity_info.items())}
+    # row index inside the previous step fits int16
+    local_src = torch.where(src >= 0, src - _previous_step_offsets(offsets, entity_num), src)
+    trajectory['entity_delta'] = {'entity_len': entity_len, 'src': local_src.short(), 'changed': changed,
+                                  'values': values}
+
+
+def decode_entity_delta(entity_num, entity_delta):
+    r"""
+    Overview:
+        rebuild entity_info from the output of encode_entity_delta
+    Arguments:
+        - entity_num (:obj:`torch.Tensor`): entity_num of each step
+        - entity_delta (:obj:`dict`): entity_delta of the trajectory
+    Returns:
+        - entity_info (:obj:`dict`): entity_info with shape [step_num, entity_len]
+    """
+    entity_num = entity_num.long()
+    entity_len = int(entity_delta['entity_len'])
+    changed = entity_delta['changed'].bool()
+    values = entity_delta['values']
+    row_num = changed.shape[0]
+    offsets = [0] + entity_num.cumsum(dim=0).tolist()
+    rows = torch.arange(row_num)
+    src = entity_delta['src'].long()
+    src = torch.where(src >= 0, src + _previous_step_offsets(offsets, entity_num), rows)
+    # every field of a row points to the row it was last written in, resolved by pointer jumping over steps
+    pointer = torch.where(changed, rows.unsqueeze(dim=1), src.unsqueeze(dim=1))
+    for _ in range(max(len(entity_num) - 1, 1).bit_length()):
+        pointer = pointer.gather(0, pointer)
+    table = torch.zeros(changed.shape)
+    for i, v in enumerate(values.values()):
+        table[changed[:, i], i] = v.float()
+    table = table.gather(0, pointer)
+    valid = torch.arange(entity_len).unsqueeze(dim=0) < entity_num.unsqueeze(dim=1)
+    entity_info = {}
+    for i, (k, v) in enumerate(values.items()):
+        entity_info[k] = torch.zeros(valid.shape, dtype=v.dtype)
+        entity_info[k][valid] = table[:, i].to(v.dtype)
+    return entity_info
+
+
+def _previous_step_offsets(offsets, entity_num):
+    # first row of the previous step for every row, 0 for rows of the first step
+    prev_offsets = torch.as_tensor([0] + offsets[:-2], dtype=torch.long)
+    return prev_offsets.repeat_interleave(entity_num)
+
+
+def _pack_kind(path):
+    if path[:3] == ('data', 'mask', 'actions_mask'):
+        return 'bits'
+    return PACK_SCHEMA.get(path)
+
+
+def _dict_leaves(data, prefix):
+    for k, v in data.items():
+        if isinstance(v, dict):
+            yield from _dict_leaves(v, prefix + (k, ))
+        else:
+            yield prefix + (k, ), v
+
+
+def pack_trajectory(trajectory):
+    r"""
+    Overview:
+        move integer leaves of PACK_SCHEMA into trajectory['packed'], 0/1 fields are bit packed and other fields are
+        downcast to the smallest integer dtype holding their values. Leaves whose values do not allow it are kept.
+    Arguments:
+        - trajectory (:obj:`dict`): output of TrajectoryBuffer.get_trajectory, modified in place
+    """
+    packed = {}
+    for path, v in list(_dict_leaves(trajectory, ())):
+        kind = _pack_kind(path)
+        if kind is None or not isinstance(v, torch.Tensor) or v.is_floating_point() or v.numel() == 0:
+            continue
+        low, high = (0, 1) if v.dtype == torch.bool else (v.min().item(), v.max().item())
+        if kind == 'bits' and low >= 0 and high <= 1:
+            data = torch.from_numpy(np.packbits(v.reshape(-1).numpy().astype(bool)))
+        else:
+            dtype = [d for d, size in PACK_INT_DTYPES if size < v.element_size()
+                     and torch.iinfo(d).min <= low and high <= torch.iinfo(d).max]
+            if len(dtype) == 0:
+                continue
+            kind, data = 'int', v.to(dtype[0])
+        packed[path] = {'kind': kind, 'data': data, 'dtype': str(v.dtype).replace('torch.', ''),
+                        'shape': list(v.shape)}
+        node = trajectory
+        for k in path[:-1]:
+            node = node[k]
+        # keep the key so that dict order is restored
+        node[path[-1]] = None
+    trajectory['packed'] = packed
+
+
+def unpack_trajectory(trajectory):
+    r"""
+    Overview:
+        restore leaves moved by pack_trajectory with their original dtype and shape
+    Arguments:
+        - trajectory (:obj:`dict`): packed trajectory, modified in place
+    """
+    for path, v in trajectory.pop('packed', {}).items():
+        dtype = getattr(torch, v['dtype'])
+        shape = [] if v['shape'] is None else [int(s) for s in v['shape']]
+        if v['kind'] == 'bits':
+            bits = np.unpackbits(np.asarray(v['data'], dtype=np.uint8), count=int(np.prod(shape)))
+            value = torch.from_numpy(bits.reshape(shape)).to(dtype)
+        else:
+            value = v['data'].to(dtype)
+        node = trajectory
+        for k in path[:-1]:
+            node = node.setdefault(k, {})
+        node[path[-1]] = value
+
+
+def unstack_trajectory(trajectory, static_layer_cache=None):
+    r"""
+    Overview:
+        split the output of TrajectoryBuffer.get_trajectory into step data list, the last step only keeps
+        last_step_keys. Interned static layers are shared by all steps, one tensor per content hash is kept in
+        static_layer_cache. Packed leaves are restored and compact teacher logits are expanded back to float32.
+    """
+
+    def index(data, i):
+        if isinstance(data, torch.Tensor):
+            return data[i]
+        elif isinstance(data, dict):
+            return {k: index(v, i) for k, v in data.items()}
+        elif isinstance(data, (list, tuple)):
+            return [index(v, i) for v in data]
+        else:
+            return data
+
+    unpack_trajectory(trajectory)
+    step_num = int(trajectory['step_num'])
+    data = trajectory['data']
+    if 'entity_delta' in trajectory:
+        data['entity_info'] = decode_entity_delta(data['entity_num'], trajectory['entity_delta'])
+    if trajectory.get('compact_teacher_logit') and 'teacher_logit' in data:
+        data['teacher_logit'] = expand_logit(data['teacher_logit'])
+    for name, static_layer in trajectory.get('static_spatial', {}).items():
+        layer = static_layer['layer']
+        if static_layer_cache is not None:
+            layer = static_layer_cache.setdefault(static_layer['key'], layer)
+        data['spatial_info'][name] = layer.expand(step_num + 1, *layer.shape)
+    steps = [index(data, i) for i in range(step_num)]
+    steps.append(index({k: data[k] for k in trajectory['last_step_keys'] if k in data}, step_num))
+    return steps
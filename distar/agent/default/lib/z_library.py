@@ -0,0 +1,144 @@
+import json
+import os
+import random
+import struct
+
+import numpy as np
+
+Z_LIBRARY_MAGIC = b'DIZLIB01'
+# name -> dtype of arrays with one row per Z, variable length lists are padded with their length in <name>_len
+Z_ARRAYS = {'building_order': 'int16', 'cumulative_stat': 'int16', 'bo_location': 'int32', 'loop': 'int64',
+            'z_type': 'int8'}
+Z_LIST_ARRAYS = ['building_order', 'cumulative_stat', 'bo_location']
+ALIGNMENT = 64
+
+_LIBRARIES = {}
+
+
+def compile_z_library(z_data, path):
+    r"""
+    Overview:
+        write Z of the json format (map -> mix race -> born location -> list of Z) into a Z library file. Z of the
+        same key are stored in consecutive rows, the index maps each key to its first row and row number.
+    Arguments:
+        - z_data (:obj:`dict`): loaded Z json
+        - path (:obj:`str`): output file
+    Returns:
+        - num (:obj:`int`): number of Z written
+    """
+    index, rows = {}, []
+    for map_name, races in z_data.items():
+        for race, born_locations in races.items():
+            for born_location, zs in born_locations.items():
+                index[_key(map_name, race, born_location)] = [len(rows), len(zs)]
+                rows.extend(zs)
+    num = len(rows)
+    arrays = {}
+    for i, name in enumerate(Z_LIST_ARRAYS):
+        width = max([len(z[i]) for z in rows] + [1])
+        array = np.zeros((num, width), dtype=Z_ARRAYS[name])
+        length = np.zeros(num, dtype='int16')
+        for j, z in enumerate(rows):
+            array[j, :len(z[i])] = z[i]
+            length[j] = len(z[i])
+        arrays[name], arrays[name + '_len'] = array, length
+    arrays['loop'] = np.array([z[3] for z in rows], dtype=Z_ARRAYS['loop'])
+    arrays['z_type'] = np.array([z[4] if len(z) == 5 else -1 for z in rows], dtype=Z_ARRAYS['z_type'])
+
+    header = {'num': num, 'index': index, 'arrays': {}}
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = [array.dtype.str, list(array.shape), offset]
+        offset += (array.nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * (-(len(header) + 16) % ALIGNMENT)
+    with open(path, 'wb') as f:
+        f.write(Z_LIBRARY_MAGIC + struct.pack('<Q', len(header)) + header)
+        for array in arrays.values():
+            data = array.tobytes()
+            f.write(data + b'\0' * (-len(data) % ALIGNMENT))
+    return num
+
+
+def _key(map_name, race, born_location):
+    return '{}/{}/{}'.format(map_name, race, born_location)
+
+
+class ZLibrary(object):
+    r"""
+    Overview:
+        read only Z library file of compile_z_library. The file is memory mapped, forked processes share its pages.
+        Z are returned in the json format: [building_order, cumulative_stat, bo_location, loop(, z_type)].
+    Interface:
+        __init__, count, get, sample
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic = f.read(len(Z_LIBRARY_MAGIC))
+            assert magic == Z_LIBRARY_MAGIC, '{} is not a Z library file'.format(path)
+            header_len = struct.unpack('<Q', f.read(8))[0]
+            header = json.loads(f.read(header_len).decode('utf-8'))
+        self._index = {k: tuple(v) for k, v in header['index'].items()}
+        buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        data_offset = len(Z_LIBRARY_MAGIC) + 8 + header_len
+        self._arrays = {}
+        for name, (dtype, shape, offset) in header['arrays'].items():
+            dtype = np.dtype(dtype)
+            start = data_offset + offset
+            end = start + dtype.itemsize * int(np.prod(shape))
+            self._arrays[name] = buffer[start:end].view(dtype).reshape(shape)
+
+    def count(self, map_name, race, born_location):
+        return self._index.get(_key(map_name, race, born_location), (0, 0))[1]
+
+    def get(self, map_name, race, born_location, idx):
+        start, count = self._index[_key(map_name, race, born_location)]
+        assert 0 <= idx < count, 'Z index {} out of range {}'.format(idx, count)
+        row = start + idx
+        z = [self._arrays[name][row, :self._arrays[name + '_len'][row]].tolist() for name in Z_LIST_ARRAYS]
+        z.append(int(self._arrays['loop'][row]))
+        z_type = int(self._arrays['z_type'][row])
+        if z_type >= 0:
+            z.append(z_type)
+        return z
+
+    def sample(self, map_name, race, born_location):
+        count = self.count(map_name, race, born_location)
+        assert count > 0, 'no Z for map {}, race {}, born location {}'.format(map_name, race, born_location)
+        return self.get(map_name, race, born_location, random.randrange(count))
+
+
+class JsonZLibrary(object):
+    r"""
+    Overview:
+        Z json with the interface of ZLibrary, parsed once per process
+    Interface:
+        __init__, count, get, sample
+    """
+
+    def __init__(self, path):
+        with open(path, 'r') as f:
+            self._z_data = json.load(f)
+
+    def count(self, map_name, race, born_location):
+        return len(self._z_data.get(map_name, {}).get(race, {}).get(born_location, []))
+
+    def get(self, map_name, race, born_location, idx):
+        return self._z_data[map_name][race][born_location][idx]
+
+    def sample(self, map_name, race, born_location):
+        return random.choice(self._z_data[map_name][race][born_location])
+
+
+def load_z_library(z_path):
+    r"""
+    Overview:
+        load Z file once per process, files ending with .zlib are Z library files of compile_z_library, others are
+        json. Relative paths are relative to distar/agent/default/lib. Loading before env processes are forked
+        shares the loaded library with them.
+    """
+    path = os.path.join(os.path.dirname(__file__), z_path)
+    if path not in _LIBRARIES:
+        _LIBRARIES[path] = ZLibrary(path) if path.endswith('.zlib') else JsonZLibrary(path)
+    return _LIBRARIES[path]
@@ -0,0 +1,87 @@
+import torch
+
+from ..lib.features import fake_step_data
+from distar.ctools.torch_utils import to_device
+
+
+def enable_fallback_random():
+    # process wide inductor setting, compiled graphs use the random ops of eager mode
+    if hasattr(torch, 'compile'):
+        import torch._inductor.config
+        torch._inductor.config.fallback_random = True
+
+
+class CompiledModel(object):
+    r"""
+    Overview:
+        Inference wrapper of Model, compute_logp_action and compute_teacher_logit are compiled once by torch.compile
+        and reused across steps. Compiled graphs read parameters of the wrapped model at call time, so parameters
+        loaded in place (load_state_dict / copy_) are used without recompiling. Inductor samples actions like eager
+        mode only with torch._inductor.config.fallback_random, set by enable_fallback_random in actor setup, otherwise
+        the check fails and the eager model is used.
+    Interface:
+        __init__, compute_logp_action, compute_teacher_logit, compute_teacher_logit_sequence, policy
+    """
+
+    def __init__(self, model, backend='inductor', check=True):
+        self.model = model
+        self.compiled = False
+        self.compute_logp_action = model.compute_logp_action
+        self.compute_teacher_logit = model.compute_teacher_logit
+        self.compute_teacher_logit_sequence = model.compute_teacher_logit_sequence
+        if not hasattr(torch, 'compile'):
+            print('torch.compile needs torch>=2.0, use eager model instead')
+            return
+        compute_logp_action = torch.compile(model.compute_logp_action, backend=backend)
+        compute_teacher_logit = torch.compile(model.compute_teacher_logit, backend=backend)
+        if check:
+            try:
+                same_output = self._check(compute_logp_action, compute_teacher_logit)
+            except Exception as e:
+                print('can not compile model, use eager model instead, Error: {}'.format(e), flush=True)
+                return
+            if not same_output:
+                print('compiled model outputs differ from eager mode, use eager model instead', flush=True)
+                return
+        self.compute_logp_action = compute_logp_action
+        self.compute_teacher_logit = compute_teacher_logit
+        self.compiled = True
+
+    @property
+    def policy(self):
+        return self.model.policy
+
+    def _check(self, compute_logp_action, compute_teacher_logit):
+        # warm up with the fixed layout of fake_step_data and compare with eager mode under the same seed
+        hidden_size = self.model.cfg.encoder.core_lstm.hidden_size
+        num_layers = self.model.cfg.encoder.core_lstm.num_layers
+        device = next(self.model.parameters()).device
+        data = fake_step_data(share_memory=True, batch_size=1, hidden_size=hidden_size, hidden_layer=num_layers,
+                              train=False)
+        data = to_device(data, device)
+        rng_state = torch.get_rng_state()
+        try:
+            return self._compare(compute_logp_action, compute_teacher_logit, data)
+        finally:
+            torch.set_rng_state(rng_state)
+
+    def _compare(self, compute_logp_action, compute_teacher_logit, data):
+        with torch.no_grad():
+            torch.manual_seed(0)
+            eager_output = self.model.compute_logp_action(**data)
+            torch.manual_seed(0)
+            compiled_output = compute_logp_action(**data)
+            for k, v in eager_output['logit'].items():
+                if not torch.allclose(v, compiled_output['logit'][k], rtol=1e-4, atol=1e-5):
+                    return False
+            for k, v in eager_output['action_info'].items():
+                if not torch.equal(v, compiled_output['action_info'][k]):
+                    return False
+            data['action_info'] = eager_output['action_info']
+            data['selected_units_num'] = eager_output['selected_units_num']
+            eager_logit = self.model.compute_teacher_logit(**data)['logit']
+            compiled_logit = compute_teacher_logit(**data)['logit']
+            for k, v in eager_logit.items():
+                if not torch.allclose(v, compiled_logit[k], rtol=1e-4, atol=1e-5):
+                    return False
+        return True
@@ -104,6 +104,8 @@ class SelectedUnitsHead(nn.Module):
 
         self.num_layers = self.cfg.num_layers
         self.test_iou = self.cfg.get('test_iou', False)
+        # drop rows which have selected end flag from the working set at inference
+        self.compact_rows = self.cfg.get('compact_rows', True)
 
         self.lstm = script_lnlstm(self.cfg.key_dim, self.cfg.hidden_dim, self.cfg.num_layers)
         self.end_embedding = torch.nn.Parameter(torch.FloatTensor(1, self.key_dim))
@@ -259,6 +261,8 @@ class SelectedUnitsHead(nn.Module):
                     results = results.transpose(1, 0).contiguous()
 
 
+        elif self.compact_rows:
+            return self._compact_query(key, entity_num, autoregressive_embedding, logits_mask, key_embeddings, su_mask)
         else:
             selected_units_num = torch.ones(bs, dtype=torch.long, device=ae.device) * self.max_select_num
             end_flag[~su_mask] = 1
@@ -306,13 +310,105 @@ class SelectedUnitsHead(nn.Module):
                     break
             if self.extra_units:
                 end_flag_logit = step_logits[torch.arange(bs), entity_num]
-                extra_units = ((step_logits > end_flag_logit.unsqueeze(dim=1)) * ~end_flag.unsqueeze(dim=1)).float()
+                # step_logits is only as wide as the entity bucket, extra_units keeps MAX_ENTITY_NUM + 1 columns
+                extra_units[:, :step_logits.shape[1]] = \
+                    ((step_logits > end_flag_logit.unsqueeze(dim=1)) * ~end_flag.unsqueeze(dim=1)).float()
             results = torch.stack(results_list, dim=0)
             results = results.transpose(1, 0).contiguous()
             logits = torch.stack(logits_list, dim=0)
             logits = logits.transpose(1, 0).contiguous()
         return logits, results, ae, selected_units_num, extra_units
 
+    def _compact_query(self, key: Tensor, entity_num: Tensor, autoregressive_embedding: Tensor, logits_mask: Tensor,
+                       key_embeddings: Tensor, su_mask: Tensor):
+        # same sampling as the inference loop in _query, but only rows still selecting units are computed,
+        # rows without unit selection never enter the loop. Results after end flag are filled with end flag and
+        # logits with -1e9, they are cut by selected_units_num anyway.
+        bs, n = logits_mask.shape
+        device = autoregressive_embedding.device
+        selected_units_num = torch.ones(bs, dtype=torch.long, device=device) * self.max_select_num
+        selected_units_num[~su_mask] = 0
+        extra_units = torch.zeros(bs, MAX_ENTITY_NUM + 1, device=device)
+        ae_out = autoregressive_embedding.clone()
+        results_list, logits_list = [], []
+
+        active_idx = torch.arange(bs, device=device)[su_mask]
+        key = key[active_idx]
+        key_embeddings = key_embeddings[active_idx]
+        logits_mask = logits_mask[active_idx]
+        ae_base = autoregressive_embedding[active_idx]
+        ae = ae_base
+        active_entity_num = entity_num[active_idx]
+        state = [(torch.zeros(len(active_idx), 32, device=device), torch.zeros(len(active_idx), 32, device=device))
+                 for _ in range(self.num_layers)]
+        selected_units_one_hot = torch.zeros(*key_embeddings.shape[:2], device=device).unsqueeze(dim=2)
+        result: Optional[Tensor] = None
+        for i in range(self.max_select_num):
+            if len(active_idx) == 0:
+                break
+            active_num = len(active_idx)
+            if i > 0:
+                if i == 1:  # end flag can be selected at second selection
+                    logits_mask[torch.arange(active_num), active_entity_num] = 1
+                if result is not None:
+                    logits_mask[torch.arange(active_num), result] = 0  # mask selected units
+            lstm_input = self.query_fc2(self.query_fc1(ae)).unsqueeze(0)
+            lstm_output, state = self.lstm(lstm_input, state)
+            queries = lstm_output.permute(1, 0, 2)  # b, 1, c
+            query_result = queries * key
+            step_logits = query_result.sum(dim=2)  # b, n
+            step_logits = step_logits.masked_fill(~logits_mask, -1e9)
+            result = self._get_pred_with_logit(step_logits)
+            end_flag = result == active_entity_num
+            selected_units_num[active_idx[end_flag]] = i + 1
+
+            full_result = entity_num.clone()
+            full_result[active_idx] = result
+            full_logits = torch.full((bs, n), -1e9, device=device)
+            full_logits[active_idx] = step_logits
+            results_list.append(full_result)
+            logits_list.append(full_logits)
+
+            if self.whole_cfg.model.entity_reduce_type == 'selected_units_num' or 'attention' in self.whole_cfg.model.entity_reduce_type:
+                selected_units_one_hot[torch.arange(active_num)[~end_flag], result[~end_flag], :] = 1
+                if self.whole_cfg.model.entity_reduce_type == 'selected_units_num':
+                    selected_units_emebedding = (key_embeddings * selected_units_one_hot).sum(dim=1)
+                    slected_num = selected_units_one_hot.sum(dim=1).squeeze(dim=1)
+                    selected_units_emebedding[slected_num != 0] = selected_units_emebedding[slected_num != 0] / slected_num[slected_num != 0].unsqueeze(dim=1)
+                    selected_units_emebedding = self.embed_fc2(self.embed_fc1(selected_units_emebedding))
+                    ae = ae_base + selected_units_emebedding
+                elif self.whole_cfg.model.entity_reduce_type == 'attention_pool':
+                    ae = ae_base + self.attention_pool(key_embeddings, mask=selected_units_one_hot)
+                elif self.whole_cfg.model.entity_reduce_type == 'attention_pool_add_num':
+                    ae = ae_base + self.attention_pool(key_embeddings, num=selected_units_one_hot.sum(dim=1).squeeze(dim=1),
+                                                       mask=selected_units_one_hot, )
+            else:
+                ae = ae + key_embeddings[torch.arange(active_num), result] * ~end_flag.unsqueeze(dim=1)
+            ae_out[active_idx] = ae
+
+            if self.extra_units and i == self.max_select_num - 1:
+                end_flag_logit = step_logits[torch.arange(active_num), active_entity_num]
+                extra_units[active_idx[~end_flag], :n] = (step_logits > end_flag_logit.unsqueeze(dim=1))[~end_flag].float()
+            if end_flag.any():
+                keep = ~end_flag
+                active_idx = active_idx[keep]
+                key = key[keep]
+                key_embeddings = key_embeddings[keep]
+                logits_mask = logits_mask[keep]
+                ae_base = ae_base[keep]
+                ae = ae[keep]
+                active_entity_num = active_entity_num[keep]
+                state = [(h[keep], c[keep]) for h, c in state]
+                selected_units_one_hot = selected_units_one_hot[keep]
+                result = result[keep]
+        if len(results_list) == 0:
+            # no row selects units, keep one step of end flag as the full batch loop outputs at least one step
+            results_list.append(entity_num.clone())
+            logits_list.append(torch.full((bs, n), -1e9, device=device))
+        results = torch.stack(results_list, dim=1)
+        logits = torch.stack(logits_list, dim=1)
+        return logits, results, ae_out, selected_units_num, extra_units
+
     def forward(
             self,
             embedding,
@@ -153,6 +153,38 @@ class LayerNormLSTMCell(nn.Module):
         return hy, (hy, cy)
 
 
+class LinearLayerNormLSTMCell(nn.Module):
+    # same computation as LayerNormLSTMCell, gemm weights are kept in nn.Linear so dynamic quantization can replace them
+    def __init__(self, cell):
+        super(LinearLayerNormLSTMCell, self).__init__()
+        self.input_size = cell.input_size
+        self.hidden_size = cell.hidden_size
+        self.linear_ih = nn.Linear(self.input_size, 4 * self.hidden_size, bias=False)
+        self.linear_hh = nn.Linear(self.hidden_size, 4 * self.hidden_size, bias=False)
+        self.linear_ih.weight = Parameter(cell.weight_ih.detach().clone())
+        self.linear_hh.weight = Parameter(cell.weight_hh.detach().clone())
+        self.layernorm_i = cell.layernorm_i
+        self.layernorm_h = cell.layernorm_h
+        self.layernorm_c = cell.layernorm_c
+
+    def forward(self, input: Tensor, state: Tuple[Tensor, Tensor]) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
+        hx, cx = state
+        igates = self.layernorm_i(self.linear_ih(input))
+        hgates = self.layernorm_h(self.linear_hh(hx))
+        gates = igates + hgates
+        ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
+
+        ingate = torch.sigmoid(ingate)
+        forgetgate = torch.sigmoid(forgetgate)
+        cellgate = torch.tanh(cellgate)
+        outgate = torch.sigmoid(outgate)
+
+        cy = self.layernorm_c((forgetgate * cx) + (ingate * cellgate))
+        hy = outgate * torch.tanh(cy)
+
+        return hy, (hy, cy)
+
+
 class LSTMLayer(nn.Module):
     def __init__(self, cell, *cell_args):
         super(LSTMLayer, self).__init__()
@@ -42,6 +42,8 @@ class Model(nn.Module):
         self.core_lstm = script_lnlstm(self.cfg.encoder.core_lstm.input_size,
                                        self.cfg.encoder.core_lstm.hidden_size,
                                        self.cfg.encoder.core_lstm.num_layers)
+        # bumped by actor after loading new parameters, inference copies (e.g. quantized model) are rebuilt on change
+        self.version = torch.zeros(1, dtype=torch.long).share_memory_()
 
     def forward(self, spatial_info: Tensor, entity_info: Dict[str, Tensor], scalar_info: Dict[str, Tensor],
                 entity_num: Tensor, hidden_state: List[Tuple[Tensor, Tensor]],
@@ -92,6 +94,26 @@ class Model(nn.Module):
         return {'logit': logit, 'hidden_state': out_state, 'entity_num': entity_num,
                 'selected_units_num': selected_units_num}
 
+    def compute_teacher_logit_sequence(self,
+                                       spatial_info: Tensor,
+                                       entity_info: Dict[str, Tensor],
+                                       scalar_info: Dict[str, Tensor],
+                                       entity_num: Tensor,
+                                       hidden_state: List[Tuple[Tensor, Tensor]],
+                                       selected_units_num,
+                                       action_info: Dict[str, Tensor],
+                                       **kwargs):
+        # steps of one trajectory are stacked in dim 0, encoder runs batched over time and core lstm runs the sequence
+        lstm_input, scalar_context, baseline_feature, entity_embeddings, map_skip = \
+            self.encoder(spatial_info, entity_info, scalar_info, entity_num)
+        lstm_output, out_state = self.core_lstm(lstm_input.unsqueeze(dim=1), hidden_state)
+        action_info, selected_units_num, logit = self.policy.train_forward(lstm_output.squeeze(dim=1),
+                                                                           entity_embeddings, map_skip,
+                                                                           scalar_context, entity_num, action_info,
+                                                                           selected_units_num)
+        return {'logit': logit, 'hidden_state': out_state, 'entity_num': entity_num,
+                'selected_units_num': selected_units_num}
+
     def rl_learner_forward(self,
                            spatial_info,
                            entity_info,
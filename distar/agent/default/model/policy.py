@@ -4,7 +4,7 @@ import torch.nn as nn
 from .head import DelayHead, QueuedHead, SelectedUnitsHead, TargetUnitHead, LocationHead, ActionTypeHead
 from typing import List, Dict, Optional
 from torch import Tensor
-from ..lib.actions import SELECTED_UNITS_MASK
+from ..lib.actions import SELECTED_UNITS_MASK, TARGET_UNIT_MASK, TARGET_LOCATION_MASK
 
 
 class Policy(nn.Module):
@@ -18,6 +18,23 @@ class Policy(nn.Module):
         self.selected_units_head = SelectedUnitsHead(self.whole_cfg)
         self.target_unit_head = TargetUnitHead(self.whole_cfg)
         self.location_head = LocationHead(self.whole_cfg)
+        # at inference, only compute target unit and location heads for rows whose action type uses them
+        self.lazy_heads = self.cfg.get('lazy_heads', False)
+        self.location_num = self.whole_cfg.model.spatial_y * self.whole_cfg.model.spatial_x
+
+    def _masked_head(self, head, mask: Tensor, logit_size: int, *args):
+        # rows not in mask get -1e9 logits and action 0, they are masked by actions_mask in learner
+        bs = mask.shape[0]
+        if mask.all():
+            return head(*args)
+        device = args[0].device
+        logits = torch.full((bs, logit_size), -1e9, device=device)
+        actions = torch.zeros(bs, dtype=torch.long, device=device)
+        if mask.any():
+            idx = mask.nonzero().squeeze(dim=1)
+            args = [[m[idx] for m in x] if isinstance(x, list) else x[idx] for x in args]
+            logits[idx], actions[idx] = head(*args)
+        return logits, actions
 
     def forward(self, lstm_output: Tensor, entity_embeddings: Tensor, map_skip: List[Tensor], scalar_context: Tensor, entity_num: Tensor):
         action = torch.jit.annotate(Dict[str, Tensor], {})
@@ -37,6 +54,17 @@ class Policy(nn.Module):
                 embeddings, entity_embeddings, entity_num, None, None, su_mask
             )
 
+        if self.lazy_heads:
+            logit['target_unit'], action['target_unit'] = self._masked_head(
+                self.target_unit_head, TARGET_UNIT_MASK[action['action_type']], entity_embeddings.shape[1],
+                embeddings, entity_embeddings, entity_num
+            )
+            logit['target_location'], action['target_location'] = self._masked_head(
+                self.location_head, TARGET_LOCATION_MASK[action['action_type']], self.location_num,
+                embeddings, map_skip
+            )
+            return action, selected_units_num, logit, extra_units
+
         logit['target_unit'], action['target_unit'] = self.target_unit_head(
             embeddings, entity_embeddings, entity_num
         )
@@ -0,0 +1,44 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from .lstm import LayerNormLSTMCell, LinearLayerNormLSTMCell
+
+
+class BF16Conv(nn.Module):
+    def __init__(self, conv):
+        super(BF16Conv, self).__init__()
+        self.conv = conv.to(torch.bfloat16)
+
+    def forward(self, x):
+        return self.conv(x.to(torch.bfloat16)).float()
+
+
+def quantize_model(model, conv_bf16=False):
+    r"""
+    Overview:
+        Build an inference only copy of model: nn.Linear layers (entity transformer, fc_blocks) and lstm cell gemms
+        use dynamic int8 quantization, conv layers in spatial encoder and location head optionally run in bf16.
+        The original fp32 model is not modified.
+    Arguments:
+        - model (:obj:`Model`): fp32 model
+        - conv_bf16 (:obj:`bool`): whether to run conv layers of spatial encoder and location head in bf16
+    Returns:
+        - quantized_model (:obj:`Model`): quantized copy, only supports cpu inference
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, LayerNormLSTMCell):
+                setattr(module, name, LinearLayerNormLSTMCell(child))
+    if conv_bf16:
+        for root in [model.encoder.spatial_encoder, model.policy.location_head]:
+            for module in list(root.modules()):
+                for name, child in list(module.named_children()):
+                    if isinstance(child, (nn.Conv2d, nn.ConvTranspose2d)):
+                        setattr(module, name, BF16Conv(child))
+    model = torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    for param in model.parameters():
+        param.requires_grad_(False)
+    return model
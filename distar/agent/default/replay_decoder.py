@@ -11,7 +11,7 @@ from distar.pysc2 import run_configs
 from distar.pysc2.lib import point
 from distar.pysc2.lib.static_data import NUM_UNIT_TYPES
 
-from .lib.features import Features, MAX_DELAY
+from .lib.features import Features, MAX_DELAY, build_tag_index
 from distar.envs.map_info import get_map_size, LOCALIZED_BNET_NAME_TO_NAME_LUT
 from distar.pysc2.lib.actions import RAW_FUNCTIONS
 from distar.pysc2.run_configs.lib import VERSIONS
@@ -113,19 +113,19 @@ class FilterActions:
             if a_id in self.morph_abilities:
                 unit_tags = self.gen_unit_tags(actions[0])
                 pre_unit_types = [u.unit_type for u in pre_obs.units]
-                pre_unit_tags = [u.tag for u in pre_obs.units]
+                pre_unit_tags = build_tag_index([u.tag for u in pre_obs.units])
                 post_unit_types = [u.unit_type for u in post_obs.units]
-                post_unit_tags = [u.tag for u in post_obs.units]
+                post_unit_tags = build_tag_index([u.tag for u in post_obs.units])
                 for t in unit_tags:
                     try:
-                        pre_unit_index = pre_unit_tags.index(t)
-                    except ValueError:
+                        pre_unit_index = pre_unit_tags[t]
+                    except KeyError:
                         # print('not found')
                         action_count += 1
                         continue
                     try:
-                        post_unit_index = post_unit_tags.index(t)
-                    except ValueError:
+                        post_unit_index = post_unit_tags[t]
+                    except KeyError:
                         # print('not found')
                         action_count += 1
                         continue
@@ -142,12 +142,12 @@ class FilterActions:
             elif a_id in self.corrosivebile:
                 unit_tags = self.gen_unit_tags(actions[0])
                 pre_unit_types = [u.unit_type for u in pre_obs.units]
-                pre_unit_tags = [u.tag for u in pre_obs.units]
+                pre_unit_tags = build_tag_index([u.tag for u in pre_obs.units])
                 action_count = 0
                 for t in unit_tags:
                     try:
-                        pre_unit_index = pre_unit_tags.index(t)
-                    except ValueError:
+                        pre_unit_index = pre_unit_tags[t]
+                    except KeyError:
                         # print('not found')
                         action_count += 1
                         continue
@@ -158,21 +158,21 @@ class FilterActions:
             elif a_id in self.train_abilities:
                 unit_tags = self.gen_unit_tags(actions[0])
                 pre_unit_orders = [len(u.orders) for u in pre_obs.units]
-                pre_unit_tags = [u.tag for u in pre_obs.units]
+                pre_unit_tags = build_tag_index([u.tag for u in pre_obs.units])
                 post_unit_orders = [len(u.orders) for u in post_obs.units]
-                post_unit_tags = [u.tag for u in post_obs.units]
+                post_unit_tags = build_tag_index([u.tag for u in post_obs.units])
                 pre_order_len = 0
                 post_order_len = 0
                 for t in unit_tags:
                     try:
-                        pre_unit_index = pre_unit_tags.index(t)
-                    except ValueError:
+                        pre_unit_index = pre_unit_tags[t]
+                    except KeyError:
                         # print('not found')
                         return actions
                     pre_order_len += pre_unit_orders[pre_unit_index]
                     try:
-                        post_unit_index = post_unit_tags.index(t)
-                    except ValueError:
+                        post_unit_index = post_unit_tags[t]
+                    except KeyError:
                         # print('not found')
                         return actions
                     post_order_len += post_unit_orders[post_unit_index]
@@ -307,16 +307,16 @@ class ReplayDecoder:
             step_data = feature.transform_obs(raw_ob)
             # add last step info
             entity_num = step_data['entity_num']
-            tags = step_data['game_info']['tags']
+            tag_index = step_data['game_info']['tag_index']
             last_selected_units = torch.zeros(entity_num, dtype=torch.int8)
             last_targeted_unit = torch.zeros(entity_num, dtype=torch.int8)
             if last_selected_unit_tags is not None:
                 for t in last_selected_unit_tags:
-                    if t in tags:
-                        last_selected_units[tags.index(t)] = 1
+                    if t in tag_index:
+                        last_selected_units[tag_index[t]] = 1
             if last_target_unit_tag is not None:
-                if last_target_unit_tag in tags:
-                    last_targeted_unit[tags.index(last_target_unit_tag)] = 1
+                if last_target_unit_tag in tag_index:
+                    last_targeted_unit[tag_index[last_target_unit_tag]] = 1
             step_data['entity_info']['last_selected_units'] = last_selected_units
             step_data['entity_info']['last_targeted_unit'] = last_targeted_unit
             step_data['scalar_info']['last_delay'] = last_delay
@@ -324,7 +324,7 @@ class ReplayDecoder:
             step_data['scalar_info']['last_queued'] = last_queued
             step_data['scalar_info']['enemy_unit_type_bool'] = (enemy_unit_type_bool | step_data['scalar_info']['enemy_unit_type_bool']).to(torch.uint8)
             # action
-            action, action_mask, selected_units_num, last_selected_unit_tags, last_target_unit_tag, invalid_action_flag = feature.reverse_raw_action(action, step_data['game_info']['tags'])
+            action, action_mask, selected_units_num, last_selected_unit_tags, last_target_unit_tag, invalid_action_flag = feature.reverse_raw_action(action, step_data['game_info']['tags'], tag_index)
             if invalid_action_flag:
                 continue
             action['delay'] = torch.tensor(delay, dtype=torch.long).clamp_(max=MAX_DELAY - 1)
@@ -19,6 +19,7 @@ import torch.multiprocessing as tm
 import torch.nn.functional as F
 
 from ..lib.features import SPATIAL_SIZE, MAX_ENTITY_NUM, MAX_SELECTED_UNITS_NUM
+from ..lib.trajectory_buffer import unstack_trajectory
 
 
 from distar.ctools.data.collate_fn import default_collate_with_dim
@@ -42,8 +43,14 @@ def flat(data):
         print(type(data))
 
 
+# spatial layers interned by actors, content hash -> layer
+STATIC_LAYER_CACHE = {}
+
+
 def collate_fn(traj_batch):
     # data list of list, with shape batch_size, unroll_len
+    # trajectories sent from TrajectoryBuffer are stacked along unroll_len
+    traj_batch = [unstack_trajectory(traj, STATIC_LAYER_CACHE) if isinstance(traj, dict) else traj for traj in traj_batch]
     # find max_entity_num in data_batch
     max_entity_num = max(
         [len(traj_data['entity_info']['x']) for traj_data_list in traj_batch for traj_data in traj_data_list])
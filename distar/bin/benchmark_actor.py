@@ -0,0 +1,240 @@
+import argparse
+import json
+import multiprocessing
+import os
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+import portpicker
+import torch
+from easydict import EasyDict
+from flask import request
+
+from distar.actor import Actor
+from distar.ctools.utils.file_helper import dumps
+from distar.ctools.utils.log_helper import VariableRecord
+from distar.ctools.worker.coordinator.adapter import Adapter
+from distar.ctools.worker.coordinator.coordinator import Coordinator, create_coordinator_app, KeepAliveRequestHandler
+from distar.envs.map_info import get_map_size
+
+# names in the actor's VariableRecord of every stage
+STAGES = [('agent_step', 'agent_time'), ('env_step', 'env_time'), ('collect_data', 'post_process_time'),
+          ('send_data', 'send_data_time')]
+PLAYER_IDS = ['model1', 'model2']
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, default=300, help='agent steps to measure')
+    parser.add_argument('--warmup_steps', type=int, default=10)
+    parser.add_argument('--map_name', type=str, default='KairosJunction')
+    parser.add_argument('--z_path', type=str, default='3map.json')
+    parser.add_argument('--max_units', type=int, default=200, help='own units at the end of the unit ramp')
+    parser.add_argument('--game_loops', type=int, default=13440, help='game loops of every fake game')
+    parser.add_argument('--traj_len', type=int, default=16)
+    parser.add_argument('--pipeline_env_num', type=int, default=1)
+    parser.add_argument('--model_update_interval', type=float, default=5, help='seconds between model updates')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def z_born_locations(z_path, map_name, race):
+    # fake games use born locations of the Z file, so agents find their Z
+    path = os.path.join(os.path.dirname(__file__), '..', 'agent', 'default', 'lib', z_path)
+    with open(path, 'r') as f:
+        keys = sorted(json.load(f)[map_name][race].keys(), key=int)
+    map_y = get_map_size(map_name)[1]
+    return [[int(k) % 160 + 0.5, map_y - int(k) // 160 - 0.5] for k in (keys * 2)[:2]]
+
+
+def make_cfg(args, port):
+    return EasyDict({
+        'common': {'experiment_name': 'benchmark_actor'},
+        'agent': {'z_path': args.z_path},
+        'learner': {'data': {'fs_type': 'nppickle'}},
+        'actor': {
+            'job_type': 'train',
+            'fake_model': True,
+            'traj_len': args.traj_len,
+            'episode_num': 1 << 30,
+            'print_freq': 100,
+            'pipeline_env_num': args.pipeline_env_num,
+        },
+        'env': {
+            'map_name': args.map_name,
+            'races': ['zerg', 'zerg'],
+            'save_replay_episodes': 0,
+            'fake_sc2': {
+                'game_loops': args.game_loops,
+                'born_locations': z_born_locations(args.z_path, args.map_name, 'zerg'),
+                'world': {'max_units': args.max_units, 'ramp_loops': args.game_loops, 'seed': args.seed},
+            },
+        },
+        'communication': {
+            'coordinator_ip': '127.0.0.1',
+            'coordinator_port': port,
+            'league_port': port,
+            'adapter_traj_worker_num': 1,
+            'adapter_model_worker_num': 1,
+            'model_fs_type': 'torch',
+            'actor_model_update_interval': args.model_update_interval,
+            'actor_ask_for_job_interval': 1 << 30,
+        },
+    })
+
+
+def make_job(args):
+    # what league gives a train actor of two active players
+    return {
+        'player_ids': PLAYER_IDS,
+        'side_ids': [0, 1],
+        'pipelines': ['default', 'default'],
+        'checkpoint_paths': ['none', 'none'],
+        'successive_ids': ['none', 'none'],
+        'z_path': [args.z_path, args.z_path],
+        'z_prob': [0., 0.],
+        'teacher_player_ids': ['teacher', 'teacher'],
+        'teacher_checkpoint_paths': ['none', 'none'],
+        'send_data_players': PLAYER_IDS,
+        'update_players': PLAYER_IDS,
+        'frac_ids': [],
+        'env_info': {'player_ids': PLAYER_IDS, 'side_id': [0, 1]},
+    }
+
+
+def start_coordinator(cfg, job, results):
+    # coordinator in this process, also answers the league requests of ActorComm
+    coordinator_app = create_coordinator_app(Coordinator(cfg))
+
+    @coordinator_app.route('/league/actor_ask_for_job', methods=['POST'])
+    def actor_ask_for_job():
+        return {'code': 0, 'info': job}
+
+    @coordinator_app.route('/league/actor_send_result', methods=['POST'])
+    def actor_send_result():
+        results.append(request.json)
+        return {'code': 0, 'info': ''}
+
+    thread = threading.Thread(target=coordinator_app.run, kwargs={
+        'host': cfg.communication.coordinator_ip, 'port': cfg.communication.coordinator_port, 'debug': False,
+        'use_reloader': False, 'request_handler': KeepAliveRequestHandler}, daemon=True)
+    thread.start()
+    time.sleep(1)
+
+
+class StepRecord(VariableRecord):
+    # keeps every value besides the averages the actor logs
+    def __init__(self, length, records):
+        super(StepRecord, self).__init__(length)
+        self.records = records
+
+    def update_var(self, info):
+        super(StepRecord, self).update_var(info)
+        for k, v in info.items():
+            self.records[k].append(v)
+
+
+class BenchmarkActor(Actor):
+    r"""
+    Overview:
+        train actor running its own env loop and ActorComm, records every step and closes the loop after steps
+    """
+
+    def __init__(self, cfg, warmup_steps, steps):
+        self.records = defaultdict(list)
+        self.duration = None
+        self._warmup_steps = warmup_steps
+        self._steps = steps
+        self._stop_pipe, self.stop_pipe_c = multiprocessing.Pipe()
+        super(BenchmarkActor, self).__init__(cfg)
+
+    def _make_variable_record(self):
+        variable_record = StepRecord(self._cfg.print_freq, self.records)
+        for name in super(BenchmarkActor, self)._make_variable_record().get_var_names():
+            variable_record.register_var(name)
+        return variable_record
+
+    def iter_after_hook(self, iter_count, variable_record):
+        super(BenchmarkActor, self).iter_after_hook(iter_count, variable_record)
+        if iter_count == self._warmup_steps:
+            self.records.clear()
+            self._comm._update_model_time.clear()
+            self._start_time = time.time()
+        elif iter_count == self._warmup_steps + self._steps:
+            self.duration = time.time() - self._start_time
+            self._stop_pipe.send('close')
+
+
+def send_model_loop(cfg, player_id, model):
+    # plays the learner, keeps the latest model on the coordinator for actors to pull
+    adapter = Adapter(cfg=cfg, maxlen=1)
+    state_dict = {k: v for k, v in model.state_dict().items() if 'value_networks' not in k and 'value_encoder' not in k}
+    data = dumps({'model': state_dict, 'model_last_iter': 0, 'reset_flag': False},
+                 fs_type=cfg.communication.model_fs_type, compress=True)
+    while True:
+        if not adapter.full(player_id + 'model'):
+            adapter.push(data, token=player_id + 'model', worker_num=cfg.communication.adapter_model_worker_num)
+        time.sleep(0.01)
+
+
+def receive_traj_loop(cfg, player_id, received, traj_bytes):
+    # plays the learner dataloader, counts trajectories arriving at the other end
+    adapter = Adapter(cfg=cfg)
+    while True:
+        data = adapter.pull(token=player_id + 'traj', fs_type='nppickle', sleep_time=0.2,
+                            worker_num=cfg.communication.adapter_traj_worker_num)
+        received[player_id] += 1
+        if len(traj_bytes) < 10:
+            traj_bytes.append(len(dumps(data, fs_type='nppickle', compress=True)))
+
+
+def update_model_loop(actor, stop_event):
+    # main process of a train actor without batch inference, env loops run in other processes there
+    while not stop_event.is_set():
+        actor._comm.update_model(actor)
+        time.sleep(0.1)
+
+
+def main():
+    args = get_args()
+    torch.manual_seed(args.seed)
+    cfg = make_cfg(args, portpicker.pick_unused_port())
+    results = []
+    start_coordinator(cfg, make_job(args), results)
+    actor = BenchmarkActor(cfg, args.warmup_steps, args.steps)
+    received = defaultdict(int)
+    traj_bytes = []
+    for player_id, model in actor.models.items():
+        threading.Thread(target=send_model_loop, args=(cfg, player_id, model), daemon=True).start()
+        threading.Thread(target=receive_traj_loop, args=(cfg, player_id, received, traj_bytes), daemon=True).start()
+    stop_event = threading.Event()
+    update_thread = threading.Thread(target=update_model_loop, args=(actor, stop_event), daemon=True)
+    update_thread.start()
+
+    actor._inference_loop(env_id=0, job=actor._comm.job, pipe_c=actor.stop_pipe_c)
+    stop_event.set()
+    update_thread.join()
+    # wait for trajectories still cached in ActorComm
+    deadline = time.time() + 60
+    while any(actor._comm._adapter.length(player_id + 'traj') for player_id in PLAYER_IDS) and \
+            time.time() < deadline:
+        time.sleep(0.1)
+
+    cost = {stage: actor.records[name] for stage, name in STAGES}
+    cost['model_update'] = list(actor._comm._update_model_time)
+    print('{} steps with {} units at most, {:.2f} steps/s, {} games finished'.format(
+        args.steps, args.max_units, args.steps / actor.duration, len(results)))
+    for stage, values in cost.items():
+        if values:
+            print('{:>13}: mean {:.2f} ms, p95 {:.2f} ms, {} calls'.format(
+                stage, np.mean(values) * 1000, np.percentile(values, 95) * 1000, len(values)))
+    print('model versions: {}'.format({k: m.version.item() for k, m in actor.models.items()}))
+    if traj_bytes:
+        print('{:.0f} bytes per serialized trajectory of {} steps, {} trajectories received'.format(
+            np.mean(traj_bytes), args.traj_len, sum(received.values())))
+
+
+if __name__ == '__main__':
+    main()
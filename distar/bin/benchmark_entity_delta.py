@@ -0,0 +1,59 @@
+import argparse
+import copy
+import os
+import time
+
+import torch
+
+from distar.ctools.utils.file_helper import dumps
+from distar.agent.default.lib.trajectory_buffer import encode_entity_delta, decode_entity_delta
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, required=True,
+                        help='directory of trajectories saved by actor with actor.trajectory_dump_dir')
+    parser.add_argument('--num', type=int, default=100, help='max number of trajectories')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    torch.set_num_threads(1)
+    files = sorted([f for f in os.listdir(args.data) if f.endswith('.pt')])[:args.num]
+    raw_size, delta_size, raw_lz4_size, delta_lz4_size = 0, 0, 0, 0
+    encode_time, decode_time, changed_ratio = 0., 0., 0.
+    for f in files:
+        trajectory = torch.load(os.path.join(args.data, f))
+        entity_info = trajectory['data']['entity_info']
+        entity_num = trajectory['data']['entity_num']
+        start_time = time.time()
+        encoded = copy.copy(trajectory)
+        encoded['data'] = dict(trajectory['data'])
+        encode_entity_delta(encoded)
+        encode_time += time.time() - start_time
+        entity_delta = encoded['entity_delta']
+        start_time = time.time()
+        decoded = decode_entity_delta(entity_num, entity_delta)
+        decode_time += time.time() - start_time
+        for k, v in entity_info.items():
+            assert torch.equal(decoded[k], v), 'entity_info {} differs after decoding, file: {}'.format(k, f)
+        raw_size += len(dumps(entity_info, fs_type='nppickle', compress=False))
+        delta_size += len(dumps(entity_delta, fs_type='nppickle', compress=False))
+        raw_lz4_size += len(dumps(entity_info, fs_type='nppickle', compress=True))
+        delta_lz4_size += len(dumps(entity_delta, fs_type='nppickle', compress=True))
+        changed_ratio += entity_delta['changed'].float().mean().item()
+
+    num = len(files)
+    print('trajectories: {}, changed fields: {:.3f}'.format(num, changed_ratio / num))
+    print('{:<16}{:>14}{:>14}{:>10}'.format('', 'raw(KB)', 'delta(KB)', 'ratio'))
+    print('{:<16}{:>14.1f}{:>14.1f}{:>10.2f}'.format('pickle', raw_size / num / 1024, delta_size / num / 1024,
+                                                     raw_size / delta_size))
+    print('{:<16}{:>14.1f}{:>14.1f}{:>10.2f}'.format('pickle+lz4', raw_lz4_size / num / 1024,
+                                                     delta_lz4_size / num / 1024, raw_lz4_size / delta_lz4_size))
+    print('encode {:.2f} ms, decode {:.2f} ms per trajectory'.format(encode_time / num * 1000,
+                                                                      decode_time / num * 1000))
+
+
+if __name__ == '__main__':
+    main()
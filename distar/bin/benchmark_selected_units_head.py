@@ -0,0 +1,90 @@
+import argparse
+import random
+import time
+
+import torch
+
+from distar.ctools.utils import deep_merge_dicts
+from distar.agent.default.model.model import alphastar_model_default_config
+from distar.agent.default.model.head.action_arg_head import SelectedUnitsHead
+from distar.agent.default.lib.features import MAX_ENTITY_NUM, MAX_SELECTED_UNITS_NUM
+
+# (min_len, max_len, prob) of selected units number in one action, 0 means the action selects no unit
+LENGTH_DISTRIBUTIONS = {
+    'realistic': [(0, 0, 0.3), (1, 1, 0.45), (2, 4, 0.12), (5, 12, 0.08), (13, 32, 0.04), (33, 64, 0.01)],
+    'single': [(1, 1, 1.)],
+    'uniform': [(0, MAX_SELECTED_UNITS_NUM, 1.)],
+}
+
+
+class ScriptedSelectedUnitsHead(SelectedUnitsHead):
+    # select end flag after a preset number of units, the row is recognized by its entity_num
+    def reset_script(self, target_len):
+        self.target_len = target_len
+        self.step = 0
+
+    def _get_pred_with_logit(self, logit):
+        valid = logit > -1e8
+        last_valid = valid.shape[1] - 1 - valid.flip(dims=[1]).long().argmax(dim=1)
+        # end flag is masked only at the first selection, it is the last valid column afterwards
+        entity_num = last_valid + 1 if self.step == 0 else last_valid
+        units = valid[:, :-1].long().argmax(dim=1)
+        end = self.target_len[entity_num] <= self.step
+        units[end] = entity_num[end]
+        self.step += 1
+        return units
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--dist', type=str, default='realistic', choices=list(LENGTH_DISTRIBUTIONS.keys()))
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=1)
+    return parser.parse_args()
+
+
+def sample_length(dist):
+    r = random.random()
+    for min_len, max_len, prob in LENGTH_DISTRIBUTIONS[dist]:
+        if r < prob:
+            return random.randint(min_len, max_len)
+        r -= prob
+    return LENGTH_DISTRIBUTIONS[dist][-1][1]
+
+
+def main():
+    args = get_args()
+    torch.set_num_threads(args.threads)
+    random.seed(0)
+    cfg = deep_merge_dicts(alphastar_model_default_config, {})
+    head = ScriptedSelectedUnitsHead(cfg).eval()
+    input_dim = head.cfg.input_dim
+    embedding_dim = head.cfg.entity_embedding_dim
+    print('{:<12}{:>16}{:>16}{:>10}'.format('batch_size', 'full(ms)', 'compact(ms)', 'speedup'))
+    with torch.no_grad():
+        for batch_size in args.batch_size:
+            assert batch_size < MAX_ENTITY_NUM - MAX_SELECTED_UNITS_NUM, 'entity_num identifies the row'
+            cost = {}
+            for compact_rows in [False, True]:
+                head.compact_rows = compact_rows
+                cost[compact_rows] = 0.
+                random.seed(0)
+                for _ in range(args.iters):
+                    target_len = torch.zeros(MAX_ENTITY_NUM + 1, dtype=torch.long)
+                    entity_num = torch.tensor(random.sample(range(MAX_SELECTED_UNITS_NUM + 1, MAX_ENTITY_NUM), batch_size))
+                    for n in entity_num.tolist():
+                        target_len[n] = sample_length(args.dist)
+                    su_mask = target_len[entity_num] > 0
+                    embedding = torch.randn(batch_size, input_dim)
+                    entity_embedding = torch.randn(batch_size, MAX_ENTITY_NUM, embedding_dim)
+                    head.reset_script(target_len)
+                    start_time = time.time()
+                    head(embedding, entity_embedding, entity_num, su_mask=su_mask)
+                    cost[compact_rows] += time.time() - start_time
+            print('{:<12}{:>16.2f}{:>16.2f}{:>10.2f}'.format(batch_size, cost[False] / args.iters * 1000,
+                                                              cost[True] / args.iters * 1000, cost[False] / cost[True]))
+
+
+if __name__ == '__main__':
+    main()
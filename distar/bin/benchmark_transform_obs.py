@@ -0,0 +1,126 @@
+import argparse
+import random
+import time
+
+import torch
+
+from s2clientprotocol import common_pb2 as sc_common
+from s2clientprotocol import raw_pb2 as sc_raw
+from s2clientprotocol import sc2api_pb2 as sc_pb
+
+from distar.pysc2.tests import dummy_observation
+from distar.pysc2.lib.static_data import UNIT_TYPES, BUFFS, ADDON
+from distar.agent.default.lib.actions import UNIT_ABILITY_REORDER, ABILITY_TO_QUEUE_ACTION
+from distar.agent.default.lib.features import Features, SPATIAL_SIZE
+
+HATCHERY = 86
+BORN_LOCATION_TYPES = [59, 18, 86]
+ORDER_IDS = (UNIT_ABILITY_REORDER >= 0).nonzero().squeeze(dim=1).tolist()
+QUEUE_ORDER_IDS = (ABILITY_TO_QUEUE_ACTION > 0).nonzero().squeeze(dim=1).tolist()
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--units', type=int, default=400, help='units per observation')
+    parser.add_argument('--passenger_prob', type=float, default=0.02, help='probability of a unit carrying passengers')
+    parser.add_argument('--num', type=int, default=50, help='number of observations')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+class RawUnit(object):
+    # raw unit for dummy_observation.Builder.feature_units, tag is added by the builder
+
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+
+    def as_dict(self):
+        return self._kwargs
+
+
+def random_unit(unit_type, args, unit_num, alliance=None):
+    orders = []
+    if random.random() < 0.5:
+        orders.append(sc_raw.UnitOrder(ability_id=random.choice(ORDER_IDS), progress=random.random()))
+        orders += [sc_raw.UnitOrder(ability_id=random.choice(QUEUE_ORDER_IDS), progress=random.random())
+                   for _ in range(random.randint(0, 3))]
+    passengers = []
+    if random.random() < args.passenger_prob:
+        passengers = [sc_raw.PassengerUnit(tag=unit_num * 10 + i, unit_type=random.choice(UNIT_TYPES),
+                                           health=random.uniform(0, 100), health_max=100., shield=random.uniform(0, 50),
+                                           shield_max=50., energy=random.uniform(0, 200), energy_max=200.)
+                      for i in range(random.randint(1, 4))]
+    return RawUnit(
+        unit_type=unit_type, alliance=alliance if alliance is not None else random.choice([1, 3, 4]),
+        owner=random.choice([1, 2, 16]),
+        display_type=random.choice([1, 2]), cloak=random.choice([1, 2, 3]), is_blip=random.random() < 0.1,
+        is_powered=random.random() < 0.5, is_active=random.random() < 0.5,
+        is_hallucination=random.random() < 0.05,
+        pos=sc_common.Point(x=random.uniform(0, SPATIAL_SIZE[1] - 1), y=random.uniform(0, SPATIAL_SIZE[0] - 1), z=10.),
+        build_progress=random.random(), health=random.uniform(0, 500), health_max=500.,
+        shield=random.uniform(0, 100), shield_max=100., energy=random.uniform(0, 200), energy_max=200.,
+        mineral_contents=random.randint(0, 1800), vespene_contents=random.randint(0, 2500),
+        cargo_space_taken=random.randint(0, 8), cargo_space_max=8, assigned_harvesters=random.randint(0, 16),
+        weapon_cooldown=random.uniform(0, 20), buff_ids=random.sample(BUFFS, random.randint(0, 2)),
+        add_on_tag=random.randint(1, unit_num) if random.random() < 0.05 else 0,
+        attack_upgrade_level=random.randint(0, 3), armor_upgrade_level=random.randint(0, 3),
+        shield_upgrade_level=random.randint(0, 3), orders=orders, passengers=passengers)
+
+
+def build_obs(args):
+    builder = dummy_observation.Builder({'feature_minimap': (11, SPATIAL_SIZE[0], SPATIAL_SIZE[1])})
+    unit_types = [t for t in UNIT_TYPES if t not in BORN_LOCATION_TYPES]
+    # own hatchery is used as born location
+    units = [random_unit(HATCHERY, args, args.units, alliance=1)]
+    for _ in range(args.units - 1):
+        units.append(random_unit(random.choice(ADDON + unit_types), args, args.units))
+    return builder.feature_units(units).build()
+
+
+def build_game_info():
+    game_info = sc_pb.ResponseGameInfo(map_name='KairosJunction')
+    game_info.start_raw.map_size.x = SPATIAL_SIZE[1]
+    game_info.start_raw.map_size.y = SPATIAL_SIZE[0]
+    game_info.start_raw.start_locations.add(x=100., y=100.)
+    game_info.player_info.add(player_id=1, type=sc_pb.Participant, race_requested=2)
+    game_info.player_info.add(player_id=2, type=sc_pb.Participant, race_requested=2)
+    return game_info
+
+
+def assert_same(a, b, path='obs'):
+    if isinstance(a, torch.Tensor):
+        assert a.dtype == b.dtype and a.shape == b.shape and a.numpy().tobytes() == b.numpy().tobytes(), \
+            '{} differs'.format(path)
+    elif isinstance(a, dict):
+        assert a.keys() == b.keys(), '{} keys differ'.format(path)
+        for k in a.keys():
+            assert_same(a[k], b[k], '{}.{}'.format(path, k))
+    else:
+        assert a == b, '{} differs'.format(path)
+
+
+def main():
+    args = get_args()
+    random.seed(args.seed)
+    torch.set_num_threads(1)
+    game_info = build_game_info()
+    observations = [(build_obs(args), build_obs(args)) for _ in range(args.num)]
+    features = {}
+    for columnar in [False, True]:
+        features[columnar] = Features(game_info, observations[0][0], {'feature': {'columnar_entity_info': columnar}})
+    cost = {False: 0., True: 0.}
+    for obs, opponent_obs in observations:
+        output = {}
+        for columnar, feature in features.items():
+            start_time = time.time()
+            output[columnar] = feature.transform_obs(obs, padding_spatial=True, opponent_obs=opponent_obs)
+            cost[columnar] += time.time() - start_time
+        assert_same(output[False], output[True])
+    print('{} observations with {} units, outputs are identical'.format(args.num, args.units))
+    print('row {:.2f} ms, columnar {:.2f} ms, speedup {:.2f}'.format(cost[False] / args.num * 1000,
+                                                                     cost[True] / args.num * 1000,
+                                                                     cost[False] / cost[True]))
+
+
+if __name__ == '__main__':
+    main()
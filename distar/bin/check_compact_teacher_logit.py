@@ -0,0 +1,93 @@
+import argparse
+import os
+import sys
+
+import torch
+import torch.nn.functional as F
+
+from distar.ctools.utils import read_config
+from distar.ctools.utils.file_helper import dumps
+from distar.agent.default.model.model import Model
+from distar.agent.default.lib.features import fake_step_data
+from distar.agent.default.lib.compact_logit import compact_logit, expand_logit
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default=None, help='model path, random initialized model if not given')
+    parser.add_argument('--data', type=str, default=None,
+                        help='torch.save file of a list of recorded model inputs (the batch size 1 dicts passed to '
+                             'compute_logp_action in Agent.step), fake observations are used if not given')
+    parser.add_argument('--num', type=int, default=32, help='number of fake observations')
+    parser.add_argument('--topk', type=int, default=64, help='actor.compact_teacher_logit_topk')
+    parser.add_argument('--noise', type=float, default=0.01,
+                        help='std of noise added to teacher parameters to get the learner model')
+    parser.add_argument('--bound', type=float, default=1e-2, help='max kl loss error of each head')
+    return parser.parse_args()
+
+
+def kl_divergence(teacher_logit, logit):
+    # same as kl_loss in rl_training, teacher probability weighted
+    teacher_logp = F.log_softmax(teacher_logit.float(), dim=-1)
+    logp = F.log_softmax(logit.float(), dim=-1)
+    return (teacher_logp.exp() * (teacher_logp - logp)).sum(dim=-1).mean().item()
+
+
+def main():
+    args = get_args()
+    torch.set_num_threads(1)
+    cfg = read_config(os.path.join(os.path.dirname(__file__), 'user_config.yaml'))
+    teacher = Model(cfg).eval()
+    if args.model is not None:
+        state_dict = torch.load(args.model, map_location='cpu')
+        teacher.load_state_dict({k: v for k, v in state_dict['model'].items() if 'value_networks' not in k},
+                                strict=False)
+    learner = Model(cfg).eval()
+    learner.load_state_dict(teacher.state_dict())
+    with torch.no_grad():
+        for p in learner.parameters():
+            p.add_(torch.randn_like(p) * args.noise)
+    hidden_size = teacher.cfg.encoder.core_lstm.hidden_size
+    num_layers = teacher.cfg.encoder.core_lstm.num_layers
+    if args.data is not None:
+        samples = torch.load(args.data)
+    else:
+        print('no recorded observations given, use fake observations')
+        samples = [fake_step_data(batch_size=1, hidden_size=hidden_size, hidden_layer=num_layers, train=False)
+                   for _ in range(args.num)]
+
+    full_kl, kl_error, teacher_kl = {}, {}, {}
+    full_size, compact_size = 0, 0
+    with torch.no_grad():
+        for sample in samples:
+            output = teacher.compute_logp_action(**sample)
+            teacher_input = dict(sample)
+            teacher_input['action_info'] = output['action_info']
+            teacher_input['selected_units_num'] = output['selected_units_num']
+            teacher_logit = teacher.compute_teacher_logit(**teacher_input)['logit']
+            learner_logit = learner.compute_teacher_logit(**teacher_input)['logit']
+            compact = compact_logit(teacher_logit, args.topk)
+            expanded = expand_logit(compact)
+            full_size += len(dumps(teacher_logit, fs_type='nppickle', compress=False))
+            compact_size += len(dumps(compact, fs_type='nppickle', compress=False))
+            for k, v in teacher_logit.items():
+                kl = kl_divergence(v, learner_logit[k])
+                full_kl[k] = full_kl.get(k, 0.) + kl
+                kl_error[k] = max(kl_error.get(k, 0.), abs(kl_divergence(expanded[k], learner_logit[k]) - kl))
+                teacher_kl[k] = max(teacher_kl.get(k, 0.), kl_divergence(v, expanded[k]))
+
+    num = len(samples)
+    print('{:<20}{:>14}{:>18}{:>18}'.format('head', 'kl loss', 'max kl error', 'max kl(full|compact)'))
+    for k in full_kl.keys():
+        print('{:<20}{:>14.2e}{:>18.2e}{:>18.2e}'.format(k, full_kl[k] / num, kl_error[k], teacher_kl[k]))
+    print('teacher logit size: {:.1f} KB -> {:.1f} KB per step'.format(full_size / num / 1024,
+                                                                       compact_size / num / 1024))
+    failed = [k for k, v in kl_error.items() if v > args.bound]
+    if failed:
+        print('[ERROR] kl loss error of {} exceeds bound {}'.format(failed, args.bound))
+        sys.exit(1)
+    print('kl loss error of all heads within bound {}'.format(args.bound))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import threading
+import time
+
+import numpy as np
+import portpicker
+import torch
+from easydict import EasyDict
+
+from distar.ctools.worker.coordinator.adapter import Adapter
+from distar.ctools.worker.coordinator.coordinator import Coordinator, create_coordinator_app, KeepAliveRequestHandler
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num', type=int, default=50, help='trajectories pushed through each transport')
+    parser.add_argument('--size', type=int, default=4, help='MB of every trajectory')
+    parser.add_argument('--slot_size', type=int, default=32, help='MB of a shared memory slot')
+    parser.add_argument('--slot_num', type=int, default=4)
+    return parser.parse_args()
+
+
+def make_cfg(port, args, local_transport):
+    return EasyDict({'communication': {
+        'coordinator_ip': '127.0.0.1',
+        'coordinator_port': port,
+        'local_transport': local_transport,
+        'local_transport_slot_size': args.slot_size,
+        'local_transport_slot_num': args.slot_num,
+    }})
+
+
+def fake_traj(i, size):
+    return {'step': torch.tensor(i), 'obs': torch.rand(size << 18), 'action': torch.randint(0, 100, (64, 16))}
+
+
+def run(cfg, args):
+    pusher, puller = Adapter(cfg=cfg, maxlen=3), Adapter(cfg=cfg)
+    cost = []
+    for i in range(args.num):
+        traj = fake_traj(i, args.size)
+        t = time.time()
+        pusher.push(traj, token='traj', fs_type='nppickle')
+        data = puller.pull(token='traj', fs_type='nppickle', sleep_time=0.01)
+        cost.append(time.time() - t)
+        for k, v in traj.items():
+            assert torch.equal(v, data[k]), 'trajectory {} differs at {}'.format(i, k)
+    # releases are sent without reply
+    time.sleep(0.5)
+    if pusher._ring is not None:
+        assert len(pusher._ring._free) == args.slot_num, 'shared memory slots are not released'
+        check_put_back(pusher, args)
+    return cost
+
+
+def check_put_back(pusher, args):
+    # a message handed back to a full cache drops the newest one, whose slot has to be freed
+    for i in range(3):
+        pusher.push(fake_traj(i, 1), token='put_back', fs_type='nppickle')
+    msg_id, message = pusher._cache_data['put_back'][0]
+    descriptor = pusher._take('put_back', msg_id, slots=True)
+    free_num = len(pusher._ring._free)
+    pusher.push(fake_traj(3, 1), token='put_back', fs_type='nppickle')
+    assert len(pusher._ring._free) == free_num - 1
+    pusher._put_back('put_back', msg_id, descriptor)
+    assert pusher.length('put_back') == 3
+    assert len(pusher._ring._free) == free_num, 'slot of the message dropped by put back is not freed'
+
+
+def main():
+    args = get_args()
+    port = portpicker.pick_unused_port()
+    coordinator_app = create_coordinator_app(Coordinator(make_cfg(port, args, True)))
+    threading.Thread(target=coordinator_app.run, kwargs={
+        'host': '127.0.0.1', 'port': port, 'debug': False, 'use_reloader': False,
+        'request_handler': KeepAliveRequestHandler}, daemon=True).start()
+    time.sleep(1)
+    for name, local_transport in [('local', True), ('tcp', False)]:
+        cost = run(make_cfg(port, args, local_transport), args)
+        print('{:>5}: {} trajectories of {} MB, push to pull mean {:.2f} ms, p50 {:.2f} ms'.format(
+            name, args.num, args.size, np.mean(cost) * 1000, np.percentile(cost, 50) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import os
+import signal
+import time
+
+import torch
+from easydict import EasyDict
+
+from distar.envs.vector_env import VectorSC2Env
+from distar.agent.default.lib.features import Features
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--env_num', type=int, default=4)
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--game_loops', type=int, default=400, help='game loops of every fake game')
+    parser.add_argument('--kill_step', type=int, default=50, help='kill the worker of env 0 at this step')
+    return parser.parse_args()
+
+
+def make_cfg(args):
+    return EasyDict({
+        'actor': {'job_type': 'train'},
+        'env': {
+            'map_name': 'KairosJunction',
+            'player_ids': ['agent1', 'agent2'],
+            'races': ['zerg', 'zerg'],
+            'map_size_resolutions': [True, True],
+            'minimap_resolutions': [[160, 152], [160, 152]],
+            'realtime': False,
+            'random_seed': 'none',
+            'save_replay_episodes': 0,
+            'random_delay_weights': [1],
+            'fake_sc2': {'game_loops': args.game_loops},
+        },
+    })
+
+
+def assert_same(a, b, path):
+    if isinstance(a, torch.Tensor):
+        assert torch.equal(a, b.to(a.dtype)), '{} differs'.format(path)
+    else:
+        for k in a.keys():
+            if k in b:
+                assert_same(a[k], b[k], '{}.{}'.format(path, k))
+
+
+def main():
+    args = get_args()
+    cfg = make_cfg(args)
+    envs = VectorSC2Env(cfg, args.env_num)
+    features = {}
+
+    def check(infos):
+        for env_idx, info in enumerate(infos):
+            if info['reset'] is not None:
+                for side in range(envs.num_agents):
+                    features[env_idx, side] = Features(info['reset']['game_info'][side],
+                                                       info['obs'][side]['raw_obs'], cfg)
+            for side, obs in info['obs'].items():
+                expected = features[env_idx, side].transform_obs(obs['raw_obs'], padding_spatial=True)
+                expected.pop('game_info')
+                assert_same(expected, obs['agent_obs'], 'env {} side {}'.format(env_idx, side))
+
+    _, _, infos = envs.reset()
+    check(infos)
+    no_op = [{'func_id': 0, 'skip_steps': 8}]
+    games, crashes = 0, 0
+    start_time = time.time()
+    for step in range(args.steps):
+        if step == args.kill_step:
+            os.kill(envs._processes[0].pid, signal.SIGKILL)
+        envs.step_async([{side: no_op for side in infos[env_idx]['obs'].keys()} for env_idx in range(args.env_num)])
+        _, dones, infos = envs.step_wait()
+        games += sum(1 for info in infos if info['reset'] is not None)
+        crashes += sum(1 for info in infos if info['crashed'])
+        check(infos)
+    duration = time.time() - start_time
+    envs.close()
+    assert crashes == 1, 'killed worker should be reported once'
+    assert games >= args.env_num, 'envs should reset themselves after a game ends'
+    print('{} envs, {} steps, {:.1f} steps/s, {} new games, {} crashes, observations match Features'.format(
+        args.env_num, args.steps, args.steps * args.env_num / duration, games, crashes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import argparse
+import time
+
+from easydict import EasyDict
+
+from distar.envs.env import SC2Env
+from distar.envs.fake_sc2 import FakeSC2Process
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--episodes', type=int, default=12)
+    parser.add_argument('--launch_time', type=float, default=1., help='seconds to launch a fake SC2 process')
+    parser.add_argument('--join_time', type=float, default=0.5, help='seconds to join a fake game')
+    parser.add_argument('--episode_time', type=float, default=4., help='seconds of every fake episode')
+    parser.add_argument('--recycle_games', type=int, default=3)
+    parser.add_argument('--kill_episode', type=int, default=6, help='kill the standby SC2 during this episode')
+    return parser.parse_args()
+
+
+def make_env(args, warm_pool):
+    steps = 20
+    cfg = EasyDict({
+        'actor': {'job_type': 'train'},
+        'env': {
+            'map_name': 'KairosJunction',
+            'player_ids': ['agent1', 'agent2'],
+            'races': ['zerg', 'zerg'],
+            'map_size_resolutions': [True, True],
+            'minimap_resolutions': [[160, 152], [160, 152]],
+            'realtime': False,
+            'random_seed': 'none',
+            'save_replay_episodes': 0,
+            'random_delay_weights': [1],
+            'recycle_games': args.recycle_games,
+            'warm_pool': warm_pool,
+            'fake_sc2': {'launch_time': args.launch_time, 'join_time': args.join_time,
+                         'step_time': args.episode_time / steps, 'game_loops': steps * 8},
+        },
+    })
+    return SC2Env(cfg)
+
+
+def run(args, warm_pool):
+    env = make_env(args, warm_pool)
+    launches = FakeSC2Process.count
+    reset_time, total_start = 0., time.time()
+    for episode in range(args.episodes):
+        start_time = time.time()
+        env.reset()
+        reset_time += time.time() - start_time
+        assert env._slot_games <= args.recycle_games, 'SC2 processes should be recycled after recycle_games games'
+        if warm_pool and episode == args.kill_episode:
+            # the standby of a healthy pool is ready long before the episode ends
+            time.sleep(args.launch_time + args.join_time + 0.5)
+            slot, _ = env._warm_pool._standby.result()
+            for p in slot['procs']:
+                p.kill()
+        no_op = [{'func_id': 0, 'skip_steps': 8}]
+        done = False
+        while not done:
+            _, _, done = env.step({0: no_op, 1: no_op})
+    total_time = time.time() - total_start
+    env.close()
+    launches = FakeSC2Process.count - launches
+    print('warm_pool={}: {} episodes, reset {:.3f} s per episode, total {:.1f} s, {} SC2 launches'.format(
+        warm_pool, args.episodes, reset_time / args.episodes, total_time, launches))
+    return reset_time / args.episodes, launches
+
+
+def main():
+    args = get_args()
+    cold_reset, _ = run(args, False)
+    warm_reset, _ = run(args, True)
+    assert warm_reset < cold_reset, 'warm pool reset should be faster'
+    print('reset speedup {:.1f}'.format(cold_reset / warm_reset))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+import argparse
+import json
+import os
+import time
+
+from distar.agent.default.lib.z_library import compile_z_library, ZLibrary
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, required=True, help='Z json, e.g. distar/agent/default/lib/3map.json')
+    parser.add_argument('--output', type=str, default=None, help='Z library file, input with .zlib suffix if not given')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    output = args.output if args.output is not None else os.path.splitext(args.input)[0] + '.zlib'
+    start_time = time.time()
+    with open(args.input, 'r') as f:
+        z_data = json.load(f)
+    json_time = time.time() - start_time
+    num = compile_z_library(z_data, output)
+
+    start_time = time.time()
+    z_library = ZLibrary(output)
+    open_time = time.time() - start_time
+    for map_name, races in z_data.items():
+        for race, born_locations in races.items():
+            for born_location, zs in born_locations.items():
+                assert z_library.count(map_name, race, born_location) == len(zs)
+                for idx, z in enumerate(zs):
+                    assert z_library.get(map_name, race, born_location, idx) == z, \
+                        'Z differs after conversion, map: {}, race: {}, born location: {}, idx: {}'.format(
+                            map_name, race, born_location, idx)
+    start_time = time.time()
+    for _ in range(1000):
+        z_library.sample(map_name, race, born_location)
+    sample_time = (time.time() - start_time) / 1000
+    print('converted {} Z to {}, {:.1f} KB -> {:.1f} KB'.format(num, output, os.path.getsize(args.input) / 1024,
+                                                                 os.path.getsize(output) / 1024))
+    print('json load {:.2f} ms, library open {:.2f} ms, sample {:.3f} ms'.format(json_time * 1000, open_time * 1000,
+                                                                                  sample_time * 1000))
+    print('set agent.z_path to {} to use it'.format(os.path.basename(output)))
+
+
+if __name__ == '__main__':
+    main()
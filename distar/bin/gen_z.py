@@ -9,12 +9,14 @@ import mpyq
 import argparse
 import six
 import json
+import queue
 
 from collections import defaultdict
 
 from distar.pysc2 import run_configs
 from distar.pysc2.lib import point
-from distar.agent.default.lib.features import Features
+from distar.agent.default.lib.features import Features, build_tag_index
+from distar.agent.default.lib.z_library import compile_z_library
 
 from distar.envs.map_info import get_map_size, LOCALIZED_BNET_NAME_TO_NAME_LUT
 from distar.pysc2.lib.actions import RAW_FUNCTIONS
@@ -46,36 +48,79 @@ BUILD2VERSION = {
 }
 
 
-def result_loop(result_queue, path_queue, output_file):
-    result = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
-    cnt = 0
-    while True:
-        if result_queue.empty():
-            time.sleep(0.01)
-            continue
-        data = result_queue.get()
-        if data is None:
-            continue
-        if data == 'done':
-            print(f'done {cnt}, left: {path_queue.qsize() * 2}')
-            with open(output_file, 'w') as f:
-                json.dump(result, f)
-            return
-        map_name, beginning_order, cumulative_stat, bo_location, born_location, race, loop = data
-        result[map_name][race][born_location].append([beginning_order, cumulative_stat, bo_location, loop])
-        cnt += 1
-        if cnt % 10 == 0:
-            print(f'done {cnt}, left: {path_queue.qsize() * 2}')
-            with open(output_file, 'w') as f:
-                json.dump(result, f)
-
-
-def worker_loop(path_queue, result_queue):
+class ZRecordStore:
+    r"""
+    Overview:
+        Append-only store of decoded replays, one json line per (replay path, player index) in files of a directory.
+        Every worker process appends to its own new file, lines are flushed to disk once written so that a crash
+        loses at most the replay being decoded. Replays without Z are recorded with null Z so that they are skipped
+        when resuming. Reading only consumes complete lines added since last read.
+    Interface:
+        __init__, open_writer, append, update, compact
+    """
+
+    def __init__(self, path):
+        self._path = path
+        os.makedirs(path, exist_ok=True)
+        self._offsets = {}
+        self._result = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+        self.done = set()
+        self.num = 0
+
+    @staticmethod
+    def open_writer(path):
+        return open(os.path.join(path, 'records_{}_{}.jsonl'.format(os.getpid(), time.time())), 'ab')
+
+    @staticmethod
+    def append(writer, path, player_index, data):
+        writer.write((json.dumps({'path': path, 'player_index': player_index, 'z': data}) + '\n').encode('utf-8'))
+        writer.flush()
+        os.fsync(writer.fileno())
+
+    def update(self):
+        for name in sorted(os.listdir(self._path)):
+            if not name.endswith('.jsonl'):
+                continue
+            # binary, so offsets are bytes of the file on every platform
+            with open(os.path.join(self._path, name), 'rb') as f:
+                f.seek(self._offsets.get(name, 0))
+                lines = f.read().split(b'\n')
+            # last piece is empty or a line still being written
+            self._offsets[name] = self._offsets.get(name, 0) + sum([len(l) + 1 for l in lines[:-1]])
+            for line in lines[:-1]:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    print(f'[WARNING] broken record in {name} skipped')
+                    continue
+                self.done.add((record['path'], record['player_index']))
+                if record['z'] is not None:
+                    map_name, beginning_order, cumulative_stat, bo_location, born_location, race, loop = record['z']
+                    self._result[map_name][race][born_location].append([beginning_order, cumulative_stat,
+                                                                        bo_location, loop])
+                    self.num += 1
+
+    def compact(self, output_file, library=False):
+        # files are replaced after fully written, readers never see a partial Z file
+        with open(output_file + '.tmp', 'w') as f:
+            json.dump(self._result, f)
+        os.replace(output_file + '.tmp', output_file)
+        if library:
+            library_file = os.path.splitext(output_file)[0] + '.zlib'
+            compile_z_library(self._result, library_file + '.tmp')
+            os.replace(library_file + '.tmp', library_file)
+
+
+def worker_loop(path_queue, record_path):
     decoder = ReplayDecoder({})
-    while not path_queue.empty():
-        path = path_queue.get()
-        for player_index in range(2):
-            result_queue.put(decoder.run(path, player_index))
+    writer = ZRecordStore.open_writer(record_path)
+    while True:
+        try:
+            path, player_index = path_queue.get(timeout=1)
+        except queue.Empty:
+            break
+        ZRecordStore.append(writer, path, player_index, decoder.run(path, player_index))
+    writer.close()
 
 
 class FilterActions:
@@ -122,19 +167,19 @@ class FilterActions:
             if a_id in self.morph_abilities:
                 unit_tags = self.gen_unit_tags(actions[0])
                 pre_unit_types = [u.unit_type for u in pre_obs.units]
-                pre_unit_tags = [u.tag for u in pre_obs.units]
+                pre_unit_tags = build_tag_index([u.tag for u in pre_obs.units])
                 post_unit_types = [u.unit_type for u in post_obs.units]
-                post_unit_tags = [u.tag for u in post_obs.units]
+                post_unit_tags = build_tag_index([u.tag for u in post_obs.units])
                 for t in unit_tags:
                     try:
-                        pre_unit_index = pre_unit_tags.index(t)
-                    except ValueError:
+                        pre_unit_index = pre_unit_tags[t]
+                    except KeyError:
                         # print('not found')
                         action_count += 1
                         continue
                     try:
-                        post_unit_index = post_unit_tags.index(t)
-                    except ValueError:
+                        post_unit_index = post_unit_tags[t]
+                    except KeyError:
                         # print('not found')
                         action_count += 1
                         continue
@@ -151,12 +196,12 @@ class FilterActions:
             elif a_id in self.corrosivebile:
                 unit_tags = self.gen_unit_tags(actions[0])
                 pre_unit_types = [u.unit_type for u in pre_obs.units]
-                pre_unit_tags = [u.tag for u in pre_obs.units]
+                pre_unit_tags = build_tag_index([u.tag for u in pre_obs.units])
                 action_count = 0
                 for t in unit_tags:
                     try:
-                        pre_unit_index = pre_unit_tags.index(t)
-                    except ValueError:
+                        pre_unit_index = pre_unit_tags[t]
+                    except KeyError:
                         # print('not found')
                         action_count += 1
                         continue
@@ -167,21 +212,21 @@ class FilterActions:
             elif a_id in self.train_abilities:
                 unit_tags = self.gen_unit_tags(actions[0])
                 pre_unit_orders = [len(u.orders) for u in pre_obs.units]
-                pre_unit_tags = [u.tag for u in pre_obs.units]
+                pre_unit_tags = build_tag_index([u.tag for u in pre_obs.units])
                 post_unit_orders = [len(u.orders) for u in post_obs.units]
-                post_unit_tags = [u.tag for u in post_obs.units]
+                post_unit_tags = build_tag_index([u.tag for u in post_obs.units])
                 pre_order_len = 0
                 post_order_len = 0
                 for t in unit_tags:
                     try:
-                        pre_unit_index = pre_unit_tags.index(t)
-                    except ValueError:
+                        pre_unit_index = pre_unit_tags[t]
+                    except KeyError:
                         # print('not found')
                         return actions
                     pre_order_len += pre_unit_orders[pre_unit_index]
                     try:
-                        post_unit_index = post_unit_tags.index(t)
-                    except ValueError:
+                        post_unit_index = post_unit_tags[t]
+                    except KeyError:
                         # print('not found')
                         return actions
                     post_order_len += post_unit_orders[post_unit_index]
@@ -378,6 +423,8 @@ if __name__ == '__main__':
     parser.add_argument("--data", required=True, help='replay directory or file with replay paths')
     parser.add_argument("--name", required=True, help='output file name')
     parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--compact_interval", type=int, default=300,
+                        help='seconds between rewrites of the Z file from records')
     args = parser.parse_args()
 
     run_config = run_configs.get('4.10.0')
@@ -386,27 +433,39 @@ if __name__ == '__main__':
     output_file = os.path.join(os.path.dirname(__file__), '../agent/default/lib','{}.json'.format(args.name))
     print('Z file will be saved at {}\n'.format(os.path.abspath(output_file)))
 
+    # decoded replays are recorded here, replays already recorded by an interrupted run are skipped
+    record_path = os.path.splitext(output_file)[0] + '_records'
+    store = ZRecordStore(record_path)
+    store.update()
     path_queue = multiprocessing.Queue()
-    result_queue = multiprocessing.Queue()
     data_path = []
     if os.path.isfile(replay_path):
         with open(replay_path, 'r') as f:
             for l in f.readlines():
-                path_queue.put(l.strip())
+                data_path.append(l.strip())
     elif os.path.isdir(replay_path):
         for p in os.listdir(replay_path):
-            path_queue.put(os.path.join(replay_path, p))
+            data_path.append(os.path.join(replay_path, p))
+    todo = [(p, player_index) for p in data_path for player_index in range(2) if (p, player_index) not in store.done]
+    print('{} replays recorded, {} left'.format(len(store.done), len(todo)))
+    for item in todo:
+        path_queue.put(item)
 
-    result_loop_process = multiprocessing.Process(target=result_loop, args=(result_queue, path_queue, output_file), daemon=True, )
-    result_loop_process.start()
     procs = []
     for i in range(num_procs):
-        p = multiprocessing.Process(target=worker_loop, args=(path_queue, result_queue), daemon=True)
+        p = multiprocessing.Process(target=worker_loop, args=(path_queue, record_path), daemon=True)
         p.start()
         procs.append(p)
+    last_compact_time = time.time()
+    while any([p.is_alive() for p in procs]):
+        time.sleep(1)
+        if time.time() - last_compact_time > args.compact_interval:
+            store.update()
+            store.compact(output_file)
+            last_compact_time = time.time()
+            print(f'done {store.num}, left: {path_queue.qsize()}')
     for p in procs:
         p.join()
-    result_queue.put('done')
-    result_loop_process.join()
-
-
+    store.update()
+    store.compact(output_file, library=True)
+    print(f'done {store.num}, Z library saved at {os.path.splitext(output_file)[0]}.zlib')
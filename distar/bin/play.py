@@ -20,6 +20,7 @@ def get_args():
                         help='must specify model path'
                         )
     parser.add_argument('--cpu', action="store_true", help='use cpu inference')
+    parser.add_argument('--quantize', action="store_true", help='use int8 quantized model in cpu inference')
     parser.add_argument('--game_type', type=str, default='human_vs_agent')
     return parser.parse_args()
 
@@ -70,6 +71,8 @@ if __name__ == '__main__':
     else:
         user_config.actor.use_cuda = False
         print('warning! cuda is not activate, this will cause significant agent performance degradation!')
+        if args.quantize:
+            user_config.actor.quantized_inference = True
     assert args.game_type in ['agent_vs_agent', 'agent_vs_bot', 'human_vs_agent'], 'game_type only support agent_vs_agent or agent_vs_bot or human_vs_agent!'
     if args.game_type == 'agent_vs_agent':
         user_config.env.player_ids = [os.path.basename(model1).split('.')[0], os.path.basename(model2).split('.')[0]]
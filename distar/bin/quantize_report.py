@@ -0,0 +1,82 @@
+import argparse
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+
+from distar.ctools.utils import read_config
+from distar.agent.default.model.model import Model
+from distar.agent.default.model.quantize import quantize_model
+from distar.agent.default.lib.features import fake_step_data
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default=None, help='model path, random initialized model if not given')
+    parser.add_argument('--data', type=str, default=None,
+                        help='torch.save file of a list of recorded model inputs (the batch size 1 dicts passed to '
+                             'compute_logp_action in Agent.step), fake observations are used if not given')
+    parser.add_argument('--num', type=int, default=32, help='number of fake observations')
+    parser.add_argument('--threads', type=int, default=1, help='torch intra-op threads, actor env processes use 1')
+    return parser.parse_args()
+
+
+def kl_divergence(ref_logit, logit):
+    ref_logp = F.log_softmax(ref_logit.float(), dim=-1)
+    logp = F.log_softmax(logit.float(), dim=-1)
+    return (ref_logp.exp() * (ref_logp - logp)).sum(dim=-1).mean().item()
+
+
+def main():
+    args = get_args()
+    torch.set_num_threads(args.threads)
+    cfg = read_config(os.path.join(os.path.dirname(__file__), 'user_config.yaml'))
+    model = Model(cfg).eval()
+    if args.model is not None:
+        state_dict = torch.load(args.model, map_location='cpu')
+        model.load_state_dict({k: v for k, v in state_dict['model'].items() if 'value_networks' not in k}, strict=False)
+    hidden_size = model.cfg.encoder.core_lstm.hidden_size
+    num_layers = model.cfg.encoder.core_lstm.num_layers
+    if args.data is not None:
+        samples = torch.load(args.data)
+    else:
+        print('no recorded observations given, use fake observations, kl only checks numerics')
+        samples = [fake_step_data(batch_size=1, hidden_size=hidden_size, hidden_layer=num_layers, train=False)
+                   for _ in range(args.num)]
+
+    variants = [('fp32', model), ('int8', quantize_model(model)), ('int8+bf16conv', quantize_model(model, conv_bf16=True))]
+    step_time = {name: 0. for name, _ in variants}
+    kl = {name: {} for name, _ in variants}
+    action_type_match = {name: 0 for name, _ in variants}
+    with torch.no_grad():
+        for sample in samples:
+            ref_output = model.compute_logp_action(**sample)
+            teacher_input = dict(sample)
+            teacher_input['action_info'] = ref_output['action_info']
+            teacher_input['selected_units_num'] = ref_output['selected_units_num']
+            ref_logit = model.compute_teacher_logit(**teacher_input)['logit']
+            for name, variant in variants:
+                start_time = time.time()
+                output = variant.compute_logp_action(**sample)
+                step_time[name] += time.time() - start_time
+                action_type_match[name] += int((output['action_info']['action_type'] ==
+                                                ref_output['action_info']['action_type']).all().item())
+                # teacher forcing fp32 actions so that autoregressive heads are compared on the same inputs
+                logit = variant.compute_teacher_logit(**teacher_input)['logit']
+                for k, v in logit.items():
+                    kl[name][k] = kl[name].get(k, 0.) + kl_divergence(ref_logit[k], v)
+
+    num = len(samples)
+    heads = list(ref_logit.keys())
+    print('{:<16}{:>12}{:>10}{:>14}'.format('model', 'ms/step', 'speedup', 'action_type') +
+          ''.join(['{:>16}'.format('kl/' + k) for k in heads]))
+    for name, _ in variants:
+        print('{:<16}{:>12.2f}{:>10.2f}{:>14.3f}'.format(name, step_time[name] / num * 1000,
+                                                         step_time['fp32'] / step_time[name],
+                                                         action_type_match[name] / num) +
+              ''.join(['{:>16.2e}'.format(kl[name].get(k, 0.) / num) for k in heads]))
+
+
+if __name__ == '__main__':
+    main()
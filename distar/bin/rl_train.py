@@ -10,7 +10,7 @@ from distar.ctools.utils import read_config
 from distar.actor import Actor
 from distar.agent.import_helper import import_module
 
-from distar.ctools.worker.coordinator.coordinator import Coordinator, create_coordinator_app
+from distar.ctools.worker.coordinator.coordinator import Coordinator, create_coordinator_app, KeepAliveRequestHandler
 from distar.ctools.worker.league.league import League
 from distar.ctools.worker.league.league_api import create_league_app
 import time
@@ -56,6 +56,8 @@ def actor_run(config, args):
         config.actor.gpu_batch_inference = True
     else:
         config.actor.gpu_batch_inference = False
+    if args.cpu_batch_inference == 'true':
+        config.actor.cpu_batch_inference = True
     if config.actor.job_type == 'train':
         exp_name = config.common.experiment_name
         replay_path = os.path.abspath(config.env.replay_dir)
@@ -100,7 +102,7 @@ def coordinator_run(config, args):
     coordinator = Coordinator(config)
     coordinator_app = create_coordinator_app(coordinator)
     coordinator_app.run(host=config.communication.coordinator_ip, port=config.communication.coordinator_port,
-                        debug=False, use_reloader=False)
+                        debug=False, use_reloader=False, request_handler=KeepAliveRequestHandler)
 
 
 if __name__ == '__main__':
@@ -121,6 +123,7 @@ if __name__ == '__main__':
     parser.add_argument("--task", default='bot')
     parser.add_argument("--player_id", default='MP0')
     parser.add_argument("--gpu_batch_inference", default='false')
+    parser.add_argument("--cpu_batch_inference", default='false')
     parser.add_argument("--init_method", type=str, default=None)
     parser.add_argument("--rank", type=int, default=0)
     parser.add_argument("--world_size", type=int, default=1)
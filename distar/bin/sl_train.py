@@ -4,7 +4,7 @@ from distar.agent.import_helper import import_module
 import argparse
 from distar.ctools.utils import read_config
 from distar.ctools.worker.actor.replay_actor import ReplayActor
-from distar.ctools.worker.coordinator.coordinator import Coordinator, create_coordinator_app
+from distar.ctools.worker.coordinator.coordinator import Coordinator, create_coordinator_app, KeepAliveRequestHandler
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="sl_train")
@@ -42,7 +42,8 @@ if __name__ == '__main__':
     elif args.type == 'coordinator':
         coordinator = Coordinator(config)
         coordinator_app = create_coordinator_app(coordinator)
-        coordinator_app.run(host=config.communication.coordinator_ip, port=config.communication.coordinator_port, debug=False, use_reloader=False)
+        coordinator_app.run(host=config.communication.coordinator_ip, port=config.communication.coordinator_port, debug=False, use_reloader=False,
+                            request_handler=KeepAliveRequestHandler)
     elif args.type == 'replay_actor':
         ReplayDecoder = import_module(config.learner.agent, 'ReplayDecoder')
         replay_decoder = ReplayDecoder(config)
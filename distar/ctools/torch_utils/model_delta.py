@@ -0,0 +1,49 @@
+import torch
+
+
+def make_model_delta(state_dict, keyframe, fp16=True, threshold=0.):
+    r"""
+    Overview:
+        compute the difference between a state_dict and a keyframe state_dict with the same keys, tensors which are
+        not changed are skipped
+    Arguments:
+        - state_dict (:obj:`dict`): current state_dict
+        - keyframe (:obj:`dict`): state_dict the delta is computed against
+        - fp16 (:obj:`bool`): send floating point delta in half precision
+        - threshold (:obj:`float`): floating point delta whose absolute value is below threshold is set to 0
+    Returns:
+        - delta (:obj:`dict`): 'model_delta' holds floating point differences, 'model' holds other changed tensors
+    """
+    model_delta, model = {}, {}
+    for k, v in state_dict.items():
+        if torch.equal(v, keyframe[k]):
+            continue
+        if v.is_floating_point():
+            d = v - keyframe[k]
+            if threshold > 0:
+                d[d.abs() < threshold] = 0
+            model_delta[k] = d.half() if fp16 else d
+        else:
+            model[k] = v.clone()
+    return {'model_delta': model_delta, 'model': model}
+
+
+def apply_model_delta(keyframe, delta):
+    r"""
+    Overview:
+        rebuild a state_dict from a keyframe state_dict and the delta of make_model_delta, keyframe is not modified
+    Arguments:
+        - keyframe (:obj:`dict`): state_dict the delta is computed against
+        - delta (:obj:`dict`): output of make_model_delta
+    Returns:
+        - state_dict (:obj:`dict`): rebuilt state_dict
+    """
+    state_dict = {}
+    for k, v in keyframe.items():
+        if k in delta['model_delta']:
+            state_dict[k] = v + delta['model_delta'][k].to(v.dtype)
+        elif k in delta['model']:
+            state_dict[k] = delta['model'][k]
+        else:
+            state_dict[k] = v
+    return state_dict
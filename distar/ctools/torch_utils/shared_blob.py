@@ -0,0 +1,45 @@
+import time
+
+import numpy as np
+import torch
+
+
+class SharedBlob(object):
+    r"""
+    Overview:
+        Bytes in shared memory written by one process and read by many. The version counter is odd while the bytes
+        are being written, readers retry until they copy the bytes under the same even version.
+    Interface:
+        __init__, write, read, version, capacity
+    """
+
+    def __init__(self, capacity):
+        self._data = torch.zeros(capacity, dtype=torch.uint8).share_memory_()
+        self._length = torch.zeros(1, dtype=torch.long).share_memory_()
+        self._version = torch.zeros(1, dtype=torch.long).share_memory_()
+
+    @property
+    def version(self):
+        return self._version.item()
+
+    @property
+    def capacity(self):
+        return self._data.shape[0]
+
+    def write(self, data):
+        if len(data) > self.capacity:
+            # readers in other processes map this buffer, it can not grow
+            raise ValueError('SharedBlob data size {} exceeds capacity {}'.format(len(data), self.capacity))
+        self._version += 1
+        self._data.numpy()[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+        self._length.fill_(len(data))
+        self._version += 1
+
+    def read(self):
+        while True:
+            version = self.version
+            if version % 2 == 0:
+                data = self._data.numpy()[:self._length.item()].tobytes()
+                if self.version == version:
+                    return version, data
+            time.sleep(0.001)
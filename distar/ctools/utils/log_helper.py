@@ -606,6 +606,74 @@ class EmaMeter(object):
         raise NotImplementedError
 
 
+class LatencyHistogram(object):
+    r"""
+    Overview:
+        Count latencies into fixed log-spaced buckets, used to check handoff latency between processes. Counts are in
+        shared memory with one row per env slot, so env processes forked after creation update their own row and
+        get_text reports all of them.
+    Interface:
+        __init__, reset, update, get_text
+    """
+    # upper bounds of buckets in milliseconds, the last bucket collects everything above
+    BUCKETS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+    def __init__(self, name='latency', rows=1):
+        self.name = name
+        self._counts = torch.zeros(rows, len(self.BUCKETS) + 1, dtype=torch.long).share_memory_()
+        self._total = torch.zeros(rows, dtype=torch.float64).share_memory_()
+        self._max = torch.zeros(rows, dtype=torch.float64).share_memory_()
+
+    def reset(self):
+        self._counts.zero_()
+        self._total.zero_()
+        self._max.zero_()
+
+    def update(self, val, row=0):
+        r"""
+        Overview:
+            add one latency
+        Arguments:
+            - val (:obj:`float`): latency in seconds
+            - row (:obj:`int`): env slot the latency is measured in
+        """
+        val = val * 1000
+        idx = 0
+        while idx < len(self.BUCKETS) and val > self.BUCKETS[idx]:
+            idx += 1
+        self._counts[row, idx] += 1
+        self._total[row] += val
+        self._max[row] = max(self._max[row].item(), val)
+
+    @property
+    def counts(self):
+        return self._counts.sum(dim=0).tolist()
+
+    @property
+    def count(self):
+        return int(self._counts.sum().item())
+
+    @property
+    def total(self):
+        return self._total.sum().item()
+
+    @property
+    def max(self):
+        return self._max.max().item()
+
+    def get_text(self):
+        count = self.count
+        if count == 0:
+            return '{}: no data'.format(self.name)
+        counts = self.counts
+        buckets = ['<={}ms: {}'.format(b, c) for b, c in zip(self.BUCKETS, counts) if c > 0]
+        if counts[-1] > 0:
+            buckets.append('>{}ms: {}'.format(self.BUCKETS[-1], counts[-1]))
+        rows = int((self._counts.sum(dim=1) > 0).sum().item())
+        return '{}: count({})|envs({})|avg({:.3f}ms)|max({:.3f}ms)|{}'.format(
+            self.name, count, rows, self.total / count, self.max, ', '.join(buckets))
+
+
 class DistributionTimeImage(object):
     r"""
     Overview:
@@ -15,12 +15,42 @@ import numpy as np
 from distar.agent.import_helper import import_module
 from distar.ctools.utils.file_helper import dumps
 from distar.ctools.utils.file_helper import save_traj_file, loads
+from distar.ctools.torch_utils.model_delta import apply_model_delta
 from collections import deque
 from distar.ctools.worker.coordinator.adapter import Adapter
 
 
+def pull_model(adapter, player_id, keyframes=None):
+    r"""
+    Overview:
+        pull the latest model of player_id. With keyframes, the delta against the kept keyframe is pulled and applied,
+        the full snapshot (a keyframe) is pulled when no keyframe is kept or the learner has moved to a newer one
+    Arguments:
+        - adapter (:obj:`Adapter`): adapter to pull from
+        - player_id (:obj:`str`): player id
+        - keyframes (:obj:`dict`): player_id -> (keyframe_id, state_dict), updated in place, None means full \
+            snapshots only
+    Returns:
+        - data (:obj:`dict`): with 'model', 'model_last_iter' and 'reset_flag'
+    """
+    if keyframes is None:
+        return adapter.pull(token=player_id + 'model', sleep_time=0.5, worker_num=1)
+    for _ in range(2):
+        if player_id in keyframes:
+            data = adapter.pull(token=player_id + 'model_delta', sleep_time=0.5, worker_num=1)
+            keyframe_id, keyframe = keyframes[player_id]
+            if data['keyframe_id'] == keyframe_id:
+                data['model'] = apply_model_delta(keyframe, data)
+                return data
+        data = adapter.pull(token=player_id + 'model', sleep_time=0.5, worker_num=1)
+        keyframes[player_id] = (data['keyframe_id'], data['model'])
+    return data
+
+
 def update_model_loop(cfg, model_ref, signal_queue, update_interval, model_last_iter_dict, avg_update_model_time):
+    torch.set_num_threads(1)
     adapter = Adapter(cfg)
+    keyframes = {} if cfg.communication.get('model_delta_update', False) else None
     last_update_time = time.time()
     update_model_time = deque(maxlen=100)
     last_reset_flag = {k: False for k in model_ref.keys()}
@@ -29,7 +59,7 @@ def update_model_loop(cfg, model_ref, signal_queue, update_interval, model_last_
             reset_flag = False
             for player_id, model in model_ref.items():
                 start_time = time.time()
-                state_dict = adapter.pull(token=player_id + 'model', sleep_time=0.5, worker_num=1)
+                state_dict = pull_model(adapter, player_id, keyframes)
                 model_last_iter = torch.Tensor([state_dict['model_last_iter']])
                 model_last_iter_dict[player_id].copy_(model_last_iter)
                 for k, v in state_dict['model'].items():
@@ -64,6 +94,8 @@ class ActorComm:
         self._avg_update_model_time = torch.Tensor([0]).share_memory_()
         self.model_last_iter_dict = {}
         self._adapter = Adapter(cfg=self._whole_cfg, maxlen=3)
+        # keyframes of models updated by delta, see pull_model
+        self._keyframes = {} if self._whole_cfg.communication.get('model_delta_update', False) else None
         self.worker_num = self._whole_cfg.communication.adapter_traj_worker_num
 
     def ask_for_job(self, actor):
@@ -74,6 +106,8 @@ class ActorComm:
                 job = result['info']
                 print(job)
                 self.job = job
+                if self._keyframes is not None:
+                    self._keyframes = {}
                 self.tmp_model_path = {}
                 self.tmp_traj_path = {}
                 actor.agents = []
@@ -111,16 +145,14 @@ class ActorComm:
                             agent.player_id = player_id
                             if self._whole_cfg.actor.use_cuda:
                                 agent.model = agent.model.cuda()
+                            last_iter = 0
                             if not self._whole_cfg.actor.fake_model:
                                 state_dict = torch.load(self.job['checkpoint_paths'][idx], map_location='cpu')
                                 model_state_dict = {k: v for k, v in state_dict['model'].items() if
                                                     'value_networks' not in k}
                                 agent.model.load_state_dict(model_state_dict,strict=False)
+                                last_iter = state_dict.get('last_iter', 0)
                             actor.models[player_id] = agent.model
-                            if 'last_iter' in state_dict.keys():
-                                last_iter = state_dict['last_iter']
-                            else:
-                                last_iter = 0
                             self.model_last_iter_dict[player_id] = torch.Tensor([last_iter]).share_memory_()
                         else:
                             agent.model = actor.models[player_id]
@@ -180,11 +212,13 @@ class ActorComm:
                 if player_id in self.job['update_players']:
                     start = time.time()
 
-                    state_dict = self._adapter.pull(token=player_id + 'model', sleep_time=0.5, worker_num=1)
+                    state_dict = pull_model(self._adapter, player_id, self._keyframes)
 
                     model_last_iter = torch.Tensor([state_dict['model_last_iter']])
                     self.model_last_iter_dict[player_id].copy_(model_last_iter)
                     model.load_state_dict(state_dict['model'])
+                    if hasattr(model, 'version'):
+                        model.version += 1
                     self._update_model_time.append(time.time() - start)
                     avg_time = torch.Tensor([np.mean(self._update_model_time)])
                     self._avg_update_model_time.copy_(avg_time)
@@ -196,7 +230,6 @@ class ActorComm:
                 actor.reset_env()
 
     def async_update_model(self, actor):
-        torch.set_num_threads(1)
         if not hasattr(self, '_update_model_loop'):
             self._model_ref = {}
             for player_id, model in actor.models.items():
@@ -212,6 +245,8 @@ class ActorComm:
             reset_flag = self._model_signal_queue.get()
             for player_id, model in self._model_ref.items():
                 actor.models[player_id].load_state_dict(model)
+                if hasattr(actor.models[player_id], 'version'):
+                    actor.models[player_id].version += 1
             if reset_flag:
                 actor.reset_env()
 
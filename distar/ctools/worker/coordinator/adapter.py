@@ -10,6 +10,7 @@ import torch
 import os
 import gc
 import copy
+import itertools
 import random
 
 from collections import deque, defaultdict
@@ -17,11 +18,16 @@ from functools import partial
 
 from distar.ctools.utils.file_helper import redis, dumps, loads
 from .protocol import encode, decode
+from .stream import StreamServer, StreamPool
+from .local_transport import SLOT_FS_TYPES, SlotMessage, SlotRing, host_id, local_address, local_transport_supported, \
+    read_descriptor
 
 
 BYTES_LENGTH = 5
 START = b"\n\r"
 END = b"\r\n"
+ADVERTISE_TIMEOUT = 20  # seconds before a pushed message nobody took is advertised to coordinator again
+STREAM_TIMEOUT = 60  # seconds to wait for a message from a pusher
 
 
 class Adapter(object):
@@ -32,6 +38,23 @@ class Adapter(object):
         self._worker_addr = defaultdict(list)
         self._coordinator_ip = self._whole_cfg.communication.coordinator_ip
         self._coordinator_port = self._whole_cfg.communication.coordinator_port
+        # pushed messages are (msg_id, bytes), served to pullers by one StreamServer over persistent connections
+        self._push_lock = threading.Lock()
+        self._msg_ids = ('{}-{}'.format(uuid.uuid4().hex, i) for i in itertools.count())
+        self._advertise_time = {}
+        self._streams = StreamPool()
+        self._thread_local = threading.local()
+        # pushers and pullers on one host talk over a unix socket, pushed data is written once into shared memory slots
+        communication_cfg = self._whole_cfg.communication
+        self._local_transport = communication_cfg.get('local_transport', True) and local_transport_supported()
+        self._slot_size = communication_cfg.get('local_transport_slot_size', 32) << 20
+        self._slot_num = communication_cfg.get('local_transport_slot_num', 4)
+        self._host_id = host_id() if self._local_transport else None
+        self._ring = None
+        self._lent = {}  # slot -> (token, msg_id, SlotMessage) being read by a puller on this host
+        self._token_local = {}  # token -> whether its last message was taken by a puller on this host
+        self._local_streams = StreamPool()
+        self._slotless = set()  # unix sockets of pushers whose shared memory can not be mapped here
 
         # =======ignore these code=======
         self._server = server
@@ -74,81 +97,120 @@ class Adapter(object):
                     s.close()
                 return ip
             self._ip = get_host_ip()
+            if self._local_transport:
+                self._local_addr = local_address()
+                self._ring = SlotRing.create(self._slot_size, self._slot_num)
+                self._stream_server = StreamServer(self._ip, self._take, self._put_back, self._release,
+                                                   self._local_addr)
+            else:
+                self._stream_server = StreamServer(self._ip, self._take, self._put_back)
             self._push_thread = threading.Thread(target=self._push_loop, daemon=True)
             self._push_thread.start()
 
         if worker_num is not None and len(self._worker_addr[token]) == 0:
             self.request_worker(token, worker_num)
 
-        if not isinstance(data, bytes):
-            data = dumps(data, fs_type=fs_type, compress=compress)
-        self._cache_data[token].append(data)
+        message = None
+        if isinstance(data, bytes):
+            message = data
+        elif self._ring is not None and fs_type in SLOT_FS_TYPES and self._token_local.get(token, True):
+            # written once for pullers on this host, None if the ring is full or data is too big
+            message = self._ring.write(data, fs_type, compress)
+        if message is None:
+            message = dumps(data, fs_type=fs_type, compress=compress)
+        with self._push_lock:
+            cache = self._cache_data[token]
+            if self._maxlen is not None and len(cache) == self._maxlen:
+                self._free(cache.popleft()[1])
+            cache.append((next(self._msg_ids), message))
+
+    def _take(self, token, msg_id, slots=False):
+        # a message is removed from cache when a puller takes it
+        with self._push_lock:
+            cache = self._cache_data[token]
+            for idx, (cache_msg_id, message) in enumerate(cache):
+                if cache_msg_id == msg_id:
+                    del cache[idx]
+                    self._advertise_time.pop(msg_id, None)
+                    self._token_local[token] = slots
+                    break
+            else:
+                return None
+            if isinstance(message, SlotMessage) and slots:
+                self._lent[message.slot] = (token, msg_id, message)
+                return self._ring.descriptor(message)
+        if isinstance(message, SlotMessage):
+            return self._ring.read(message)
+        return message
+
+    def _put_back(self, token, msg_id, data):
+        with self._push_lock:
+            if isinstance(data, dict):
+                token, msg_id, data = self._lent.pop(data['slot'])
+            cache = self._cache_data[token]
+            if cache.maxlen is not None and len(cache) == cache.maxlen:
+                # appendleft drops the newest message
+                self._free(cache.pop()[1])
+            cache.appendleft((msg_id, data))
+            self._advertise_time.pop(msg_id, None)
+
+    def _release(self, slot):
+        with self._push_lock:
+            self._lent.pop(slot, None)
+        self._ring.free(slot)
+
+    def _free(self, message):
+        if isinstance(message, SlotMessage):
+            self._ring.free(message.slot)
 
     def _push_loop(self):
         torch.set_num_threads(1)
-        meta_data = {'user_ip': self._ip}
+        meta_data = {'user_ip': self._ip, 'user_port': self._stream_server.port}
+        if self._local_transport:
+            meta_data.update({'host_id': self._host_id, 'local_addr': self._local_addr})
         while True:
-            flag = False
-            for token, v in self._cache_data.items():
-                if len(v):
-                    flag = True 
-                    break
-            if not flag:
+            # messages are advertised to coordinator, and again if no puller takes them in ADVERTISE_TIMEOUT
+            now = time.time()
+            with self._push_lock:
+                messages = [(token, msg_id) for token, v in self._cache_data.items() for msg_id, _ in v]
+                live = set(msg_id for _, msg_id in messages)
+                for msg_id in list(self._advertise_time.keys()):
+                    if msg_id not in live:
+                        self._advertise_time.pop(msg_id)
+            messages = [(token, msg_id) for token, msg_id in messages
+                        if now - self._advertise_time.get(msg_id, 0) > ADVERTISE_TIMEOUT]
+            if not messages:
                 time.sleep(0.01)
                 continue
-            while True:
-                try:
-                    port = portpicker.pick_unused_port()
-                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    s.bind((self._ip, port))
-                    s.listen(5)
+            # messages of one token are announced in one request
+            token_msg_ids = defaultdict(list)
+            for token, msg_id in messages:
+                token_msg_ids[token].append(msg_id)
+            for token, msg_ids in token_msg_ids.items():
+                meta_data.update({'token': token, 'msg_ids': msg_ids})
+                if len(self._worker_addr[token]) == 0:
+                    http_addr =  'http://{}:{}/'.format(self._coordinator_ip, self._coordinator_port) + 'coordinator/push'
+                else:
+                    worker_index = random.randint(0, len(self._worker_addr[token]) - 1)
+                    worker_addr = self._worker_addr[token][worker_index]
+                    http_addr = 'http://{}:{}/'.format(worker_addr['ip'], worker_addr['port']) + 'worker/push'
+                try: 
+                    response = self._session().post(http_addr, json=meta_data).json()
+                    assert response['code'] == 0
+                except requests.exceptions.ConnectionError as e:
+                    worker_num = len(self._worker_addr[token])
+                    if worker_num:
+                        self.request_worker(token, worker_num)
+                    print(f'[push ERROR], can not connect to {http_addr}, retrying!')
+                    time.sleep(1)
                     break
                 except Exception as e:
-                    s.close()
-            meta_data['token'] = token
-            meta_data.update({'token': token, 'user_port': port})
-            if len(self._worker_addr[token]) == 0:
-                http_addr =  'http://{}:{}/'.format(self._coordinator_ip, self._coordinator_port) + 'coordinator/push'
-            else:
-                worker_index = random.randint(0, len(self._worker_addr[token]) - 1)
-                worker_addr = self._worker_addr[token][worker_index]
-                http_addr = 'http://{}:{}/'.format(worker_addr['ip'], worker_addr['port']) + 'worker/push'
-            try: 
-                response = requests.post(http_addr, json=meta_data).json()
-                assert response['code'] == 0
-            except requests.exceptions.ConnectionError as e:
-                worker_num = len(self._worker_addr[token])
-                if worker_num:
-                    self.request_worker(token, worker_num)
-                print(f'[push ERROR], can not connect to {http_addr}, retrying!')
-                time.sleep(1)
-                continue
-            except Exception as e:
-                print(f'[push ERROR], can not connect to {http_addr} retrying!', e)
-                time.sleep(10)
-                continue
-
-            try:
-                s.settimeout(20)
-                c, addr = s.accept()
-            except socket.timeout as e:
-                # print('[push ERROR] wait accept time out', e)
-                s.close()
-                continue
-            try:
-                # t = time.time()
-                data = self._cache_data[token].popleft()
-                data_len = len(data)
-                send_len = c.send(data_len.to_bytes(length=BYTES_LENGTH, byteorder='big', signed=False))
-                if send_len == 0:
-                    raise RuntimeError("socket connection broken")
-                c.sendall(data)
-                # print(f'size: {data_len/ 1000000:.2f}M, push comm time: {time.time() - t:.2f}', flush=True)
-            except Exception as e:
-                print('[push socket ERROR jump to next data]', e, flush=True)
-            finally:
-                c.close()
-                s.close()  
+                    print(f'[push ERROR], can not connect to {http_addr} retrying!', e)
+                    time.sleep(10)
+                    break
+                with self._push_lock:
+                    for msg_id in msg_ids:
+                        self._advertise_time[msg_id] = time.time()
 
     def pull(self, token='default', fs_type='torch', compress=True, sleep_time=1, timeout=None, size=None, worker_num=None):
         if worker_num is not None and len(self._worker_addr[token]) == 0:
@@ -169,7 +231,7 @@ class Adapter(object):
             while True:
                 try:
                     t = time.time()
-                    response = requests.post(http_addr, json=meta_data).json()
+                    response = self._session().post(http_addr, json=meta_data).json()
                     # print('coordinator pull time', time.time() - t)
                     if response['code'] == 0:
                         results = response['info']
@@ -199,38 +261,17 @@ class Adapter(object):
                 results = [results]
             for result in results:
                 try:
-                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    s.settimeout(5)
-                    try:
-                        s.connect((result['user_ip'], result['user_port']))
-                    except Exception as e:
-                        s.close()
-                        print('[pull ERROR] socket connect time out, if this keeps happening, check firewall or close proxy!', e)
+                    data = self._request(result, token)
+                    if data is None:
+                        # taken by another puller after being advertised again
                         continue
-                        
-                    data = io.BytesIO()
-                    data_len = 0
-                    bytes_length = s.recv(BYTES_LENGTH)
-                    if len(bytes_length) == 0:
-                        raise RuntimeError("socket connection broken")
-                    data_size = int.from_bytes(bytes_length, byteorder='big', signed=False)
-                    while data_len < data_size:
-                        data.seek(data_len)
-                        d = s.recv(data_size - data_len)
-                        if len(d) == 0:
-                            raise RuntimeError("socket connection broken")
-                        data.write(d)
-                        data_len += len(d)
-                    s.close()
                     t = time.time()
-                    new_data = loads(data.getvalue(), fs_type, compress=compress)
-                    data.close()
-                    ret_data.append(new_data)
-                    # print(f'size: {data_len/ 1000000:.2f}M, pull unpickle time: {time.time() - t:.2f}', flush=True)
+                    if isinstance(data, (bytes, bytearray)):
+                        data = loads(data, fs_type, compress=compress)
+                    ret_data.append(data)
+                    # print(f'size: {len(data)/ 1000000:.2f}M, pull unpickle time: {time.time() - t:.2f}', flush=True)
                 except Exception as e:
-                    data.close()
-                    s.close()
-                    print('[pull socket ERROR jump to next data]', e, flush=True)
+                    print('[pull stream ERROR jump to next data]', e, flush=True)
                     if timeout is not None and time.time() - start_time > timeout:
                         return None
                     time.sleep(sleep_time + sleep_count * sleep_time)
@@ -244,6 +285,40 @@ class Adapter(object):
                     meta_data['size'] = left_num
                 else:
                     return ret_data
+
+    def _request(self, result, token):
+        # pushers on this host are asked over their unix socket, data in a slot is copied out of shared memory
+        local_addr = result.get('local_addr')
+        if self._local_transport and local_addr and result.get('host_id') == self._host_id:
+            try:
+                connection = self._local_streams.connection(local_addr)
+                data = connection.request(token, result['msg_id'], timeout=STREAM_TIMEOUT,
+                                          slots=local_addr not in self._slotless)
+            except (ConnectionError, OSError):
+                # same host id in another network namespace, fall back to tcp
+                connection = None
+            if connection is not None:
+                if not isinstance(data, dict):
+                    return data
+                descriptor = data
+                try:
+                    data = read_descriptor(descriptor)
+                except OSError as e:
+                    print('[WARNING] can not read shared memory of {}, ask for bytes instead'.format(local_addr), e)
+                    self._slotless.add(local_addr)
+                    connection.release(descriptor['slot'], read=False)
+                    return None
+                # raises if the connection broke meanwhile, the pusher then pushes the message again
+                connection.release(descriptor['slot'])
+                return data
+        return self._streams.request((result['user_ip'], result['user_port']), token, result['msg_id'],
+                                     timeout=STREAM_TIMEOUT)
+
+    def _session(self):
+        # one keep-alive http session per thread for coordinator requests
+        if not hasattr(self._thread_local, 'session'):
+            self._thread_local.session = requests.Session()
+        return self._thread_local.session
             
     def _register(self):
         self._ip = socket.gethostbyname(socket.gethostname())
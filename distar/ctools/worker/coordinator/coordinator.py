@@ -8,6 +8,7 @@ import re
 
 from distar.agent.default.rl_training.rl_dataloader import worker_loop
 from flask import Flask, request
+from werkzeug.serving import WSGIRequestHandler
 import portpicker
 
 from distar.ctools.utils.log_helper import TextLogger
@@ -17,6 +18,11 @@ log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 
 
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    # HTTP/1.1 keeps connections of adapter sessions open between requests
+    protocol_version = 'HTTP/1.1'
+
+
 class Worker(object):
     def __init__(self, worker_index) -> None:
         self._lock = LockContext(type_=LockContextType.THREAD_LOCK)
@@ -25,7 +31,11 @@ class Worker(object):
 
     def deal_with_push(self, request_info):
         token = request_info.pop('token')
-        self._buffer[token].append(request_info)
+        # one announce may carry several messages of a pusher
+        for msg_id in request_info.pop('msg_ids', []):
+            self._buffer[token].append(dict(request_info, msg_id=msg_id))
+        if 'msg_id' in request_info:
+            self._buffer[token].append(request_info)
         print(f'worker index: {self.worker_index}, push to token: {token} buffer size: {len(self._buffer[token])}, {request_info}')
         return True
     
@@ -56,7 +66,7 @@ def run_worker(token, ip, port, worker_index):
     worker = Worker(worker_index)
     worker_app = create_worker_app(worker)
     print(f'run worker for token: {token} at {ip}: {port}')
-    worker_app.run(host=ip, port=port, debug=False, use_reloader=False)
+    worker_app.run(host=ip, port=port, debug=False, use_reloader=False, request_handler=KeepAliveRequestHandler)
     
 
 class Coordinator(object):
@@ -130,7 +140,11 @@ class Coordinator(object):
     def deal_with_push(self, request_info, request_ip):
         token = request_info.pop('token')
         request_info['user_ip'] = request_ip
-        self._buffer[token].append(request_info)
+        # one announce may carry several messages of a pusher
+        for msg_id in request_info.pop('msg_ids', []):
+            self._buffer[token].append(dict(request_info, msg_id=msg_id))
+        if 'msg_id' in request_info:
+            self._buffer[token].append(request_info)
         print(f'push to token: {token}, buffer size: {len(self._buffer[token])}, request info: {request_info}')
         return True
 
@@ -0,0 +1,177 @@
+import atexit
+import os
+import pickle
+import platform
+import socket
+import threading
+import uuid
+
+from distar.ctools.utils.data_helper import to_ndarray, to_tensor
+from distar.ctools.utils.file_helper import dumps
+
+# fs_type of data written into slots as pickle protocol 5 with out of band buffers
+SLOT_FS_TYPES = ['nppickle', 'pickle']
+_own_rings = set()
+
+
+def local_transport_supported():
+    return platform.system().lower() == 'linux' and hasattr(socket, 'AF_UNIX')
+
+
+def host_id():
+    # boot id tells apart machines with the same host name, containers of one machine still share it
+    try:
+        with open('/proc/sys/kernel/random/boot_id', 'r') as f:
+            boot_id = f.read().strip()
+    except OSError:
+        boot_id = ''
+    return '{}-{}'.format(socket.gethostname(), boot_id)
+
+
+def local_address():
+    # name of an abstract unix socket, it goes away with the socket
+    return 'distar_adapter_{}'.format(uuid.uuid4().hex)
+
+
+def _attach(name):
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+    shm = SharedMemory(name=name)
+    # the creator unlinks it, the tracker of an attaching process would unlink it on exit as well
+    if name not in _own_rings:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class SlotMessage(object):
+    r"""
+    Overview:
+        a pushed message held in a slot of SlotRing, descriptor tells pullers where its pickle header and buffers are
+    """
+
+    def __init__(self, slot, lengths, fs_type, compress):
+        self.slot = slot
+        self.lengths = lengths
+        self.fs_type = fs_type
+        self.compress = compress
+
+
+class SlotRing(object):
+    r"""
+    Overview:
+        shared memory of slot_num fixed size slots owned by one pushing Adapter. Data is written once into a free slot
+        as pickle protocol 5 header followed by its out of band buffers, pullers on the same host copy it out and
+        the slot is freed when they release it.
+    Interface:
+        create, write, descriptor, read, free, close
+    """
+
+    def __init__(self, shm, slot_size, slot_num):
+        self._shm = shm
+        self._slot_size = slot_size
+        self._free = list(range(slot_num))
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, slot_size, slot_num):
+        r"""
+        Overview:
+            create a ring, returns None if there is not enough free space in /dev/shm, since writing beyond it
+            kills the process
+        """
+        from multiprocessing.shared_memory import SharedMemory
+        size = slot_size * slot_num
+        try:
+            stat = os.statvfs('/dev/shm')
+            if stat.f_bavail * stat.f_frsize < size:
+                print('[WARNING] not enough space in /dev/shm for local transport, need {} MB'.format(size >> 20))
+                return None
+            shm = SharedMemory(create=True, size=size, name='distar_{}'.format(uuid.uuid4().hex))
+        except OSError as e:
+            print('[WARNING] can not create shared memory for local transport', e)
+            return None
+        _own_rings.add(shm.name)
+        ring = cls(shm, slot_size, slot_num)
+        atexit.register(ring.close)
+        return ring
+
+    def write(self, data, fs_type, compress):
+        r"""
+        Overview:
+            write data into a free slot, returns None if all slots are used or data does not fit
+        """
+        if fs_type == 'nppickle':
+            data = to_ndarray(data)
+        buffers = []
+        header = pickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+        buffers = [b.raw() for b in buffers]
+        lengths = [len(header)] + [b.nbytes for b in buffers]
+        if sum(lengths) > self._slot_size:
+            return None
+        with self._lock:
+            if not self._free:
+                return None
+            slot = self._free.pop()
+        offset = slot * self._slot_size
+        for b in [header] + buffers:
+            self._shm.buf[offset:offset + len(b)] = b
+            offset += len(b)
+        return SlotMessage(slot, lengths, fs_type, compress)
+
+    def descriptor(self, message):
+        return {'name': self._shm.name, 'offset': message.slot * self._slot_size, 'lengths': message.lengths,
+                'fs_type': message.fs_type, 'slot': message.slot}
+
+    def read(self, message):
+        r"""
+        Overview:
+            serialized bytes of message for pullers on other hosts, the slot is freed
+        """
+        data = read_slot(self._shm, self.descriptor(message))
+        self.free(message.slot)
+        return dumps(data, fs_type=message.fs_type, compress=message.compress)
+
+    def free(self, slot):
+        with self._lock:
+            self._free.append(slot)
+
+    def close(self):
+        self._shm.close()
+        self._shm.unlink()
+
+
+def read_slot(shm, descriptor):
+    r"""
+    Overview:
+        copy data out of a slot, buffers of the pickle are copied once and used by the returned arrays
+    """
+    offset = descriptor['offset']
+    lengths = descriptor['lengths']
+    view = shm.buf[offset:offset + sum(lengths)]
+    header = view[:lengths[0]]
+    try:
+        buffers = []
+        start = lengths[0]
+        for length in lengths[1:]:
+            buffers.append(bytearray(view[start:start + length]))
+            start += length
+        data = pickle.loads(header, buffers=buffers)
+    finally:
+        header.release()
+        view.release()
+    if descriptor['fs_type'] == 'nppickle':
+        data = to_tensor(data)
+    return data
+
+
+def read_descriptor(descriptor):
+    r"""
+    Overview:
+        read_slot on the ring of a pusher on this host, attached for this read only, so rings of pushers that are
+        gone are not kept mapped
+    """
+    shm = _attach(descriptor['name'])
+    try:
+        return read_slot(shm, descriptor)
+    finally:
+        shm.close()
@@ -0,0 +1,303 @@
+import json
+import socket
+import struct
+import threading
+from concurrent.futures import Future, TimeoutError
+
+import portpicker
+
+# frame header: kind, request id, payload length
+HEADER = struct.Struct('>BIQ')
+REQUEST = 1  # payload is json of token, msg_id and whether a SLOT reply can be read
+DATA = 2  # payload is the message
+MISS = 3  # message is already taken or dropped
+SLOT = 4  # payload is json descriptor of a shared memory slot holding the message, local connections only
+RELEASE = 5  # payload is json of a slot and whether the puller read it, no reply
+ACK = 6  # DATA of the request id is received, no reply
+
+
+def _tune(s):
+    if s.family != socket.AF_INET:
+        return
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+
+def _recv_exact(s, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = s.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError('stream connection closed')
+        received += n
+    return buffer
+
+
+def send_frame(s, kind, request_id, payload=b''):
+    s.sendall(HEADER.pack(kind, request_id, len(payload)))
+    if len(payload):
+        s.sendall(payload)
+
+
+def recv_frame(s):
+    kind, request_id, length = HEADER.unpack(_recv_exact(s, HEADER.size))
+    return kind, request_id, _recv_exact(s, length)
+
+
+class StreamServer(object):
+    r"""
+    Overview:
+        one listening port per process for all messages pushed by an Adapter, and an abstract unix socket named
+        local_addr for pullers on the same host. Pullers keep their connections open and send framed requests of
+        (token, msg_id). take(token, msg_id, slots) returns the message bytes, a slot descriptor dict (if slots) or
+        None if it is gone. A taken message is put_back(token, msg_id, data) unless the puller acknowledges its DATA
+        or releases its slot before the connection is closed, so a broken connection or request timeout does not lose
+        it, release(slot) is called when a puller is done with a slot.
+    Interface:
+        __init__, port, close
+    """
+
+    def __init__(self, ip, take, put_back, release=None, local_addr=None):
+        self._take = take
+        self._put_back = put_back
+        self._release = release
+        while True:
+            try:
+                self._port = portpicker.pick_unused_port()
+                self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self._socket.bind((ip, self._port))
+                self._socket.listen(128)
+                break
+            except Exception as e:
+                self._socket.close()
+        self._sockets = [(self._socket, False)]
+        if local_addr is not None:
+            local_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            local_socket.bind('\0' + local_addr)
+            local_socket.listen(128)
+            self._sockets.append((local_socket, True))
+        for s, local in self._sockets:
+            threading.Thread(target=self._accept_loop, args=(s, local), daemon=True).start()
+
+    @property
+    def port(self):
+        return self._port
+
+    def _accept_loop(self, s, local):
+        while True:
+            try:
+                c, addr = s.accept()
+            except OSError:
+                return
+            _tune(c)
+            threading.Thread(target=self._serve, args=(c, local), daemon=True).start()
+
+    def _serve(self, c, local):
+        sent = {}  # request id -> (token, msg_id, data) whose DATA is not acknowledged yet
+        lent = {}
+        try:
+            while True:
+                kind, request_id, payload = recv_frame(c)
+                if kind == ACK:
+                    sent.pop(request_id, None)
+                    continue
+                request = json.loads(payload.decode('utf-8'))
+                if kind == RELEASE and local:
+                    if request['slot'] in lent:
+                        token, msg_id, data = lent.pop(request['slot'])
+                        if request['read']:
+                            self._release(request['slot'])
+                        else:
+                            # the puller can not map the shared memory, it asks for bytes next time
+                            self._put_back(token, msg_id, data)
+                    continue
+                if kind != REQUEST:
+                    raise ValueError('invalid frame kind {}'.format(kind))
+                data = self._take(request['token'], request['msg_id'], local and request.get('slots', False))
+                if data is None:
+                    send_frame(c, MISS, request_id)
+                    continue
+                try:
+                    if isinstance(data, dict):
+                        send_frame(c, SLOT, request_id, json.dumps(data).encode('utf-8'))
+                        lent[data['slot']] = (request['token'], request['msg_id'], data)
+                    else:
+                        sent[request_id] = (request['token'], request['msg_id'], data)
+                        send_frame(c, DATA, request_id, data)
+                except Exception:
+                    sent.pop(request_id, None)
+                    self._put_back(request['token'], request['msg_id'], data)
+                    raise
+        except (ConnectionError, OSError):
+            pass
+        except Exception as e:
+            print('[stream server ERROR]', e, flush=True)
+        finally:
+            c.close()
+            # messages the puller did not confirm are pushed again
+            for token, msg_id, data in list(sent.values()) + list(lent.values()):
+                self._put_back(token, msg_id, data)
+
+    def close(self):
+        for s, _ in self._sockets:
+            s.close()
+
+
+class StreamConnection(object):
+    r"""
+    Overview:
+        long lived connection to the StreamServer of one pusher. Requests of several threads are multiplexed by
+        request id, replies are read by one thread and handed to the waiting requests.
+    Interface:
+        __init__, request, release, closed, close
+    """
+
+    def __init__(self, addr, timeout=5):
+        if isinstance(addr, str):
+            # abstract unix socket of a pusher on this host
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.settimeout(timeout)
+            try:
+                self._socket.connect('\0' + addr)
+            except OSError:
+                self._socket.close()
+                raise
+        else:
+            self._socket = socket.create_connection(addr, timeout=timeout)
+        self._socket.settimeout(None)
+        _tune(self._socket)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._next_id = 0
+        self._closed = False
+        self._read_thread = threading.Thread(target=self._read_loop, daemon=True)
+        self._read_thread.start()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def _read_loop(self):
+        error = ConnectionError('stream connection closed')
+        try:
+            while True:
+                kind, request_id, payload = recv_frame(self._socket)
+                with self._lock:
+                    future = self._pending.pop(request_id, None)
+                if future is None:
+                    continue
+                if kind == SLOT:
+                    future.set_result(json.loads(payload.decode('utf-8')))
+                elif kind == DATA:
+                    try:
+                        with self._lock:
+                            send_frame(self._socket, ACK, request_id)
+                    except OSError:
+                        # the pusher pushes it again, it may be received twice
+                        pass
+                    future.set_result(payload)
+                else:
+                    future.set_result(None)
+        except Exception as e:
+            error = e if isinstance(e, ConnectionError) else ConnectionError(str(e))
+        self.close()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(error)
+
+    def request(self, token, msg_id, timeout=None, slots=False):
+        r"""
+        Overview:
+            ask for message msg_id of token, returns its bytes, a slot descriptor dict if slots is True on a local
+            connection, or None if it is gone
+        """
+        future = Future()
+        payload = json.dumps({'token': token, 'msg_id': msg_id, 'slots': slots}).encode('utf-8')
+        with self._lock:
+            if self._closed:
+                raise ConnectionError('stream connection closed')
+            request_id = self._next_id
+            self._next_id = (self._next_id + 1) % (1 << 32)
+            self._pending[request_id] = future
+            try:
+                send_frame(self._socket, REQUEST, request_id, payload)
+            except OSError as e:
+                self._pending.pop(request_id)
+                self._closed = True
+                raise ConnectionError(str(e))
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            # the reply may never come, drop the connection so the next request reconnects
+            self.close()
+            raise ConnectionError('stream request timeout')
+
+    def release(self, slot, read=True):
+        r"""
+        Overview:
+            tell the pusher a slot descriptor returned by request is read, or could not be read and the message
+            should be pushed again. Raises ConnectionError if the connection was closed meanwhile, the pusher has then
+            freed the slot and what was read may be overwritten
+        """
+        payload = json.dumps({'slot': slot, 'read': read}).encode('utf-8')
+        with self._lock:
+            if self._closed:
+                raise ConnectionError('stream connection closed')
+            try:
+                send_frame(self._socket, RELEASE, 0, payload)
+            except OSError as e:
+                self._closed = True
+                raise ConnectionError(str(e))
+
+    def close(self):
+        self._closed = True
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+
+
+class StreamPool(object):
+    r"""
+    Overview:
+        StreamConnection per pusher address, reconnected when broken
+    Interface:
+        __init__, connection, request, close
+    """
+
+    def __init__(self, timeout=5):
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    def connection(self, addr):
+        with self._lock:
+            connection = self._connections.get(addr)
+            if connection is None or connection.closed:
+                connection = StreamConnection(addr, self._timeout)
+                self._connections[addr] = connection
+            return connection
+
+    def request(self, addr, token, msg_id, timeout=None):
+        r"""
+        Overview:
+            request a message from the pusher at addr, a broken connection is reconnected and the request sent
+            once more. A message taken on the broken connection is pushed again by the pusher, the retry may get None
+            for it meanwhile. Raises ConnectionError if the pusher can not be reached.
+        """
+        for retry in range(2):
+            try:
+                return self.connection(addr).request(token, msg_id, timeout)
+            except (ConnectionError, OSError) as e:
+                if retry:
+                    raise ConnectionError(str(e))
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, {}
+        for connection in connections.values():
+            connection.close()
@@ -3,10 +3,13 @@ import os
 import sys
 import time
 import traceback
+import uuid
 import platform
 import torch.multiprocessing as tm
 
 from distar.ctools.torch_utils.data_helper import to_device
+from distar.ctools.torch_utils.model_delta import make_model_delta
+from distar.ctools.torch_utils.shared_blob import SharedBlob
 from functools import partial
 
 import requests
@@ -53,17 +56,28 @@ class LearnerComm:
     def start_send_model(self):
         context_str = 'spawn' if platform.system().lower() == 'windows' else 'fork'
         self.mp_fork_context = tm.get_context(context_str)
-        self._model_parent_conn, self._model_child_conn = [], []
+        # one serializer writes each model version once into shared memory, send workers only push those bytes
+        model_size = sum([v.numel() * v.element_size() for v in self._model_ref.values()])
+        capacity = int(model_size * 1.1) + (16 << 20)
+        tokens = [self.player_id + 'model']
+        if self._whole_cfg.communication.get('model_delta_update', False):
+            tokens.append(self.player_id + 'model_delta')
+        self._model_blobs = {token: SharedBlob(capacity) for token in tokens}
+        self._model_parent_conn, model_child_conn = self.mp_fork_context.Pipe()
+        self._serialize_model_process = self.mp_fork_context.Process(target=self._serialize_model_loop,
+                                                                     args=(model_child_conn,
+                                                                           self._model_ref,
+                                                                           self._whole_cfg,
+                                                                           self.player_id,
+                                                                           self._model_fs_type,
+                                                                           self._model_blobs),
+                                                                     daemon=True)
+        self._serialize_model_process.start()
         self._send_model_processes = []
         for _ in range(self._send_model_worker_num):
-            p, c = self.mp_fork_context.Pipe()
-            self._model_parent_conn.append(p)
             process = self.mp_fork_context.Process(target=self._send_model_loop,
-                                                      args=(c,
-                                                            self._model_ref,
-                                                            self._whole_cfg,
-                                                            self.player_id,
-                                                            self._model_fs_type),
+                                                      args=(self._whole_cfg,
+                                                            self._model_blobs),
                                                       daemon=True)
             self._send_model_processes.append(process)
             process.start()
@@ -74,29 +88,73 @@ class LearnerComm:
             state_dict = to_device({k: v for k, v in learner.model.state_dict().items() if 'value_networks' not in k and 'value_encoder' not in k},device='cpu')
             for k,val in state_dict.items():
                 self._model_ref[k].copy_(val)
-            for i in range(self._send_model_worker_num):
-                self._model_parent_conn[i].send((learner.last_iter.val, reset_flag))
+            if not self._serialize_model_process.is_alive():
+                # actors would keep playing with the last model sent
+                raise RuntimeError('model serialize process exited with code {}, no model is sent'.format(
+                    self._serialize_model_process.exitcode))
+            self._model_parent_conn.send((learner.last_iter.val, reset_flag))
             
         if not ignore_freq:
             self._send_model_count += 1
 
     @staticmethod
-    def _send_model_loop(model_child_conn,model_ref, cfg, player_id, model_fs_type):
+    def _serialize_model_loop(model_child_conn, model_ref, cfg, player_id, model_fs_type, model_blobs):
         torch.set_num_threads(1)
-        adapter = Adapter(cfg=cfg, maxlen=1)
-        worker_num = cfg.communication.adapter_model_worker_num
-        model_last_iter, reset_flag = model_child_conn.recv()
-        state_dict = {'model':  model_ref,'model_last_iter': 0, 'reset_flag': False}
-        data = dumps(state_dict, fs_type=model_fs_type, compress=True)
+        model_delta_update = cfg.communication.get('model_delta_update', False)
+        if model_delta_update:
+            # full snapshots are only refreshed at keyframes, other versions are published as deltas against the
+            # latest keyframe on a separate token
+            keyframe_interval = cfg.communication.get('model_keyframe_interval', 10)
+            delta_fp16 = cfg.communication.get('model_delta_fp16', True)
+            delta_threshold = cfg.communication.get('model_delta_threshold', 0.)
+            # keyframes are identified by process uuid and version, learner iterations repeat after a restart from
+            # a checkpoint and an actor would apply deltas to the wrong keyframe
+            process_uuid = uuid.uuid4().hex
+            version, keyframe_version, keyframe_id, keyframe = 0, 0, None, None
+        model_child_conn.recv()
+        model_last_iter, reset_flag = 0, False
         while True:
-            if model_child_conn.poll():
-                model_last_iter, reset_flag = model_child_conn.recv()
+            if not model_delta_update:
                 state_dict = {'model':  model_ref,'model_last_iter': model_last_iter, 'reset_flag': reset_flag}
-                data = dumps(state_dict, fs_type=model_fs_type, compress=True)
+                model_blobs[player_id + 'model'].write(dumps(state_dict, fs_type=model_fs_type, compress=True))
+            else:
+                if keyframe is None or reset_flag or version - keyframe_version >= keyframe_interval:
+                    keyframe = {k: v.clone() for k, v in model_ref.items()}
+                    keyframe_version, keyframe_id = version, '{}-{}'.format(process_uuid, version)
+                    state_dict = {'model': keyframe, 'model_last_iter': model_last_iter, 'reset_flag': reset_flag,
+                                  'keyframe_id': keyframe_id}
+                    model_blobs[player_id + 'model'].write(dumps(state_dict, fs_type=model_fs_type, compress=True))
+                delta = make_model_delta(model_ref, keyframe, fp16=delta_fp16, threshold=delta_threshold)
+                delta.update({'model_last_iter': model_last_iter, 'reset_flag': reset_flag,
+                              'keyframe_id': keyframe_id})
+                model_blobs[player_id + 'model_delta'].write(dumps(delta, fs_type=model_fs_type, compress=True))
+                version += 1
+            # skip versions sent while serializing, keep reset flag of skipped ones
+            model_last_iter, reset_flag = model_child_conn.recv()
+            while model_child_conn.poll():
+                model_last_iter, skipped_reset_flag = model_child_conn.recv()
+                reset_flag = reset_flag or skipped_reset_flag
 
-                adapter.push(data, token=player_id + 'model', worker_num=worker_num)
-            if not adapter.full(player_id + 'model'):
-                adapter.push(data, player_id + 'model', worker_num=worker_num)
+    @staticmethod
+    def _send_model_loop(cfg, model_blobs):
+        torch.set_num_threads(1)
+        worker_num = cfg.communication.adapter_model_worker_num
+        adapters = {token: Adapter(cfg=cfg, maxlen=1) for token in model_blobs.keys()}
+        versions = {token: 0 for token in model_blobs.keys()}
+        data = {}
+        while True:
+            idle = True
+            for token, blob in model_blobs.items():
+                if blob.version > versions[token]:
+                    versions[token], data[token] = blob.read()
+                    adapters[token].push(data[token], token=token, worker_num=worker_num)
+                    idle = False
+                elif token in data and not adapters[token].full(token):
+                    # every pushed copy is pulled by one actor, so the same bytes are pushed again
+                    adapters[token].push(data[token], token=token, worker_num=worker_num)
+                    idle = False
+            if idle:
+                time.sleep(0.01)
 
     def send_train_info(self, learner):
         flag = torch.tensor([0])
@@ -165,7 +223,9 @@ class LearnerComm:
         self._model_ref = model_ref
 
     def close(self):
-        if hasattr(self,'_send_model_process'):
-            self._send_model_process.terminate()
+        if hasattr(self, '_serialize_model_process'):
+            self._serialize_model_process.terminate()
+        for process in getattr(self, '_send_model_processes', []):
+            process.terminate()
         time.sleep(1)
         print('close subprocess in learner_comm')
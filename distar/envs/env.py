@@ -1,4 +1,5 @@
 import collections
+from concurrent import futures
 from absl import logging
 import random
 import time
@@ -132,8 +133,20 @@ class SC2Env(object):
         if self._human_flag:
             self._update_both_obs = False
 
-        self._run_config = run_configs.get(version=self._version)
+        fake_sc2 = self._cfg.get('fake_sc2', None)
+        if fake_sc2:
+            from distar.envs.fake_sc2 import FakeRunConfig
+            self._run_config = FakeRunConfig(**(fake_sc2 if isinstance(fake_sc2, dict) else {}))
+        else:
+            self._run_config = run_configs.get(version=self._version)
         self._parallel = run_parallel.RunParallel()  # Needed for multiplayer.
+        self._recycle_games = self._cfg.get('recycle_games', 10)
+        self._warm_pool = None
+        if self._cfg.get('warm_pool', False):
+            if self._realtime or self._human_flag:
+                print('[WARNING] warm_pool is not supported in realtime or human games, disabled')
+            else:
+                self._warm_pool = WarmGamePool(self, self._recycle_games, self._cfg.get('health_check_timeout', 10))
 
         self._last_score = None
         self._total_steps = 0
@@ -145,11 +158,19 @@ class SC2Env(object):
         self._controllers = None
         self._sc2_procs = None
         self._ports = None
+        self._slot_games = 0
         self._random_delay_weights = self._cfg.get('random_delay_weights', [0, 0.7, 0.2, 0.1])
+        self._step_executor = None
+        self._step_future = None
+
+    def _choose_map_name(self):
+        if self._ori_map_name == 'random':
+            return random.choice(MAPS)
+        return self._ori_map_name
 
-    def _setup_interface(self):
-        self._interface = []
-        map_size = get_map_size(self._map_name)
+    def _make_interface(self, map_name):
+        interfaces = []
+        map_size = get_map_size(map_name)
         if self._human_flag:
             raw_affects_selection = True
         else:
@@ -174,49 +195,69 @@ class SC2Env(object):
                 interface.feature_layer.minimap_resolution.x = self._cfg.minimap_resolutions[i][0]
                 interface.feature_layer.minimap_resolution.y = self._cfg.minimap_resolutions[i][1]
             interface.feature_layer.crop_to_playable_area = True
-            self._interface.append(interface)
+            interfaces.append(interface)
+        return interfaces
 
-    def _launch_game(self):
-        # Reserve a whole bunch of ports for the weird multiplayer implementation.
+    def _start_sc2(self):
+        """Launch the SC2 processes of one game, returns a slot of processes, controllers and ports."""
         max_retry_times = 10
         for i in range(max_retry_times):
+            slot = {'procs': [], 'controllers': [], 'ports': [], 'games': 0}
             try:
+                # Reserve a whole bunch of ports for the weird multiplayer implementation.
                 if self._num_agents > 1:
-                    self._ports = portspicker.pick_unused_ports(self._num_agents * 2)
-                    # logging.info("Ports used for multiplayer: %s", self._ports)
-                else:
-                    self._ports = []
+                    slot['ports'] = portspicker.pick_unused_ports(self._num_agents * 2)
 
                 # Actually launch the game processes.
                 if self._human_flag:
-                    self._sc2_procs = [
-                        self._run_config.start(extra_ports=self._ports,
-                                               want_rgb=False),
-                        self._run_config.start(extra_ports=self._ports,
-                                               want_rgb=False, full_screen=True)
-                    ]
+                    slot['procs'].append(self._run_config.start(extra_ports=slot['ports'], want_rgb=False))
+                    slot['procs'].append(self._run_config.start(extra_ports=slot['ports'], want_rgb=False,
+                                                                full_screen=True))
                 else:
-                    self._sc2_procs = [
-                        self._run_config.start(extra_ports=self._ports,
-                                            want_rgb=False)
-                        for _ in range(self._num_agents)]
-                self._controllers = [p.controller for p in self._sc2_procs]
-                return
+                    for _ in range(self._num_agents):
+                        slot['procs'].append(self._run_config.start(extra_ports=slot['ports'], want_rgb=False))
+                slot['controllers'] = [p.controller for p in slot['procs']]
+                return slot
             except Exception as e:
                 print('[ERROR {}] start SC2 failed, retry times: {}'.format(e, i))
-                self.close()
+                close_slot(slot)
                 if i == max_retry_times - 1:
                     raise e
 
+    def _launch_game(self):
+        self._set_slot(self._start_sc2())
+
+    def _set_slot(self, slot):
+        self._sc2_procs = slot['procs']
+        self._controllers = slot['controllers']
+        self._ports = slot['ports']
+        self._slot_games = slot['games']
+
+    def _get_slot(self):
+        return {'procs': self._sc2_procs, 'controllers': self._controllers, 'ports': self._ports,
+                'games': self._slot_games}
+
     def _create_join(self):
         """Create the game, and join it."""
-        map_inst = random.choice(self._maps)
-        self._map_name = map_inst.name
-
-        self._episode_length = get_default(self._default_episode_length,
-                                           map_inst.game_steps_per_episode)
-        if self._episode_length <= 0 or self._episode_length > MAX_STEP_COUNT:
-            self._episode_length = MAX_STEP_COUNT
+        self._set_game(self._create_join_game(self._maps, self._interface, self._controllers, self._ports,
+                                              self._parallel))
+        self._slot_games += 1
+
+    def _set_game(self, game):
+        self._map_name = game['map_name']
+        self._episode_length = game['episode_length']
+        self.sanitized_names = game['sanitized_names']
+        self._game_info = game['game_info']
+
+    def _create_join_game(self, map_list, interfaces, controllers, ports, parallel):
+        map_inst = random.choice(map_list)
+        game = {'map_name': map_inst.name}
+
+        episode_length = get_default(self._default_episode_length,
+                                     map_inst.game_steps_per_episode)
+        if episode_length <= 0 or episode_length > MAX_STEP_COUNT:
+            episode_length = MAX_STEP_COUNT
+        game['episode_length'] = episode_length
 
         # Create the game. Set the first instance as the host.
         create = sc_pb.RequestCreateGame(
@@ -232,7 +273,7 @@ class SC2Env(object):
             # Save the maps so they can access it. Don't do it in parallel since SC2
             # doesn't respect tmpdir on windows, which leads to a race condition:
             # https://github.com/Blizzard/s2client-proto/issues/102
-            for c in self._controllers:
+            for c in controllers:
                 c.save_map(map_inst.path, map_data)
 
         if self._random_seed is not None:
@@ -245,33 +286,34 @@ class SC2Env(object):
                     type=sc_pb.Computer, race=random.choice(p.race),
                     difficulty=p.difficulty, ai_build=random.choice(p.build))
         if self._num_agents > 1:
-            self._controllers[1].create_game(create)
+            controllers[1].create_game(create)
         else:
-            self._controllers[0].create_game(create)
+            controllers[0].create_game(create)
 
         # Create the join requests.
         agent_players = [p for p in self._players if isinstance(p, Agent)]
-        self.sanitized_names = crop_and_deduplicate_names(p.name for p in agent_players)
+        game['sanitized_names'] = crop_and_deduplicate_names(p.name for p in agent_players)
         join_reqs = []
-        for p, name, interface in zip(agent_players, self.sanitized_names, self._interface):
+        for p, name, interface in zip(agent_players, game['sanitized_names'], interfaces):
             join = sc_pb.RequestJoinGame(options=interface)
             join.race = random.choice(p.race)
             join.player_name = name
-            if self._ports:
+            if ports:
                 join.shared_port = 0  # unused
-                join.server_ports.game_port = self._ports[0]
-                join.server_ports.base_port = self._ports[1]
+                join.server_ports.game_port = ports[0]
+                join.server_ports.base_port = ports[1]
                 for i in range(self._num_agents - 1):
-                    join.client_ports.add(game_port=self._ports[i * 2 + 2],
-                                          base_port=self._ports[i * 2 + 3])
+                    join.client_ports.add(game_port=ports[i * 2 + 2],
+                                          base_port=ports[i * 2 + 3])
             join_reqs.append(join)
 
         # Join the game. This must be run in parallel because Join is a blocking
         # call to the game that waits until all clients have joined.
-        self._parallel.run((c.join_game, join)
-                           for c, join in zip(self._controllers, join_reqs))
+        parallel.run((c.join_game, join)
+                     for c, join in zip(controllers, join_reqs))
 
-        self._game_info = self._parallel.run(c.game_info for c in self._controllers)
+        game['game_info'] = parallel.run(c.game_info for c in controllers)
+        return game
 
     @property
     def map_name(self):
@@ -290,6 +332,7 @@ class SC2Env(object):
                 len(self._maps) == 1):
             # Need to support restart for fast-restart of mini-games.
             self._controllers[0].restart()
+            self._slot_games += 1
         else:
             if len(self._controllers) > 1 and self._episode_count:
                 self._parallel.run(c.leave for c in self._controllers)
@@ -297,19 +340,34 @@ class SC2Env(object):
 
     def reset(self, players=None):
         """Start a new episode."""
-        if self._ori_map_name == 'random':
-            self._map_name = random.choice(MAPS)
-        else:
-            self._map_name = self._ori_map_name
-        self._maps = [maps.get(name) for name in to_list(self._map_name)]
-        self._setup_interface()
         if players:
+            if self._warm_pool is not None and players != self._players:
+                self._warm_pool.close()  # the standby game is created for the old players
             self._players = players
         self._episode_steps = 0
-        if self._controllers is None or (self._episode_count + 1) % 10 == 0:  #  restart game for memory release
-            self.close()
-            self._launch_game()
-        self._restart()
+        standby = self._warm_pool.acquire() if self._warm_pool is not None else None
+        if standby is not None:
+            # the finished game is left and the game after next is prepared on its processes
+            slot, game = standby
+            self._warm_pool.prepare(self._get_slot())
+            self._set_slot(slot)
+            self._set_game(game)
+        else:
+            self._map_name = self._choose_map_name()
+            self._maps = [maps.get(name) for name in to_list(self._map_name)]
+            self._interface = self._make_interface(self._map_name)
+            if self._warm_pool is not None:
+                # no standby game at the first reset or after a failure, start one in place
+                close_slot(self._get_slot())
+                self._launch_game()
+                self._create_join()
+                self._warm_pool.prepare()
+            else:
+                if self._controllers is None or (self._episode_count + 1) % self._recycle_games == 0:
+                    # restart game for memory release
+                    self.close()
+                    self._launch_game()
+                self._restart()
 
         self._next_obs_step = [0] * self._num_agents
         if self._human_flag:
@@ -374,6 +432,18 @@ class SC2Env(object):
             steps = self._parallel.run((c.step, step_mul) for c in self._controllers)
         return self._observe(target_game_loop)
 
+    def step_async(self, actions):
+        """Start a step in a background thread, the result is returned by step_wait.
+        SC2 simulates step_mul game loops while the caller is free to run inference for other envs."""
+        assert self._step_future is None, 'step_wait must be called before next step_async'
+        if self._step_executor is None:
+            self._step_executor = futures.ThreadPoolExecutor(1)
+        self._step_future = self._step_executor.submit(self.step, actions)
+
+    def step_wait(self):
+        future, self._step_future = self._step_future, None
+        return future.result()
+
     def _observe(self, target_game_loop):
         def parallel_observe(c):
             obs = c.observe(target_game_loop=target_game_loop)
@@ -507,19 +577,14 @@ class SC2Env(object):
         return self._state
 
     def close(self):
-        # Don't use parallel since it might be broken by an exception.
-        if self._controllers:
-            for c in self._controllers:
-                c.quit()
-            self._controllers = None
-        if self._sc2_procs:
-            for p in self._sc2_procs:
-                p.close()
-            self._sc2_procs = None
-
-        if self._ports:
-            portspicker.return_ports(self._ports)
-            self._ports = None
+        self._step_future = None
+        if self._warm_pool is not None:
+            self._warm_pool.close()
+        close_slot(self._get_slot())
+        self._sc2_procs = None
+        self._controllers = None
+        self._ports = None
+        self._slot_games = 0
         self._episode_count = 0
         self._game_info = None
 
@@ -532,6 +597,106 @@ class SC2Env(object):
         return self._controllers[0]
 
 
+def close_slot(slot):
+    # Don't use parallel since it might be broken by an exception.
+    if slot['controllers']:
+        for c in slot['controllers']:
+            c.quit()
+    if slot['procs']:
+        for p in slot['procs']:
+            p.close()
+    if slot['ports']:
+        portspicker.return_ports(slot['ports'])
+
+
+class WarmGamePool(object):
+    r"""
+    Overview:
+        keep a standby slot of SC2 processes for an SC2Env. While an episode runs, a background thread launches
+        the standby processes (or leaves the finished game on them) and creates and joins the next game, reset then
+        swaps the standby slot in instead of launching SC2 and loading the map. Slots are health checked before use
+        and recycled after recycle_games games for memory release.
+    Interface:
+        __init__, prepare, acquire, healthy, close
+    """
+
+    def __init__(self, env, recycle_games=10, health_check_timeout=10):
+        self._env = env
+        self._recycle_games = recycle_games
+        self._health_check_timeout = health_check_timeout
+        self._executor = futures.ThreadPoolExecutor(1)
+        self._parallel = run_parallel.RunParallel()
+        self._standby = None
+
+    def prepare(self, slot=None):
+        r"""
+        Overview:
+            prepare the next game in background on slot, a new slot is launched if slot is None, worn out or
+            unhealthy
+        """
+        assert self._standby is None, 'acquire must be called before next prepare'
+        self._standby = self._executor.submit(self._prepare, slot)
+
+    def _prepare(self, slot):
+        env = self._env
+        try:
+            if slot is not None and slot['controllers'] and \
+                    (slot['games'] >= self._recycle_games or not self.healthy(slot)):
+                close_slot(slot)
+                slot = None
+            if slot is None or not slot['controllers']:
+                slot = env._start_sc2()
+            elif len(slot['controllers']) > 1:
+                self._parallel.run(c.leave for c in slot['controllers'])
+            map_name = env._choose_map_name()
+            map_list = [maps.get(name) for name in to_list(map_name)]
+            game = env._create_join_game(map_list, env._make_interface(map_name), slot['controllers'], slot['ports'],
+                                         self._parallel)
+            slot['games'] += 1
+            return slot, game
+        except Exception:
+            if slot is not None:
+                close_slot(slot)
+            raise
+
+    def acquire(self):
+        r"""
+        Overview:
+            wait for the prepared game, returns (slot, game) or None if there is no healthy standby game
+        """
+        if self._standby is None:
+            return None
+        future, self._standby = self._standby, None
+        try:
+            slot, game = future.result()
+        except Exception as e:
+            print('[ERROR {}] prepare standby SC2 game failed'.format(e))
+            return None
+        if not self.healthy(slot):
+            print('[WARNING] standby SC2 processes failed health check, restart them')
+            close_slot(slot)
+            return None
+        return slot, game
+
+    def healthy(self, slot):
+        if not all(p.running for p in slot['procs']):
+            return False
+        executor = futures.ThreadPoolExecutor(len(slot['controllers']))
+        pings = [executor.submit(c.ping) for c in slot['controllers']]
+        done, not_done = futures.wait(pings, self._health_check_timeout)
+        executor.shutdown(wait=False)
+        return not not_done and all(f.exception() is None for f in done)
+
+    def close(self):
+        if self._standby is not None:
+            future, self._standby = self._standby, None
+            try:
+                slot, _ = future.result()
+                close_slot(slot)
+            except Exception:
+                pass
+
+
 def crop_and_deduplicate_names(names):
     """Crops and de-duplicates the passed names.
 
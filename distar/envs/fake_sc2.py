@@ -0,0 +1,425 @@
+import math
+import os
+import random
+import threading
+import time
+
+from distar.pysc2.lib import protocol
+from distar.pysc2.lib.actions import RAW_ABILITY_IDS
+from distar.pysc2.lib.features import MINIMAP_FEATURES
+from distar.pysc2.lib.protocol import Status
+from distar.pysc2.tests import dummy_observation
+from distar.envs.map_info import MAPS, get_map_size, LOCALIZED_BNET_NAME_TO_NAME_LUT
+
+from s2clientprotocol import common_pb2 as sc_common
+from s2clientprotocol import error_pb2 as sc_error
+from s2clientprotocol import sc2api_pb2 as sc_pb
+
+# game_port -> number of players joined, players get ids in join order
+_JOINED = {}
+_JOINED_LOCK = threading.Lock()
+HATCHERY = 86
+DRONE = 104
+OVERLORD = 106
+MINERAL_FIELD = 341
+VESPENE_GEYSER = 342
+# zergling, roach, hydralisk, ravager, queen
+ARMY_TYPES = [105, 110, 107, 688, 126]
+ARMY_WEIGHTS = [40, 30, 15, 5, 10]
+# spawning pool, extractor, extractor, roach warren, evolution chamber, lair, hydralisk den
+STRUCTURE_TYPES = [89, 88, 88, 97, 90, 100, 91]
+HEALTH = {86: 1500., 104: 40., 106: 200., 105: 35., 110: 145., 107: 90., 688: 120., 126: 175., 89: 1000.,
+          88: 500., 97: 850., 90: 750., 100: 2000., 91: 850.}
+START_UNITS = 14  # hatchery, 12 drones and an overlord
+MAX_WORKERS = 70
+STRUCTURE_LOOPS = 1000  # game loops between new structures
+EXPANSION_LOOPS = 3000  # game loops between new hatcheries
+MAX_EXPANSIONS = 2
+BASES = 8
+
+
+class FakeUnit(object):
+    # raw unit for dummy_observation.Builder.feature_units, tag is added by the builder
+
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+
+    def as_dict(self):
+        return self._kwargs
+
+
+class FakeWorld(object):
+    r"""
+    Overview:
+        units seen by one player of a fake zerg mirror game. Own units grow from the opening hatchery, 12 drones
+        and overlord to max_units at ramp_loops, visible enemy units are enemy_ratio of own army, minerals and
+        geysers lie at BASES bases between the born locations. Army units move, get hurt and die, tags stay the same
+        while units live. With max_units <= 0 the world is only the own hatchery.
+    Interface:
+        __init__, step, units, player_common, is_own, has_unit
+    """
+
+    def __init__(self, player_id, born_location, enemy_location, map_size, max_units=0, ramp_loops=13440,
+                 enemy_ratio=0.5, seed=None):
+        self._player_id = player_id
+        self._born_location = born_location
+        self._enemy_location = enemy_location
+        self._map_size = map_size
+        self._max_units = max_units
+        self._ramp_loops = ramp_loops
+        self._enemy_ratio = enemy_ratio
+        self._rng = random.Random(seed)
+        self._game_loop = 0
+        self._next_tag = 1
+        self._units = {}
+        self._groups = {k: [] for k in ['worker', 'overlord', 'army', 'structure', 'expansion', 'enemy', 'neutral']}
+        self._add('structure', HATCHERY, 1, born_location, 0.)
+        if max_units <= 0:
+            return
+        for _ in range(12):
+            self._add('worker', DRONE, 1, born_location, 6.)
+        self._add('overlord', OVERLORD, 1, born_location, 4.)
+        for base in self._bases():
+            for i in range(8):
+                angle = math.pi * (i / 7. - 0.5)
+                self._add('neutral', MINERAL_FIELD, 3, (base[0] + 7 * math.cos(angle), base[1] + 7 * math.sin(angle)),
+                          0., mineral_contents=1800)
+            for i in range(2):
+                self._add('neutral', VESPENE_GEYSER, 3, (base[0] - 7, base[1] + 6 * (2 * i - 1)), 0.,
+                          vespene_contents=2250)
+
+    def _bases(self):
+        # born locations and expansions on both sides of the line between them
+        bases = []
+        (x0, y0), (x1, y1) = self._born_location, self._enemy_location
+        for i in range(BASES):
+            frac = i / (BASES - 1)
+            offset = 0 if i in [0, BASES - 1] else (-1) ** i * self._map_size[0] / 6
+            bases.append((x0 + frac * (x1 - x0) + offset, y0 + frac * (y1 - y0) - offset))
+        return bases
+
+    def _clip(self, x, y):
+        return min(max(x, 0.), self._map_size[0] - 1.), min(max(y, 0.), self._map_size[1] - 1.)
+
+    def _add(self, group, unit_type, alliance, center, spread, **kwargs):
+        x, y = self._clip(center[0] + self._rng.uniform(-spread, spread),
+                          center[1] + self._rng.uniform(-spread, spread))
+        health = HEALTH.get(unit_type, 0.)
+        if alliance == 3:
+            owner = 16
+        else:
+            owner = self._player_id if alliance == 1 else 3 - self._player_id
+        unit = dict(tag=self._next_tag, unit_type=unit_type, alliance=alliance, owner=owner, display_type=1,
+                    cloak=3, build_progress=1., health=health, health_max=health, is_on_screen=True,
+                    pos=sc_common.Point(x=x, y=y, z=10.), **kwargs)
+        self._units[self._next_tag] = FakeUnit(**unit)
+        self._groups[group].append(self._next_tag)
+        self._next_tag += 1
+
+    def _remove(self, group, tag):
+        self._groups[group].remove(tag)
+        self._units.pop(tag)
+
+    def _grow(self, group, target, unit_type, alliance, center, spread):
+        while len(self._groups[group]) < target:
+            self._add(group, unit_type() if callable(unit_type) else unit_type, alliance, center, spread)
+
+    def step(self, loops):
+        self._game_loop += loops
+        if self._max_units <= 0:
+            return
+        rng = self._rng
+        frac = min(1., self._game_loop / self._ramp_loops)
+        total = START_UNITS + (self._max_units - START_UNITS) * frac
+        workers = min(MAX_WORKERS, 12 + int(total * 0.45))
+        overlords = 1 + int(total / 8)
+        structures = min(len(STRUCTURE_TYPES), self._game_loop // STRUCTURE_LOOPS)
+        expansions = min(MAX_EXPANSIONS, self._game_loop // EXPANSION_LOOPS)
+        army = max(0, int(total) - 1 - workers - overlords - structures - expansions)
+        enemy = int(army * self._enemy_ratio)
+        middle = ((self._born_location[0] + self._enemy_location[0]) / 2,
+                  (self._born_location[1] + self._enemy_location[1]) / 2)
+
+        # army units fight in the middle of the map, about 1 in 2000 dies every game loop
+        for group in ['army', 'enemy']:
+            for tag in list(self._groups[group]):
+                if rng.random() < loops / 2000:
+                    self._remove(group, tag)
+                    continue
+                unit = self._units[tag].as_dict()
+                x, y = self._clip(unit['pos'].x + rng.uniform(-1, 1) * loops / 8,
+                                  unit['pos'].y + rng.uniform(-1, 1) * loops / 8)
+                unit['pos'].x, unit['pos'].y = x, y
+                unit['health'] = max(1., min(unit['health_max'], unit['health'] + rng.uniform(-5, 3) * loops))
+
+        bases = self._bases()
+        self._grow('worker', workers, DRONE, 1, self._born_location, 8.)
+        self._grow('overlord', overlords, OVERLORD, 1, self._born_location, 20.)
+        while len(self._groups['structure']) - 1 < structures:
+            self._add('structure', STRUCTURE_TYPES[len(self._groups['structure']) - 1], 1, self._born_location, 10.)
+        while len(self._groups['expansion']) < expansions:
+            self._add('expansion', HATCHERY, 1, bases[len(self._groups['expansion']) + 1], 0.)
+        self._grow('army', army, lambda: rng.choices(ARMY_TYPES, ARMY_WEIGHTS)[0], 1, self._born_location, 15.)
+        self._grow('enemy', enemy, lambda: rng.choices(ARMY_TYPES, ARMY_WEIGHTS)[0], 4, middle, 15.)
+
+    def units(self):
+        return list(self._units.values())
+
+    def player_common(self):
+        workers = len(self._groups['worker'])
+        army_food = 2 * len(self._groups['army'])
+        hatcheries = 1 + len(self._groups['expansion'])
+        food_cap = min(200, 6 * hatcheries + 8 * len(self._groups['overlord']))
+        return dict(player_id=self._player_id, minerals=50 + self._game_loop * 7 % 800,
+                    vespene=self._game_loop * 3 % 400, food_cap=food_cap, food_used=min(200, workers + army_food),
+                    food_army=army_food, food_workers=workers, army_count=len(self._groups['army']), larva_count=3)
+
+    def is_own(self, tag):
+        return tag in self._units and self._units[tag].as_dict()['alliance'] == 1
+
+    def has_unit(self, tag):
+        return tag in self._units
+
+
+class FakeController(object):
+    r"""
+    Overview:
+        stub of remote_controller.RemoteController without SC2, games advance their game loop and FakeWorld and
+        end after game_loops loops with a victory of player 1. Calls sleep for the configured time to look like SC2.
+        Raw unit commands are checked against the world and accepted ones are reported in the actions of the next
+        observation, like SC2 does.
+    Interface:
+        status, status_ended, ping, save_map, create_game, join_game, game_info, data, observe, step, acts,
+        leave, restart, save_replay, quit, close
+    """
+
+    def __init__(self, process, game_loops=1000, join_time=0., step_time=0., born_locations=None, world=None):
+        self._process = process
+        self._game_loops = game_loops
+        self._join_time = join_time
+        self._step_time = step_time
+        self._born_locations = born_locations
+        self._world_kwargs = world or {}
+        self._world = None
+        self._actions = []
+        self._status = Status.launched
+        self._game_loop = 0
+        self._game_port = None
+        self._player_id = None
+        self._map_name = 'KairosJunction'
+        self.games = 0
+
+    def _check_alive(self):
+        if not self._process.running:
+            raise protocol.ConnectionError('Fake SC2 process is not running')
+
+    @property
+    def status(self):
+        return self._status
+
+    @property
+    def status_ended(self):
+        return self._status == Status.ended
+
+    def ping(self):
+        self._check_alive()
+        return sc_pb.ResponsePing(game_version='fake', data_version='fake', data_build=0, base_build=0)
+
+    def _set_map(self, map_path):
+        # map files are named <localized name>(_<born location>).SC2Map
+        name = os.path.splitext(os.path.basename(map_path.replace('\\', '/')))[0].split('_')[0]
+        self._map_name = LOCALIZED_BNET_NAME_TO_NAME_LUT.get(name, self._map_name)
+
+    def save_map(self, map_path, map_data):
+        self._check_alive()
+        self._set_map(map_path)
+        return sc_pb.ResponseSaveMap()
+
+    def create_game(self, req_create_game):
+        self._check_alive()
+        self._set_map(req_create_game.local_map.map_path)
+        self._status = Status.init_game
+        return sc_pb.ResponseCreateGame()
+
+    def join_game(self, req_join_game):
+        self._check_alive()
+        time.sleep(self._join_time)
+        self._game_port = req_join_game.server_ports.game_port
+        with _JOINED_LOCK:
+            _JOINED[self._game_port] = _JOINED.get(self._game_port, 0) + 1
+            self._player_id = _JOINED[self._game_port]
+        self._status = Status.in_game
+        self._start_game()
+        return sc_pb.ResponseJoinGame(player_id=self._player_id)
+
+    def _start_game(self):
+        self._game_loop = 0
+        self._actions = []
+        born_location = self._born_location(self._player_id)
+        enemy_location = self._born_location(3 - self._player_id)
+        self._world = FakeWorld(self._player_id, (born_location.x, born_location.y),
+                                (enemy_location.x, enemy_location.y), get_map_size(self._map_name),
+                                **self._world_kwargs)
+        self.games += 1
+
+    def _leave_game(self):
+        if self._game_port is not None:
+            with _JOINED_LOCK:
+                _JOINED.pop(self._game_port, None)
+            self._game_port = None
+
+    def _born_location(self, player_id):
+        if self._born_locations:
+            x, y = self._born_locations[player_id - 1]
+            return sc_common.Point2D(x=x, y=y)
+        # players are born at opposite corners
+        x, y = get_map_size(self._map_name)
+        scale = 0.25 if player_id == 1 else 0.75
+        return sc_common.Point2D(x=int(x * scale) + 0.5, y=int(y * scale) + 0.5)
+
+    def game_info(self):
+        self._check_alive()
+        map_size = get_map_size(self._map_name)
+        game_info = sc_pb.ResponseGameInfo(map_name=MAPS[self._map_name][0] or self._map_name)
+        game_info.start_raw.map_size.x = map_size[0]
+        game_info.start_raw.map_size.y = map_size[1]
+        game_info.start_raw.playable_area.p1.x = map_size[0]
+        game_info.start_raw.playable_area.p1.y = map_size[1]
+        game_info.start_raw.start_locations.add().CopyFrom(self._born_location(3 - self._player_id))
+        game_info.player_info.add(player_id=1, type=sc_pb.Participant, race_requested=2)
+        game_info.player_info.add(player_id=2, type=sc_pb.Participant, race_requested=2)
+        return game_info
+
+    def data(self):
+        self._check_alive()
+        return sc_pb.ResponseData()
+
+    def observe(self, disable_fog=False, target_game_loop=0):
+        self._check_alive()
+        map_size = get_map_size(self._map_name)
+        builder = dummy_observation.Builder({'feature_minimap': (len(MINIMAP_FEATURES), map_size[1], map_size[0])})
+        obs = builder.game_loop(self._game_loop).player_common(**self._world.player_common()).feature_units(
+            self._world.units()).build()
+        for action in self._actions:
+            obs.actions.add().CopyFrom(action)
+        self._actions = []
+        if self._status == Status.ended:
+            obs.player_result.add(player_id=1, result=sc_pb.Victory)
+            obs.player_result.add(player_id=2, result=sc_pb.Defeat)
+        return obs
+
+    def step(self, count=1):
+        self._check_alive()
+        time.sleep(self._step_time)
+        if self._status == Status.in_game:
+            self._game_loop += count
+            self._world.step(count)
+            if self._game_loop >= self._game_loops:
+                self._status = Status.ended
+        return sc_pb.ResponseStep(simulation_loop=self._game_loop)
+
+    def _action_result(self, action):
+        if not action.action_raw.HasField('unit_command'):
+            return sc_error.Success
+        unit_command = action.action_raw.unit_command
+        if unit_command.ability_id not in RAW_ABILITY_IDS:
+            return sc_error.NotSupported
+        if not unit_command.unit_tags or not all(self._world.is_own(t) for t in unit_command.unit_tags):
+            return sc_error.Error
+        if unit_command.HasField('target_unit_tag') and not self._world.has_unit(unit_command.target_unit_tag):
+            return sc_error.CantTargetThatUnit
+        return sc_error.Success
+
+    def acts(self, act_list):
+        self._check_alive()
+        result = []
+        for action in act_list:
+            result.append(self._action_result(action))
+            if result[-1] == sc_error.Success:
+                self._actions.append(action)
+        return sc_pb.ResponseAction(result=result)
+
+    def leave(self):
+        self._check_alive()
+        self._leave_game()
+        self._status = Status.launched
+        return sc_pb.ResponseLeaveGame()
+
+    def restart(self):
+        self._check_alive()
+        self._status = Status.in_game
+        self._start_game()
+        return sc_pb.ResponseRestartGame()
+
+    def save_replay(self):
+        self._check_alive()
+        return b''
+
+    def quit(self):
+        self._leave_game()
+        self._status = Status.quit
+
+    def close(self):
+        pass
+
+
+class FakeSC2Process(object):
+    r"""
+    Overview:
+        stub of sc_process.StarcraftProcess with a FakeController, kill simulates a crashed SC2 process
+    Interface:
+        controller, running, pid, kill, close
+    """
+    count = 0
+
+    def __init__(self, launch_time=0., **kwargs):
+        time.sleep(launch_time)
+        FakeSC2Process.count += 1
+        self._running = True
+        self._controller = FakeController(self, **kwargs)
+
+    @property
+    def controller(self):
+        return self._controller
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def pid(self):
+        return None
+
+    def kill(self):
+        self._running = False
+
+    def close(self):
+        if self._controller:
+            self._controller.quit()
+            self._controller = None
+        self._running = False
+
+
+class FakeRunConfig(object):
+    r"""
+    Overview:
+        run config starting FakeSC2Process instead of SC2, selected by env.fake_sc2, keys of env.fake_sc2 are
+        launch_time, join_time and step_time in seconds, game_loops of every game, born_locations ([x, y] of
+        player 1 and 2, opposite corners by default) and world (kwargs of FakeWorld, e.g. max_units)
+    Interface:
+        start, map_data, save_replay
+    """
+
+    def __init__(self, launch_time=0., join_time=0., step_time=0., game_loops=1000, born_locations=None, world=None):
+        self._launch_time = launch_time
+        self._kwargs = {'join_time': join_time, 'step_time': step_time, 'game_loops': game_loops,
+                        'born_locations': born_locations, 'world': world}
+
+    def start(self, **kwargs):
+        return FakeSC2Process(self._launch_time, **self._kwargs)
+
+    def map_data(self, map_name, players=None):
+        return b''
+
+    def save_replay(self, replay_data, replay_dir, prefix=None):
+        return 'fake.SC2Replay'
@@ -0,0 +1,242 @@
+import os
+import platform
+import signal
+import time
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+from distar.envs.env import SC2Env
+from distar.agent.default.agent import copy_input_data
+from distar.agent.default.lib.features import Features, fake_step_data
+
+
+def _worker_loop(env_idx, cfg, pipe, obs_buffers, num_agents, send_raw_obs):
+    # own process group, so SC2 processes are killed with a hung worker
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()
+    torch.set_num_threads(1)
+    env = SC2Env(cfg)
+    use_value_feature = cfg.get('learner', {}).get('use_value_feature', False)
+    features = [None] * num_agents
+    pending_reset = None
+
+    def reset():
+        observations, game_info, map_name = env.reset()
+        for side in range(num_agents):
+            features[side] = Features(game_info[side], observations[side]['raw_obs'], cfg)
+        return observations, {'map_name': map_name, 'game_info': game_info}
+
+    def write(observations, buffer_idx):
+        ret = {}
+        for side, obs in observations.items():
+            if use_value_feature:
+                agent_obs = features[side].transform_obs(obs['raw_obs'], padding_spatial=True,
+                                                         opponent_obs=obs['opponent_obs'])
+            else:
+                agent_obs = features[side].transform_obs(obs['raw_obs'], padding_spatial=True)
+            ret[side] = {'action_result': obs['action_result'], 'game_info': agent_obs.pop('game_info')}
+            if use_value_feature:
+                ret[side]['value_feature'] = agent_obs.pop('value_feature')
+            if send_raw_obs:
+                ret[side]['raw_obs'] = obs['raw_obs']
+                ret[side]['opponent_obs'] = obs['opponent_obs']
+            copy_input_data(obs_buffers[buffer_idx], agent_obs, data_idx=env_idx * num_agents + side)
+        return ret
+
+    need_reset = True
+    while True:
+        cmd, buffer_idx, actions = pipe.recv()
+        if cmd == 'close':
+            env.close()
+            break
+        result = {'reward': [0] * num_agents, 'done': False, 'crashed': False, 'reset': None, 'obs': {}}
+        try:
+            if cmd == 'reset' or need_reset:
+                observations, result['reset'] = pending_reset if pending_reset is not None else reset()
+                pending_reset = None
+                need_reset = False
+            else:
+                observations, result['reward'], result['done'] = env.step(actions)
+            result['obs'] = write(observations, buffer_idx)
+        except Exception as e:
+            print('[VECTOR ENV {} ERROR]'.format(env_idx), e, flush=True)
+            print(''.join(traceback.format_tb(e.__traceback__)), flush=True)
+            env.close()
+            result.update({'done': True, 'crashed': True, 'obs': {}})
+            pending_reset = None
+        pipe.send(result)
+        if result['done']:
+            need_reset = True
+            if not result['crashed']:
+                # start the next game while the consumer handles the last step
+                try:
+                    pending_reset = reset()
+                except Exception as e:
+                    print('[VECTOR ENV {} RESET ERROR]'.format(env_idx), e, flush=True)
+                    env.close()
+
+
+class VectorSC2Env(object):
+    r"""
+    Overview:
+        env_num SC2Env in worker processes. Workers transform observations with Features and write them into shared
+        memory batches of the fake_step_data layout, row env_idx * num_agents + side, other data goes through pipes.
+        Two batches are used in turn, so observations of the last step stay valid while the current step runs.
+        Finished envs reset themselves in background and report the first observation of the next game at the next
+        step, a crashed or hung worker is restarted without affecting others.
+    Interface:
+        __init__, reset, step_async, step_wait, agent_obs, close, obs, obs_mask, dones
+    """
+
+    def __init__(self, cfg, env_num, step_timeout=300, send_raw_obs=True):
+        self._cfg = cfg
+        self._env_num = env_num
+        self._num_agents = sum(1 for player_id in cfg.env.player_ids if 'bot' not in player_id)
+        self._step_timeout = step_timeout
+        self._send_raw_obs = send_raw_obs
+        batch_size = env_num * self._num_agents
+        self._obs_buffers = [fake_step_data(share_memory=True, batch_size=batch_size, train=False) for _ in range(2)]
+        self._buffer_idx = 0
+        self._obs_mask = torch.zeros(env_num, self._num_agents, dtype=torch.bool)
+        self._dones = torch.zeros(env_num, dtype=torch.bool)
+        self._infos = [None] * env_num
+        context_str = 'spawn' if platform.system().lower() == 'windows' else 'fork'
+        self._mp_context = mp.get_context(context_str)
+        self._pipes = [None] * env_num
+        self._processes = [None] * env_num
+        for env_idx in range(env_num):
+            self._start_worker(env_idx)
+
+    def _start_worker(self, env_idx):
+        pipe_p, pipe_c = self._mp_context.Pipe()
+        p = self._mp_context.Process(target=_worker_loop, args=(
+            env_idx, self._cfg, pipe_c, self._obs_buffers, self._num_agents, self._send_raw_obs), daemon=True)
+        p.start()
+        self._pipes[env_idx] = pipe_p
+        self._processes[env_idx] = p
+
+    def _kill_worker(self, env_idx):
+        p = self._processes[env_idx]
+        if hasattr(os, 'killpg'):
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+        if p.is_alive():
+            p.kill()
+        p.join(timeout=5)
+
+    def _restart_worker(self, env_idx):
+        self._kill_worker(env_idx)
+        self._pipes[env_idx].close()
+        self._start_worker(env_idx)
+
+    def reset(self):
+        r"""
+        Overview:
+            start new games in all envs, returns the same as step_wait
+        """
+        self._buffer_idx = 1 - self._buffer_idx
+        for env_idx in range(self._env_num):
+            self._send(env_idx, 'reset', None)
+        return self._wait()
+
+    def step_async(self, actions):
+        r"""
+        Overview:
+            step all envs in background, actions[env_idx] is the action dict of SC2Env.step, actions of envs done at
+            the last step are ignored and these envs reset instead
+        """
+        self._buffer_idx = 1 - self._buffer_idx
+        for env_idx in range(self._env_num):
+            self._send(env_idx, 'step', actions[env_idx])
+
+    def step_wait(self):
+        r"""
+        Overview:
+            wait for all envs, observations are in obs, rows of obs_mask are the sides observed at this step
+        Returns:
+            - reward (:obj:`torch.Tensor`): reward of shape (env_num, num_agents)
+            - dones (:obj:`torch.Tensor`): bool of shape (env_num, ), True if the game ended or the env crashed
+            - infos (:obj:`list`): per env dict of 'obs' (side -> non tensor data, agent_obs of Agent.step), 'reset'
+              (map_name and game_info of a new game or None) and 'crashed'
+        """
+        return self._wait()
+
+    def _send(self, env_idx, cmd, actions):
+        try:
+            self._pipes[env_idx].send((cmd, self._buffer_idx, actions))
+        except (BrokenPipeError, EOFError, OSError):
+            # found dead when waiting
+            pass
+
+    def _wait(self):
+        rewards = torch.zeros(self._env_num, self._num_agents)
+        self._obs_mask.zero_()
+        deadline = time.time() + self._step_timeout
+        for env_idx in range(self._env_num):
+            try:
+                if not self._pipes[env_idx].poll(max(deadline - time.time(), 0)):
+                    raise TimeoutError('env {} step timeout'.format(env_idx))
+                result = self._pipes[env_idx].recv()
+            except (TimeoutError, EOFError, OSError) as e:
+                print('[VECTOR ENV {} ERROR] worker is dead or hung, restart it:'.format(env_idx), e, flush=True)
+                self._restart_worker(env_idx)
+                result = {'reward': [0] * self._num_agents, 'done': True, 'crashed': True, 'reset': None, 'obs': {}}
+            rewards[env_idx] = torch.tensor(result['reward'], dtype=torch.float)
+            self._dones[env_idx] = result['done']
+            for side, obs in result['obs'].items():
+                self._obs_mask[env_idx, side] = True
+                obs['agent_obs'] = self.agent_obs(env_idx, side, obs)
+            self._infos[env_idx] = {'obs': result['obs'], 'reset': result['reset'], 'crashed': result['crashed']}
+        return rewards, self._dones.clone(), self._infos
+
+    def agent_obs(self, env_idx, side, obs):
+        r"""
+        Overview:
+            views of one row of obs in the format of Features.transform_obs, entity_info is cut to entity_num
+        """
+        row = env_idx * self._num_agents + side
+        buffer = self.obs
+        entity_num = buffer['entity_num'][row]
+        num = entity_num.item()
+        ret = {
+            'spatial_info': {k: v[row] for k, v in buffer['spatial_info'].items()},
+            'scalar_info': {k: v[row] for k, v in buffer['scalar_info'].items()},
+            'entity_info': {k: v[row, :num] for k, v in buffer['entity_info'].items()},
+            'entity_num': entity_num,
+            'game_info': obs['game_info'],
+        }
+        if 'value_feature' in obs:
+            ret['value_feature'] = obs['value_feature']
+        return ret
+
+    @property
+    def obs(self):
+        return self._obs_buffers[self._buffer_idx]
+
+    @property
+    def obs_mask(self):
+        return self._obs_mask
+
+    @property
+    def dones(self):
+        return self._dones
+
+    @property
+    def env_num(self):
+        return self._env_num
+
+    @property
+    def num_agents(self):
+        return self._num_agents
+
+    def close(self):
+        for env_idx in range(self._env_num):
+            self._send(env_idx, 'close', None)
+        for env_idx, p in enumerate(self._processes):
+            p.join(timeout=10)
+            if p.is_alive():
+                self._kill_worker(env_idx)